@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2022, CloudBlue
+# All rights reserved.
+#
+"""
+Connection pooling benchmark of the outbound HTTP calls.
+
+Starts a local HTTP/1.1 server standing in for Connect and measures the latency
+of sequential calls made with a new HTTP client per call, as done when every
+Connect client opens its own connections, and with the session shared by the
+extension. The local server has no TLS, against Connect the handshake makes the
+gap larger.
+
+Usage:
+
+    python benchmarks/pooling.py --calls 200 --delay 0.005
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import httpx
+
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from connect_ext.client import get_http_session  # noqa: E402
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    delay = 0.0
+
+    def do_GET(self):  # noqa: N802
+        time.sleep(self.delay)
+        body = b'{"id": "PR-123"}'
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+async def _measure(url, calls, get_session):
+    timings = []
+    for _ in range(calls):
+        started = time.perf_counter()
+        async with get_session() as session:
+            (await session.get(url)).raise_for_status()
+        timings.append(time.perf_counter() - started)
+    return timings
+
+
+class _Shared:
+    """Context manager returning the shared session without closing it."""
+
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+
+    async def __aenter__(self):
+        return get_http_session(self.endpoint)
+
+    async def __aexit__(self, *args):
+        pass
+
+
+def _report(name, timings):
+    timings = sorted(timings)
+    p95 = timings[int(len(timings) * 0.95) - 1]
+    print(
+        f'{name}: median {statistics.median(timings) * 1000:.2f} ms, '
+        f'p95 {p95 * 1000:.2f} ms',
+    )
+
+
+async def _main(calls, url, endpoint):
+    _report('new client per call', await _measure(url, calls, httpx.AsyncClient))
+    _report('shared session', await _measure(url, calls, lambda: _Shared(endpoint)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--calls', type=int, default=200)
+    parser.add_argument('--delay', type=float, default=0.0)
+    args = parser.parse_args()
+
+    Handler.delay = args.delay
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    endpoint = f'http://127.0.0.1:{server.server_port}/public/v1'
+    try:
+        asyncio.run(_main(args.calls, f'{endpoint}/requests/PR-123', endpoint))
+    finally:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2022, CloudBlue
+# All rights reserved.
+#
+"""
+Startup benchmark of the extension.
+
+Measures, in fresh interpreters, the time needed to import the events and web
+applications and the latency of the first and second requests served by the
+web application. Each run happens in an empty temporary directory to also check
+that importing the extension does not create any file.
+
+Usage:
+
+    python benchmarks/startup.py --runs 5
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+IMPORT_SNIPPET = '''
+import time
+started = time.perf_counter()
+import {module}
+print(time.perf_counter() - started)
+'''
+
+FIRST_REQUEST_SNIPPET = '''
+import time
+from connect.eaas.core.testing.testclient import WebAppTestClient
+from connect_ext.webapp import TstWebApplication
+client = WebAppTestClient(TstWebApplication)
+for _ in range(2):
+    started = time.perf_counter()
+    client.get('/api/tests')
+    print(time.perf_counter() - started)
+'''
+
+
+def _run(snippet):
+    with tempfile.TemporaryDirectory() as cwd:
+        env = dict(os.environ, PYTHONPATH=ROOT)
+        output = subprocess.run(
+            [sys.executable, '-c', snippet],
+            cwd=cwd,
+            env=env,
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout
+        created = os.listdir(cwd)
+    return [float(line) for line in output.split()], created
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+
+    for module in ('connect_ext.db', 'connect_ext.events', 'connect_ext.webapp'):
+        timings = []
+        for _ in range(args.runs):
+            (elapsed,), created = _run(IMPORT_SNIPPET.format(module=module))
+            if created:
+                print(f'WARNING: importing {module} created {created}')
+            timings.append(elapsed)
+        print(f'import {module}: median {statistics.median(timings) * 1000:.1f} ms')
+
+    first, second = [], []
+    for _ in range(args.runs):
+        (first_elapsed, second_elapsed), _ = _run(FIRST_REQUEST_SNIPPET)
+        first.append(first_elapsed)
+        second.append(second_elapsed)
+    print(f'first request: median {statistics.median(first) * 1000:.1f} ms')
+    print(f'second request: median {statistics.median(second) * 1000:.1f} ms')
+
+
+if __name__ == '__main__':
+    main()
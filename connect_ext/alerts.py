@@ -0,0 +1,278 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2022, CloudBlue
+# All rights reserved.
+#
+import asyncio
+import logging
+import math
+import time
+from collections import defaultdict, deque
+from datetime import datetime
+from typing import Awaitable, Callable, Deque, Dict, List, Optional, Tuple
+
+import httpx
+from pydantic import BaseModel
+
+from connect_ext.models import ResultType, TstInstance
+from connect_ext.settings import get_settings
+
+
+logger = logging.getLogger('connect_ext')
+
+
+class Alert(BaseModel):
+    rule: str
+    hub_id: Optional[str]
+    step: Optional[str]
+    test_id: Optional[int]
+    value: float
+    threshold: float
+    message: str
+    fired_at: datetime
+
+    @property
+    def key(self) -> Tuple:
+        return self.rule, self.hub_id, self.step
+
+
+class RollingStats:
+    """
+    Statistics of the last finished tests, updated once per test: the consecutive
+    failures of each hub and the last ``window`` durations of each hub and step.
+    """
+
+    def __init__(self, window: int):
+        self.window = window
+        self.consecutive_failures: Dict[str, int] = defaultdict(int)
+        self.durations: Dict[Tuple[str, str], Deque[float]] = {}
+
+    def update(self, test: TstInstance) -> None:
+        if test.result == ResultType.failed:
+            self.consecutive_failures[test.hub_id] += 1
+        else:
+            self.consecutive_failures[test.hub_id] = 0
+        for step in test.steps or []:
+            if step.checked_at:
+                durations = self.durations.setdefault(
+                    (test.hub_id, step.name),
+                    deque(maxlen=self.window),
+                )
+                durations.append((step.checked_at - step.created_at).total_seconds())
+
+    def percentile(self, hub_id: str, step: str, percentile: float) -> Tuple[float, int]:
+        """Return the nearest-rank ``percentile`` of the window and its amount of samples."""
+        durations = sorted(self.durations.get((hub_id, step), ()))
+        if not durations:
+            return math.nan, 0
+        rank = max(0, math.ceil(len(durations) * percentile / 100) - 1)
+        return durations[rank], len(durations)
+
+
+class ConsecutiveFailuresRule:
+    name = 'consecutive_failures'
+
+    def __init__(self, threshold: int):
+        self.threshold = threshold
+
+    def evaluate(self, stats: RollingStats, test: TstInstance) -> List[Alert]:
+        failures = stats.consecutive_failures[test.hub_id]
+        if failures < self.threshold:
+            return []
+        return [
+            Alert(
+                rule=self.name,
+                hub_id=test.hub_id,
+                step=None,
+                test_id=test.id,
+                value=failures,
+                threshold=self.threshold,
+                message=f'{failures} consecutive tests failed on hub {test.hub_id}.',
+                fired_at=datetime.now(),
+            ),
+        ]
+
+
+class StepLatencyRule:
+    name = 'step_latency'
+
+    def __init__(self, thresholds: Dict[str, float], percentile: float, min_samples: int):
+        self.thresholds = thresholds
+        self.percentile = percentile
+        self.min_samples = min_samples
+
+    def evaluate(self, stats: RollingStats, test: TstInstance) -> List[Alert]:
+        alerts = []
+        steps = {step.name for step in test.steps or [] if step.checked_at}
+        for step in sorted(steps & self.thresholds.keys()):
+            value, samples = stats.percentile(test.hub_id, step, self.percentile)
+            if samples >= self.min_samples and value > self.thresholds[step]:
+                alerts.append(
+                    Alert(
+                        rule=self.name,
+                        hub_id=test.hub_id,
+                        step=step,
+                        test_id=test.id,
+                        value=value,
+                        threshold=self.thresholds[step],
+                        message=(
+                            f'p{self.percentile:g} of the {step} step on hub {test.hub_id} '
+                            f'is {value:.1f}s, above {self.thresholds[step]:g}s.'
+                        ),
+                        fired_at=datetime.now(),
+                    ),
+                )
+        return alerts
+
+
+async def log_alert(alert: Alert) -> None:
+    logger.warning(f'Alert {alert.rule}: {alert.message}', extra={'alert': alert.dict()})
+
+
+def webhook_sink(url: str, timeout: float) -> Callable[[Alert], Awaitable]:
+    # Connections belong to an event loop, the client is created again if it changes.
+    session: Optional[Tuple[asyncio.AbstractEventLoop, httpx.AsyncClient]] = None
+
+    async def send(alert: Alert) -> None:
+        nonlocal session
+        loop = asyncio.get_running_loop()
+        if session is None or session[0] is not loop:
+            session = (loop, httpx.AsyncClient(timeout=timeout))
+        response = await session[1].post(url, content=alert.json())
+        response.raise_for_status()
+    return send
+
+
+class Notifier:
+    """
+    Evaluate the ``rules`` on the rolling statistics after each finished test and send
+    the alerts to every sink. An alert is not sent again for the same rule, hub and step
+    during ``cooldown`` seconds, and at most ``queue_size`` alerts wait to be delivered:
+    the ones beyond are dropped so an alert storm cannot overload the extension.
+    """
+
+    def __init__(
+        self,
+        rules: List,
+        sinks: List[Callable[[Alert], Awaitable]],
+        window: int,
+        cooldown: float,
+        queue_size: int,
+    ):
+        self.rules = rules
+        self.sinks = sinks
+        self.rolling = RollingStats(window)
+        self.cooldown = cooldown
+        self.queue_size = queue_size
+        self.queue: Optional[asyncio.Queue] = None
+        self.task: Optional[asyncio.Task] = None
+        self.sent = 0
+        self.suppressed = 0
+        self.dropped = 0
+        self.failed = 0
+        self._last_sent: Dict[Tuple, float] = {}
+        self._loop = None
+
+    def observe(self, test: TstInstance) -> List[Alert]:
+        """Account for the finished ``test`` and queue the alerts it fires."""
+        self.rolling.update(test)
+        alerts = []
+        now = time.monotonic()
+        for rule in self.rules:
+            for alert in rule.evaluate(self.rolling, test):
+                last_sent = self._last_sent.get(alert.key)
+                if last_sent is not None and now - last_sent < self.cooldown:
+                    self.suppressed += 1
+                    continue
+                self._last_sent[alert.key] = now
+                alerts.append(alert)
+        for alert in alerts:
+            self._enqueue(alert)
+        return alerts
+
+    def _enqueue(self, alert: Alert) -> None:
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self.queue = asyncio.Queue(self.queue_size)
+            self.task = loop.create_task(self._deliver(), name='alerts')
+        try:
+            self.queue.put_nowait(alert)
+        except asyncio.QueueFull:
+            self.dropped += 1
+
+    async def _deliver(self) -> None:
+        while True:
+            alert = await self.queue.get()
+            for sink in self.sinks:
+                try:
+                    await sink(alert)
+                    self.sent += 1
+                except Exception as e:
+                    self.failed += 1
+                    logger.warning(f'Alert {alert.rule} could not be sent: {e}')
+            self.queue.task_done()
+
+    async def join(self) -> None:
+        """Wait until the queued alerts have been delivered."""
+        if self.queue is not None:
+            await self.queue.join()
+
+    def stats(self) -> Dict:
+        return {
+            'sent': self.sent,
+            'suppressed': self.suppressed,
+            'dropped': self.dropped,
+            'failed': self.failed,
+            'queued': self.queue.qsize() if self.queue else 0,
+        }
+
+
+_notifier: Optional[Notifier] = None
+
+
+def get_notifier() -> Notifier:
+    global _notifier
+    if _notifier is None:
+        settings = get_settings()
+        rules = []
+        if settings.alert_consecutive_failures:
+            rules.append(ConsecutiveFailuresRule(settings.alert_consecutive_failures))
+        if settings.alert_step_latency_seconds:
+            rules.append(
+                StepLatencyRule(
+                    settings.alert_step_latency_seconds,
+                    settings.alert_latency_percentile,
+                    settings.alert_min_samples,
+                ),
+            )
+        sinks = [log_alert]
+        if settings.alert_webhook_url:
+            sinks.append(webhook_sink(settings.alert_webhook_url, settings.alert_webhook_timeout))
+        _notifier = Notifier(
+            rules,
+            sinks,
+            settings.alert_window,
+            settings.alert_cooldown_seconds,
+            settings.alert_queue_size,
+        )
+    return _notifier
+
+
+async def notify_finished(db, test_id: int, test: TstInstance = None) -> None:
+    """
+    Evaluate the alert rules once the test ``test_id`` is finished. Alerting never
+    fails the caller.
+    """
+    notifier = get_notifier()
+    if not notifier.rules:
+        return
+    try:
+        notifier.observe(test or await db.get_test(test_id))
+    except Exception:
+        logger.exception(f'Alert rules could not be evaluated for test {test_id}')
+
+
+def reset() -> None:
+    global _notifier
+    _notifier = None
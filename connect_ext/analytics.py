@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2022, CloudBlue
+# All rights reserved.
+#
+"""
+Step timing and success rate statistics per hub, computed with NumPy.
+
+    python -m connect_ext.analytics --database data.db --hub HB-123 --k 3
+"""
+import argparse
+import json
+import math
+from datetime import datetime, timezone
+from typing import Dict, List, Sequence
+
+from connect_ext.db import DB
+
+
+try:
+    import numpy
+except ImportError:  # pragma: no cover
+    numpy = None
+
+
+PERCENTILES = (50, 90, 99)
+STEP_DTYPE = [
+    ('test_id', 'i8'),
+    ('hub_id', 'O'),
+    ('name', 'O'),
+    ('created_at', 'f8'),
+    ('checked_at', 'f8'),
+]
+RESULT_DTYPE = [
+    ('hub_id', 'O'),
+    ('created_at', 'f8'),
+    ('success', 'f8'),
+]
+
+
+class AnalyticsUnavailableError(Exception):
+    pass
+
+
+def check_numpy() -> None:
+    if numpy is None:
+        raise AnalyticsUnavailableError('The analytics report needs numpy to be installed.')
+
+
+def _float(value) -> float:
+    value = float(value)
+    return None if math.isnan(value) else value
+
+
+def _timestamp(value: float) -> str:
+    return datetime.fromtimestamp(value, timezone.utc).replace(tzinfo=None).isoformat()
+
+
+def grouped_percentiles(groups, values, count: int, percentiles: Sequence[float]):
+    """
+    Return the ``percentiles`` of ``values`` for each of the ``count`` groups, as a
+    ``(count, len(percentiles))`` array, interpolating linearly like numpy.percentile.
+    NaN values are ignored, groups without values get NaN.
+    """
+    valid = ~numpy.isnan(values)
+    groups, values = groups[valid], values[valid]
+    order = numpy.lexsort((values, groups))
+    values = values[order]
+    sizes = numpy.bincount(groups, minlength=count)
+    starts = numpy.cumsum(sizes) - sizes
+    result = numpy.full((count, len(percentiles)), numpy.nan)
+    filled = sizes > 0
+    for index, percentile in enumerate(percentiles):
+        position = starts[filled] + (sizes[filled] - 1) * percentile / 100
+        low = numpy.floor(position).astype(int)
+        high = numpy.ceil(position).astype(int)
+        result[filled, index] = values[low] + (values[high] - values[low]) * (position - low)
+    return result
+
+
+def _key(*keys):
+    combined = keys[0].astype(str)
+    for key in keys[1:]:
+        combined = numpy.char.add(numpy.char.add(combined, '\x00'), key.astype(str))
+    return combined
+
+
+def _group(*keys):
+    """
+    Return the first element of each distinct combination of ``keys`` and the group
+    of every element.
+    """
+    _, first, groups = numpy.unique(_key(*keys), return_index=True, return_inverse=True)
+    return first, groups.ravel()
+
+
+def step_statistics(steps, k: float) -> Dict:
+    """Duration percentiles per hub and step, and steps slower than ``k`` times their median."""
+    checked = numpy.where(steps['checked_at'] < 0, numpy.nan, steps['checked_at'])
+    durations = checked - steps['created_at']
+    first, groups = _group(steps['hub_id'], steps['name'])
+    stats = grouped_percentiles(groups, durations, len(first), PERCENTILES)
+    totals = numpy.bincount(groups, minlength=len(first))
+    done = numpy.bincount(groups, weights=~numpy.isnan(durations), minlength=len(first))
+
+    medians = stats[groups, 0]
+    with numpy.errstate(invalid='ignore'):
+        slow = numpy.flatnonzero(durations > k * medians)
+    return {
+        'steps': [
+            {
+                'hub_id': steps['hub_id'][row],
+                'step': steps['name'][row],
+                'count': int(totals[index]),
+                'checked': int(done[index]),
+                **{f'p{p}': _float(stats[index, i]) for i, p in enumerate(PERCENTILES)},
+            }
+            for index, row in enumerate(first)
+        ],
+        'anomalies': [
+            {
+                'test_id': int(steps['test_id'][row]),
+                'hub_id': steps['hub_id'][row],
+                'step': steps['name'][row],
+                'created_at': _timestamp(steps['created_at'][row]),
+                'duration': _float(durations[row]),
+                'median': _float(medians[row]),
+            }
+            for row in slow
+        ],
+    }
+
+
+def _trailing_windows(hub_ids, buckets, window: int):
+    """
+    Return the elements of the trailing windows of ``window`` buckets that end at each
+    bucket where their hub has data: the index of each element of a window, repeated
+    for every window it belongs to, and the bucket the window ends at.
+    """
+    rows = numpy.repeat(numpy.arange(len(buckets)), window)
+    ends = buckets[rows] + numpy.tile(numpy.arange(window), len(buckets))
+    keep = numpy.isin(_key(hub_ids[rows], ends), _key(hub_ids, buckets))
+    return rows[keep], ends[keep]
+
+
+def duration_series(steps, bucket: float, window: int = 1) -> List[Dict]:
+    """
+    Rolling step duration percentiles per hub, over the ``window`` buckets of ``bucket``
+    seconds up to each bucket.
+    """
+    checked = numpy.where(steps['checked_at'] < 0, numpy.nan, steps['checked_at'])
+    durations = checked - steps['created_at']
+    buckets = numpy.floor(steps['created_at'] / bucket).astype('i8')
+    rows, ends = _trailing_windows(steps['hub_id'], buckets, window)
+    first, groups = _group(steps['hub_id'][rows], ends)
+    stats = grouped_percentiles(groups, durations[rows], len(first), PERCENTILES)
+    return [
+        {
+            'hub_id': steps['hub_id'][rows[row]],
+            'bucket_start': _timestamp(ends[row] * bucket),
+            'window_start': _timestamp((ends[row] - window + 1) * bucket),
+            **{f'p{p}': _float(stats[index, i]) for i, p in enumerate(PERCENTILES)},
+        }
+        for index, row in enumerate(first)
+    ]
+
+
+def success_series(results, bucket: float, window: int = 1) -> List[Dict]:
+    """
+    Rolling amount of finished tests and success rate per hub, over the ``window``
+    buckets of ``bucket`` seconds up to each bucket.
+    """
+    buckets = numpy.floor(results['created_at'] / bucket).astype('i8')
+    rows, ends = _trailing_windows(results['hub_id'], buckets, window)
+    first, groups = _group(results['hub_id'][rows], ends)
+    tests = numpy.bincount(groups, minlength=len(first))
+    successes = numpy.bincount(groups, weights=results['success'][rows], minlength=len(first))
+    return [
+        {
+            'hub_id': results['hub_id'][rows[row]],
+            'bucket_start': _timestamp(ends[row] * bucket),
+            'window_start': _timestamp((ends[row] - window + 1) * bucket),
+            'tests': int(tests[index]),
+            'success_rate': _float(successes[index] / tests[index]),
+        }
+        for index, row in enumerate(first)
+    ]
+
+
+def build_report(
+    db: DB,
+    since: datetime = None,
+    until: datetime = None,
+    hub_id: str = None,
+    k: float = 3.0,
+    bucket_hours: float = 24.0,
+    window_buckets: int = 7,
+) -> Dict:
+    """Load the step timings and test results in bulk and compute the report. Blocking."""
+    check_numpy()
+    filters = {'since': since, 'until': until, 'hub_id': hub_id}
+    steps = numpy.array(db.fetch_step_timings(**filters), dtype=STEP_DTYPE)
+    results = numpy.array(db.fetch_test_results(**filters), dtype=RESULT_DTYPE)
+    bucket = bucket_hours * 3600
+    return {
+        **step_statistics(steps, k),
+        'durations': duration_series(steps, bucket, window_buckets),
+        'success_rate': success_series(results, bucket, window_buckets),
+    }
+
+
+def main(argv: List[str] = None) -> None:
+    parser = argparse.ArgumentParser(description='Report step timings and success rates.')
+    parser.add_argument('--database', default='data.db')
+    parser.add_argument('--since', type=datetime.fromisoformat)
+    parser.add_argument('--until', type=datetime.fromisoformat)
+    parser.add_argument('--hub')
+    parser.add_argument('--k', type=float, default=3.0)
+    parser.add_argument('--bucket-hours', type=float, default=24.0)
+    parser.add_argument('--window-buckets', type=int, default=7)
+    args = parser.parse_args(argv)
+    try:
+        report = build_report(
+            DB(args.database),
+            since=args.since,
+            until=args.until,
+            hub_id=args.hub,
+            k=args.k,
+            bucket_hours=args.bucket_hours,
+            window_buckets=args.window_buckets,
+        )
+    except AnalyticsUnavailableError as e:
+        parser.error(str(e))
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':  # pragma: no cover
+    main()
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2022, CloudBlue
+# All rights reserved.
+#
+import asyncio
+from typing import Dict, Optional
+
+from connect_ext.settings import get_settings
+
+
+class ConcurrencyGate:
+    """
+    Let at most ``limit`` events be handled at once and ``queue_size`` more wait for
+    a slot. Events arriving beyond are refused so the caller can hand them back to
+    the runtime for later delivery, keeping memory and upstream load flat.
+    """
+
+    def __init__(self, limit: int, queue_size: int):
+        self.limit = limit
+        self.queue_size = queue_size
+        self.active = 0
+        self.waiting = 0
+        self.max_waiting = 0
+        self.admitted = 0
+        self.rejected = 0
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._loop = None
+
+    async def acquire(self) -> bool:
+        """Wait for a slot, return ``False`` right away if the queue is full."""
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            # Slots taken on a previous event loop are gone with it.
+            self._loop = loop
+            self._semaphore = asyncio.Semaphore(self.limit)
+            self.active = self.waiting = 0
+        if self.active >= self.limit and self.waiting >= self.queue_size:
+            self.rejected += 1
+            return False
+        self.waiting += 1
+        self.max_waiting = max(self.max_waiting, self.waiting)
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        self.active += 1
+        self.admitted += 1
+        return True
+
+    def release(self) -> None:
+        self.active -= 1
+        self._semaphore.release()
+
+    def stats(self) -> Dict:
+        return {
+            'limit': self.limit,
+            'active': self.active,
+            'queue_depth': self.waiting,
+            'max_queue_depth': self.max_waiting,
+            'admitted': self.admitted,
+            'rejected': self.rejected,
+        }
+
+
+_gates: Dict[str, ConcurrencyGate] = {}
+
+
+def get_event_gate(event_type: str) -> ConcurrencyGate:
+    gate = _gates.get(event_type)
+    if gate is None:
+        settings = get_settings()
+        gate = _gates[event_type] = ConcurrencyGate(
+            settings.event_concurrency,
+            settings.event_queue_size,
+        )
+    return gate
+
+
+def get_event_gate_stats() -> Dict:
+    return {event_type: gate.stats() for event_type, gate in sorted(_gates.items())}
+
+
+def reset() -> None:
+    _gates.clear()
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2022, CloudBlue
+# All rights reserved.
+#
+import asyncio
+import importlib.util
+import logging
+from typing import Dict, List, Tuple
+
+import httpx
+from fastapi import Depends
+from connect.client import AsyncConnectClient
+from connect.eaas.core.inject.asynchronous import get_extension_client
+
+from connect_ext.deadline import bounded
+from connect_ext.health import get_outbound_errors
+from connect_ext.instrumentation import measure
+from connect_ext.settings import get_settings
+from connect_ext.throttling import get_rate_limiter
+
+
+_sessions: Dict[str, Tuple[asyncio.AbstractEventLoop, httpx.AsyncClient]] = {}
+
+
+def _create_session() -> httpx.AsyncClient:
+    settings = get_settings()
+    http2 = settings.http2
+    if http2 and importlib.util.find_spec('h2') is None:
+        logging.getLogger('connect_ext').warning('HTTP/2 disabled, h2 is not installed.')
+        http2 = False
+    return httpx.AsyncClient(
+        limits=httpx.Limits(
+            max_connections=settings.http_max_connections,
+            max_keepalive_connections=settings.http_max_keepalive_connections,
+            keepalive_expiry=settings.http_keepalive_expiry,
+        ),
+        http2=http2,
+    )
+
+
+def get_http_session(endpoint: str) -> httpx.AsyncClient:
+    """
+    Return the HTTP client shared by every Connect client of ``endpoint``, so
+    connections are kept alive and reused across routes and event handlers.
+    Connections belong to an event loop, a new pool is created if the loop changes.
+    """
+    loop = asyncio.get_running_loop()
+    session = _sessions.get(endpoint)
+    if session is None or session[0] is not loop:
+        session = _sessions[endpoint] = (loop, _create_session())
+    return session[1]
+
+
+class ThrottledAsyncConnectClient(AsyncConnectClient):
+    """
+    AsyncConnectClient whose every HTTP call goes through the shared rate limiter
+    and the shared connection pool, and is cancelled at the deadline of the request.
+    """
+
+    @property
+    def session(self):
+        return get_http_session(self.endpoint)
+
+    async def execute(self, method: str, path: str, **kwargs):
+        # Under a deadline the call runs in its own task, the response it sets in the
+        # context of that task is copied back for the callers reading client.response.
+        responses = []
+        failed = True
+        with measure('outbound'):
+            try:
+                result = await bounded(
+                    self._execute(responses, method, path, **kwargs),
+                    f'{method} {path}',
+                )
+                failed = False
+                return result
+            finally:
+                get_outbound_errors().add(failed)
+                if responses:
+                    self.response = responses[0]
+
+    async def _execute(self, responses: List, method: str, path: str, **kwargs):
+        try:
+            await get_rate_limiter().acquire(path)
+            return await super().execute(method, path, **kwargs)
+        finally:
+            responses.append(self.response)
+
+
+def wrap_client(client: AsyncConnectClient) -> ThrottledAsyncConnectClient:
+    if isinstance(client, ThrottledAsyncConnectClient):
+        return client
+    # Retries are handled by connect_ext.resilience without blocking the event loop,
+    # the built-in ones of the client sleep synchronously between attempts.
+    return ThrottledAsyncConnectClient(
+        client.api_key,
+        endpoint=client.endpoint,
+        default_headers=client.default_headers,
+        default_limit=client.default_limit,
+        max_retries=0,
+        logger=client.logger,
+        timeout=client.timeout,
+    )
+
+
+def get_client(client: AsyncConnectClient = Depends(get_extension_client)):
+    return wrap_client(client)
+
+
+def reset() -> None:
+    _sessions.clear()
@@ -4,21 +4,126 @@
 # All rights reserved.
 #
 import asyncio
+import functools
+import json
+import logging
+import os
+import socket
 import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
 from datetime import datetime, timedelta
-from typing import List, Tuple
+from typing import Any, Callable, Dict, Iterator, List, Optional, Set, Tuple
 
-from connect_ext.models import ResultType, Step, TstInstance
+from connect_ext.alerts import notify_finished
+from connect_ext.deadline import check_deadline, DeadlineExceeded, get_deadline
+from connect_ext.due import DueSteps
+from connect_ext.health import HealthCounters
+from connect_ext.instrumentation import measure
+from connect_ext.models import DEFAULT_SCENARIO, ResultType, SetupStatus, Step, TstInstance
+from connect_ext.settings import get_settings
+from connect_ext.sla import get_sla_seconds
 
 
-DO_NOT_CHECK_AFTER_SECONDS = 120
+# Unix timestamp of a stored datetime.
+_EPOCH = '(julianday({})-2440587.5)*86400.0'
+
+
+class GroupCommitWriter:
+    """
+    Queue writes and commit them together, every ``interval`` seconds or as soon as
+    ``max_ops`` writes are waiting, so a burst of writes pays a single commit.
+    """
+
+    def __init__(self, db: 'DB', interval: float, max_ops: int):
+        self.db = db
+        self.interval = interval
+        self.max_ops = max_ops
+        self.queue: List[Tuple[Callable, Tuple, asyncio.Future]] = []
+        self._task = None
+        self._wakeup = None
+
+    async def submit(self, operation: Callable, *args) -> Any:
+        """Queue ``operation`` and return its result once the batch has been committed."""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.queue.append((operation, args, future))
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._task = loop.create_task(self._run())
+        if len(self.queue) >= self.max_ops:
+            self._wakeup.set()
+        return await future
+
+    async def _run(self) -> None:
+        while self.queue:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            batch, self.queue = self.queue[:self.max_ops], self.queue[self.max_ops:]
+            results = await asyncio.get_running_loop().run_in_executor(
+                None,
+                self.db._execute_batch,
+                [(operation, args) for operation, args, _ in batch],
+            )
+            for (_, _, future), (result, error) in zip(batch, results):
+                if future.done():
+                    # The submitter was cancelled, its write is committed regardless.
+                    continue
+                if error:
+                    future.set_exception(error)
+                else:
+                    future.set_result(result)
 
 
 class DB:
 
-    def __init__(self, database: str = 'data.db'):
-        self.connection = sqlite3.connect(database, check_same_thread=False)
-        cur = self.connection.cursor()
+    def __init__(self, database: str = 'data.db', group_commit: bool = False, timeout: float = 5.0):
+        # Transactions are opened explicitly by _transaction(), several processes may
+        # share the file and wait up to ``timeout`` seconds for each other's writes.
+        self.connection = sqlite3.connect(
+            database,
+            timeout=timeout,
+            isolation_level=None,
+            check_same_thread=False,
+        )
+        # Owner of the leases taken by this process.
+        self.owner = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+        # The connection is shared by the executor threads, a transaction must not be
+        # committed or rolled back by a statement run from another thread.
+        self._lock = threading.RLock()
+        # Deadline of the call running in each executor thread, statements still
+        # running past it are interrupted and their transaction rolled back.
+        self._local = threading.local()
+        # Changes of the in-memory state applied once the running transaction commits.
+        self._on_commit: List[Callable[[], None]] = []
+        # Tests whose abandoned setup was failed, to be notified to the alert rules.
+        self._abandoned: List[int] = []
+        self.connection.set_progress_handler(self._deadline_reached, 1000)
+        # Unchecked steps of the running tests by SLA deadline, loaded on first use.
+        self.due = DueSteps()
+        self.health = HealthCounters(get_settings().health_window)
+        self.writer = None
+        if group_commit:
+            settings = get_settings()
+            self.writer = GroupCommitWriter(
+                self,
+                settings.db_group_commit_interval,
+                settings.db_group_commit_max_ops,
+            )
+        # Only effective on a new database, existing ones are converted by vacuum().
+        self.connection.execute('PRAGMA auto_vacuum=INCREMENTAL')
+        # Readers of other processes do not block the writer and the other way round.
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        # Processes starting together must not both migrate the schema.
+        with self._transaction(immediate=True) as c:
+            self._create_schema(c.cursor())
+
+    def _create_schema(self, cur) -> None:
         cur.execute(
             "CREATE TABLE IF NOT EXISTS test("
             "id INTEGER PRIMARY KEY AUTOINCREMENT, "
@@ -26,7 +131,21 @@ class DB:
             "result VARCHAR(255), "
             "object_id VARCHAR(255), "
             "done_at DATETIME, "
-            "created_at DATETIME)",
+            "created_at DATETIME, "
+            "scenario VARCHAR(255), "
+            "steps_expected INTEGER, "
+            "steps_added INTEGER DEFAULT 0, "
+            "steps_checked INTEGER DEFAULT 0, "
+            "last_step VARCHAR(255), "
+            "total_duration REAL, "
+            "hub_id VARCHAR(255), "
+            "product_id VARCHAR(255), "
+            "account_id VARCHAR(255), "
+            "connection_id VARCHAR(255), "
+            "setup_status VARCHAR(255), "
+            "setup_error TEXT, "
+            "sla_breaches INTEGER DEFAULT 0, "
+            "dimensions_checked_at DATETIME)",
         )
         cur.execute(
             "CREATE TABLE IF NOT EXISTS step("
@@ -35,185 +154,912 @@ class DB:
             "object_id VARCHAR(255), "
             "created_at DATETIME, "
             "checked BOOLEAN, "
-            "checked_at DATETIME)",
+            "checked_at DATETIME, "
+            "sla_seconds REAL, "
+            "sla_met BOOLEAN, "
+            "sla_margin REAL, "
+            "position INTEGER)",
+        )
+        added = self._add_missing_columns(
+            cur,
+            'test',
+            {
+                'scenario': 'VARCHAR(255)',
+                'steps_expected': 'INTEGER',
+                'steps_added': 'INTEGER DEFAULT 0',
+                'steps_checked': 'INTEGER DEFAULT 0',
+                'last_step': 'VARCHAR(255)',
+                'total_duration': 'REAL',
+                'hub_id': 'VARCHAR(255)',
+                'product_id': 'VARCHAR(255)',
+                'account_id': 'VARCHAR(255)',
+                'connection_id': 'VARCHAR(255)',
+                'setup_status': 'VARCHAR(255)',
+                'setup_error': 'TEXT',
+                'sla_breaches': 'INTEGER DEFAULT 0',
+                'dimensions_checked_at': 'DATETIME',
+            },
+        )
+        added_to_step = self._add_missing_columns(
+            cur,
+            'step',
+            {
+                'sla_seconds': 'REAL',
+                'sla_met': 'BOOLEAN',
+                'sla_margin': 'REAL',
+                'position': 'INTEGER',
+            },
+        )
+        if 'position' in added_to_step:
+            cur.execute(
+                'UPDATE step SET position=('
+                'SELECT COUNT(*) FROM step AS previous '
+                'WHERE previous.test_id=step.test_id AND previous.rowid<step.rowid)',
+            )
+        if 'steps_checked' in added:
+            cur.execute(
+                'UPDATE test SET steps_checked=('
+                'SELECT COUNT(*) FROM step WHERE step.test_id=test.id AND checked IS True)',
+            )
+        if 'steps_expected' in added:
+            cur.execute(
+                'UPDATE test SET '
+                'steps_expected=?, '
+                'steps_added=(SELECT COUNT(*) FROM step WHERE step.test_id=test.id), '
+                'last_step=('
+                'SELECT name FROM step WHERE step.test_id=test.id '
+                'ORDER BY rowid DESC LIMIT 1), '
+                'total_duration=(julianday(done_at)-julianday(created_at))*86400',
+                (len(DEFAULT_SCENARIO),),
+            )
+        cur.execute('CREATE INDEX IF NOT EXISTS step_test_id ON step(test_id)')
+        cur.execute('CREATE UNIQUE INDEX IF NOT EXISTS step_position ON step(test_id, position)')
+        cur.execute('CREATE INDEX IF NOT EXISTS test_object_id ON test(object_id)')
+        cur.execute('CREATE INDEX IF NOT EXISTS test_hub_id ON test(hub_id, created_at)')
+        cur.execute('CREATE INDEX IF NOT EXISTS test_product_id ON test(product_id)')
+        cur.execute('CREATE INDEX IF NOT EXISTS test_hub_done_at ON test(hub_id, done_at)')
+        cur.execute(
+            "CREATE TABLE IF NOT EXISTS test_archive("
+            "id INTEGER PRIMARY KEY, "
+            "result VARCHAR(255), "
+            "object_id VARCHAR(255), "
+            "scenario VARCHAR(255), "
+            "done_at DATETIME, "
+            "created_at DATETIME, "
+            "archived_at DATETIME, "
+            "steps TEXT)",
+        )
+        cur.execute(
+            "CREATE TABLE IF NOT EXISTS job("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "test_id INTEGER, "
+            "step VARCHAR(255), "
+            "payload TEXT, "
+            "status VARCHAR(255), "
+            "attempts INTEGER DEFAULT 0, "
+            "available_at DATETIME, "
+            "last_error TEXT, "
+            "created_at DATETIME, "
+            "done_at DATETIME, "
+            "position INTEGER)",
         )
-        cur.close()
+        self._add_missing_columns(cur, 'job', {'position': 'INTEGER'})
+        cur.execute('CREATE INDEX IF NOT EXISTS job_status ON job(status, available_at)')
+        cur.execute(
+            "CREATE TABLE IF NOT EXISTS lease("
+            "name VARCHAR(255) PRIMARY KEY, "
+            "owner VARCHAR(255), "
+            "expires_at DATETIME)",
+        )
+        try:
+            # A single test runs at a time, whichever process starts it.
+            cur.execute(
+                'CREATE UNIQUE INDEX IF NOT EXISTS test_running ON test(running) '
+                'WHERE running IS True',
+            )
+        except sqlite3.IntegrityError:
+            logging.getLogger('connect_ext').warning(
+                'Several tests are running, only one test can be started at a time '
+                'once they are finished.',
+            )
+
+    async def _run(self, func: Callable, *args) -> Any:
+        with measure('db'):
+            deadline_at = get_deadline()
+            if deadline_at is not None:
+                check_deadline(func.__name__)
+                func = functools.partial(self._run_until, deadline_at, func)
+            self.health.db_pending += 1
+            started = time.perf_counter()
+            try:
+                return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+            finally:
+                self.health.db_pending -= 1
+                self.health.observe_db(time.perf_counter() - started)
+
+    def _run_until(self, deadline_at: float, func: Callable, *args) -> Any:
+        self._local.deadline = deadline_at
+        try:
+            return func(*args)
+        except sqlite3.OperationalError as e:
+            if time.monotonic() >= deadline_at:
+                raise DeadlineExceeded(func.__name__) from e
+            raise
+        finally:
+            self._local.deadline = None
+
+    def _deadline_reached(self) -> bool:
+        deadline_at = getattr(self._local, 'deadline', None)
+        return deadline_at is not None and time.monotonic() >= deadline_at
+
+    @contextmanager
+    def _transaction(self, immediate: bool = False):
+        """
+        Run the block in a transaction, or in the transaction of the caller if it is
+        nested. ``immediate`` takes the write lock of the file upfront, so the rows read
+        by the block cannot be changed by another process before it writes.
+        """
+        with self._lock:
+            if self.connection.in_transaction:
+                yield self.connection
+                return
+            self.connection.execute('BEGIN IMMEDIATE' if immediate else 'BEGIN')
+            self._on_commit = []
+            try:
+                yield self.connection
+                self.connection.commit()
+            except BaseException:
+                self.connection.rollback()
+                raise
+            finally:
+                callbacks, self._on_commit = self._on_commit, []
+            for callback in callbacks:
+                callback()
+
+    def _after_commit(self, callback: Callable[[], None]) -> None:
+        """Call ``callback`` once the outermost transaction is committed, if it is."""
+        if self.connection.in_transaction:
+            self._on_commit.append(callback)
+        else:
+            callback()
+
+    def _execute_batch(self, operations: List[Tuple[Callable, Tuple]]) -> List[Tuple]:
+        try:
+            with self._transaction(immediate=True) as c:
+                return [(operation(c, *args), None) for operation, args in operations]
+        except Exception:
+            pass
+        # Replay the batch one write per transaction to only fail the faulty writes.
+        results = []
+        for operation, args in operations:
+            try:
+                with self._transaction(immediate=True) as c:
+                    results.append((operation(c, *args), None))
+            except Exception as error:
+                results.append((None, error))
+        return results
+
+    @staticmethod
+    def _add_missing_columns(cur, table: str, columns: Dict[str, str]) -> Set[str]:
+        existing = {row[1] for row in cur.execute(f'PRAGMA table_info({table})')}
+        added = set()
+        for name, definition in columns.items():
+            if name not in existing:
+                cur.execute(f'ALTER TABLE {table} ADD COLUMN {name} {definition}')
+                added.add(name)
+        return added
 
     async def is_idle(self) -> None:
-        return await asyncio.get_running_loop().run_in_executor(None, self._is_idle)
+        return await self._run(self._is_idle)
 
     async def get_steps_to_check(self, test_id: int) -> List[Tuple]:
-        return await asyncio.get_running_loop().run_in_executor(
-            None,
+        return await self._run(
             self._get_steps_to_check,
             test_id,
         )
 
     async def get_step_count(self, test_id: int) -> int:
-        return await asyncio.get_running_loop().run_in_executor(
-            None,
+        return await self._run(
             self._get_step_count,
             test_id,
         )
 
-    async def check_step(self, test_id: int, name: str, object_id: str = None) -> None:
-        return await asyncio.get_running_loop().run_in_executor(
-            None,
+    async def check_step(self, test_id: int, name: str, object_id: str = None) -> Optional[int]:
+        if self.writer:
+            check_deadline('check_step')
+            with measure('db'):
+                return await self.writer.submit(self._write_check_step, test_id, name, object_id)
+        return await self._run(
             self._check_step,
             test_id,
             name,
             object_id,
         )
 
-    async def add_new_step(self, asset_id: str, name: str, request_id: str = None) -> None:
-        return await asyncio.get_running_loop().run_in_executor(
-            None,
+    async def add_new_step(
+        self,
+        asset_id: str,
+        name: str,
+        request_id: str = None,
+        position: int = None,
+    ) -> None:
+        """
+        Add the step ``name`` to the test of ``asset_id`` at ``position``, after the
+        steps already added by default. Nothing is added if the position is taken.
+        """
+        if self.writer:
+            check_deadline('add_new_step')
+            with measure('db'):
+                return await self.writer.submit(
+                    self._write_add_new_step,
+                    asset_id,
+                    name,
+                    request_id,
+                    position,
+                )
+        return await self._run(
             self._add_new_step,
             asset_id,
             name,
             request_id,
+            position,
         )
 
+    async def get_step_object_ids(self, asset_id: str) -> List[str]:
+        return await self._run(self._get_step_object_ids, asset_id)
+
+    async def get_tests_summary(self) -> Dict:
+        """
+        Return the amount of running tests and the last result of each hub, whichever
+        process wrote them. The summary is read again once ``health_cache_seconds``
+        have passed.
+        """
+        summary = self.health.cached_tests(get_settings().health_cache_seconds)
+        if summary is None:
+            summary = await self._run(self._get_tests_summary)
+            self.health.cache_tests(summary)
+        return summary
+
     async def is_running_a_test(self) -> bool:
-        return await asyncio.get_running_loop().run_in_executor(None, self._is_running_a_test)
+        return await self._run(self._is_running_a_test)
 
-    async def create_new_test(self, object_id: str) -> TstInstance:
-        return await asyncio.get_running_loop().run_in_executor(
-            None,
+    async def create_new_test(
+        self,
+        object_id: str,
+        scenario: List[str] = None,
+        hub_id: str = None,
+        product_id: str = None,
+        account_id: str = None,
+        connection_id: str = None,
+    ) -> TstInstance:
+        test = await self._run(
             self._create_new_test,
             object_id,
+            scenario,
+            hub_id,
+            product_id,
+            account_id,
+            connection_id,
         )
+        abandoned, self._abandoned = self._abandoned, []
+        for test_id in abandoned:
+            await notify_finished(self, test_id)
+        return test
 
-    async def list_tests(self) -> List[TstInstance]:
-        return await asyncio.get_running_loop().run_in_executor(None, self._list_tests)
+    async def bind_test_object(
+        self,
+        test_id: int,
+        object_id: str,
+        account_id: str = None,
+        connection_id: str = None,
+    ) -> None:
+        return await self._run(
+            self._bind_test_object,
+            test_id,
+            object_id,
+            account_id,
+            connection_id,
+        )
+
+    async def finish_setup(self, test_id: int, error: str = None) -> None:
+        return await self._run(
+            self._finish_setup,
+            test_id,
+            error,
+        )
+
+    async def list_tests(self, include_steps: bool = True) -> List[TstInstance]:
+        return await self._run(
+            self._list_tests,
+            include_steps,
+        )
 
     async def get_test(self, test_id: int) -> TstInstance:
-        return await asyncio.get_running_loop().run_in_executor(None, self._get_test, test_id)
+        return await self._run(self._get_test, test_id)
 
     async def get_test_id_from_object_id(self, object_id: str) -> int:
-        return await asyncio.get_running_loop().run_in_executor(
-            None,
+        return await self._run(
             self._get_test_id_from_object_id,
             object_id,
         )
 
-    async def set_test_result(self, test_id, result: str = ResultType.success.value) -> None:
-        return await asyncio.get_running_loop().run_in_executor(
-            None,
+    async def get_test_scenario(self, object_id: str) -> Tuple[Optional[int], List[str]]:
+        return await self._run(
+            self._get_test_scenario,
+            object_id,
+        )
+
+    async def set_test_result(self, test_id, result: str = ResultType.success.value) -> bool:
+        return await self._run(
             self._set_test_result,
             test_id,
             result,
         )
 
+    async def finish_check(
+        self,
+        test_id: int,
+        steps: List[Tuple[str, str]],
+        result: str,
+        now: datetime,
+    ) -> bool:
+        """
+        Check the ``(name, object_id)`` steps and set the result of the test at ``now``
+        in the same transaction. False if the test was already finished.
+        """
+        return await self._run(
+            self._finish_check,
+            test_id,
+            steps,
+            result,
+            now,
+        )
+
+    async def check_step_and_enqueue(
+        self,
+        test_id: int,
+        name: str,
+        object_id: str,
+        next_job: Callable[[int], Optional[str]],
+        payload: Dict,
+    ) -> Optional[int]:
+        """
+        Check the step and, in the same transaction, queue the job returned by
+        ``next_job`` for the new amount of checked steps, if any.
+        """
+        if self.writer:
+            check_deadline('check_step_and_enqueue')
+            with measure('db'):
+                return await self.writer.submit(
+                    self._write_check_step_and_enqueue,
+                    test_id,
+                    name,
+                    object_id,
+                    next_job,
+                    payload,
+                )
+        return await self._run(
+            self._check_step_and_enqueue,
+            test_id,
+            name,
+            object_id,
+            next_job,
+            payload,
+        )
+
+    async def claim_job(self, lease: float) -> Optional[Tuple]:
+        return await self._run(self._claim_job, lease)
+
+    async def get_next_job_delay(self) -> Optional[float]:
+        return await self._run(self._get_next_job_delay)
+
+    async def complete_job(self, job_id: int, attempts: int) -> bool:
+        return await self._run(self._complete_job, job_id, attempts)
+
+    async def retry_job(self, job_id: int, attempts: int, error: str, delay: float) -> bool:
+        return await self._run(
+            self._retry_job,
+            job_id,
+            attempts,
+            error,
+            delay,
+        )
+
+    async def fail_job(self, job_id: int, attempts: int, error: str) -> bool:
+        return await self._run(
+            self._fail_job,
+            job_id,
+            attempts,
+            error,
+        )
+
     async def update_step_object_id(self, test_id: int, name: str, object_id: str) -> None:
-        return await asyncio.get_running_loop().run_in_executor(
-            None,
+        return await self._run(
             self._update_step_object_id,
             test_id,
             name,
             object_id,
         )
 
+    async def archive_tests(
+        self,
+        before: Optional[datetime],
+        keep: Optional[int],
+        limit: int,
+    ) -> List[Dict]:
+        return await self._run(
+            self._archive_tests,
+            before,
+            keep,
+            limit,
+        )
+
+    async def vacuum(self, pages: int) -> None:
+        return await self._run(self._vacuum, pages)
+
+    async def get_hub_stats(self, since: datetime = None, hub_id: str = None) -> List[Dict]:
+        return await self._run(
+            self._get_hub_stats,
+            since,
+            hub_id,
+        )
+
+    async def get_tests_without_dimensions(self, limit: int) -> List[Tuple[int, str]]:
+        return await self._run(
+            self._get_tests_without_dimensions,
+            limit,
+        )
+
+    async def set_test_dimensions(
+        self,
+        test_id: int,
+        hub_id: str,
+        product_id: str,
+        account_id: str,
+        connection_id: str,
+    ) -> None:
+        return await self._run(
+            self._set_test_dimensions,
+            test_id,
+            hub_id,
+            product_id,
+            account_id,
+            connection_id,
+        )
+
     def _is_idle(self) -> None:
-        with self.connection as c:
+        with self._transaction() as c:
             res = c.execute('SELECT COUNT(*) FROM test WHERE running is True')
             result = res.fetchone()
             return result[0] == 0
 
     def _get_steps_to_check(self, test_id: int) -> List[Tuple]:
-        with self.connection as c:
-            res = c.execute(
-                'SELECT object_id, created_at '
-                'FROM step '
-                'WHERE checked IS False '
-                'AND object_id IS NOT NULL '
-                'AND test_id=? '
-                'AND created_at < ?',
-                (test_id, datetime.now() - timedelta(seconds=DO_NOT_CHECK_AFTER_SECONDS)),
-            )
-            return res.fetchall()
+        test_id = int(test_id)
+        with self._transaction() as c:
+            self._load_new_steps(c)
+            rowids = self.due.overdue(test_id, datetime.now())
+            if not rowids:
+                return []
+            rows = c.execute(
+                'SELECT rowid, object_id, created_at, checked FROM step '
+                f'WHERE rowid IN ({",".join("?" * len(rowids))}) ORDER BY rowid',
+                rowids,
+            ).fetchall()
+            # Steps checked or deleted meanwhile, by this process or another one.
+            pending = {row[0] for row in rows if not row[3]}
+            self.due.discard(test_id, set(rowids) - pending)
+            return [
+                (object_id, created_at)
+                for rowid, object_id, created_at, _ in rows
+                if rowid in pending and object_id is not None
+            ]
+
+    def _load_new_steps(self, c) -> None:
+        """
+        Track the steps added since the last call and stop tracking the tests finished
+        meanwhile, whichever process wrote them.
+        """
+        last_rowid = c.execute('SELECT MAX(rowid) FROM step').fetchone()[0] or 0
+        if last_rowid < self.due.last_rowid:
+            # The last steps were deleted and their rowids can be reused, start over.
+            self.due.clear()
+        tracked = self.due.tests()
+        if tracked:
+            # Tests finished by another process.
+            running = {row[0] for row in c.execute('SELECT id FROM test WHERE running IS True')}
+            for test_id in tracked - running:
+                self.due.forget(test_id)
+        res = c.execute(
+            'SELECT step.rowid, step.test_id, step.created_at, '
+            'step.sla_seconds, test.hub_id, step.name FROM step '
+            'JOIN test ON test.id=step.test_id '
+            'WHERE step.rowid > ? AND step.rowid <= ? '
+            'AND step.checked IS False AND test.running IS True',
+            (self.due.last_rowid, last_rowid),
+        )
+        self.due.extend(
+            (
+                (
+                    rowid,
+                    test_id,
+                    created_at,
+                    get_sla_seconds(hub_id, name) if sla_seconds is None else sla_seconds,
+                )
+                for rowid, test_id, created_at, sla_seconds, hub_id, name in res.fetchall()
+            ),
+            last_rowid,
+        )
 
     def _get_step_count(self, test_id: int) -> int:
-        with self.connection as c:
-            res = c.execute(
-                'SELECT COUNT(*) '
-                'FROM step '
-                f'WHERE test_id={test_id} AND checked is True',
-            )
+        with self._transaction() as c:
+            res = c.execute('SELECT steps_checked FROM test WHERE id=?', (test_id,))
             result = res.fetchone()
             if result:
                 return result[0]
             return 0
 
-    def _check_step(self, test_id, name, object_id) -> None:
-        with self.connection as c:
-            sql = (
-                'UPDATE step '
-                'SET checked=?, checked_at=? '
-                'WHERE test_id=? AND checked is False AND name=?'
-            )
-            data = (True, datetime.now(), test_id, name)
-            if object_id:
-                sql += ' AND object_id=?'
-                data = data + (object_id,)
-            c.execute(
-                sql,
-                data,
+    def _check_step(self, test_id, name, object_id) -> Optional[int]:
+        with self._transaction() as c:
+            return self._write_check_step(c, test_id, name, object_id)
+
+    def _write_check_step(self, c, test_id, name, object_id, now=None) -> Optional[int]:
+        now = now or datetime.now()
+        duration = '(julianday(?)-julianday(created_at))*86400'
+        sql = (
+            'UPDATE step '
+            f'SET checked=?, checked_at=?, sla_met={duration}<=sla_seconds, '
+            f'sla_margin=sla_seconds-{duration} '
+            'WHERE test_id=? AND checked is False AND name=?'
+        )
+        data = (True, now, now, now, test_id, name)
+        if object_id:
+            sql += ' AND object_id=?'
+            data = data + (object_id,)
+        checked = c.execute(
+            sql,
+            data,
+        ).rowcount
+        if not checked:
+            return None
+        rowids = [
+            row[0] for row in c.execute(
+                'SELECT rowid FROM step WHERE test_id=? AND checked_at=?',
+                (test_id, now),
             )
+        ]
+        self._after_commit(functools.partial(self.due.discard, int(test_id), rowids))
+        c.execute(
+            'UPDATE test '
+            'SET steps_checked=steps_checked+?, '
+            'sla_breaches=COALESCE(sla_breaches, 0)+('
+            'SELECT COUNT(*) FROM step '
+            'WHERE step.test_id=test.id AND checked_at=? AND sla_met IS False), '
+            'total_duration=(julianday(?)-julianday(created_at))*86400 '
+            'WHERE id=?',
+            (checked, now, now, test_id),
+        )
+        res = c.execute('SELECT steps_checked FROM test WHERE id=?', (test_id,))
+        return res.fetchone()[0]
 
-    def _add_new_step(self, asset_id: str, name: str, request_id: str) -> None:
-        test_id = self._get_test_id_from_object_id(asset_id)
+    def _add_new_step(
+        self,
+        asset_id: str,
+        name: str,
+        request_id: str,
+        position: int = None,
+    ) -> None:
+        with self._transaction() as c:
+            self._write_add_new_step(c, asset_id, name, request_id, position)
+
+    def _write_add_new_step(
+        self,
+        c,
+        asset_id: str,
+        name: str,
+        request_id: str,
+        position: int = None,
+    ) -> None:
+        res = c.execute(
+            'SELECT id, hub_id, steps_added FROM test WHERE object_id=?',
+            (asset_id,),
+        ).fetchone()
+        test_id, hub_id, steps_added = res if res else (None, None, None)
         now = datetime.now()
-        data = (test_id, name, now, False, None)
+        # The threshold is kept with the step, later changes of the settings apply to
+        # the next steps only.
+        data = (
+            test_id,
+            name,
+            now,
+            False,
+            None,
+            get_sla_seconds(hub_id, name),
+            steps_added if position is None else position,
+        )
         sql = (
-            'INSERT INTO step(test_id,name,created_at,checked,checked_at) '
-            'VALUES(?,?,?,?,?)'
+            'INSERT OR IGNORE INTO step('
+            'test_id,name,created_at,checked,checked_at,sla_seconds,position) '
+            'VALUES(?,?,?,?,?,?,?)'
         )
         if request_id:
             sql = (
-                'INSERT INTO step(test_id,name,created_at,checked,checked_at,object_id) '
-                'VALUES(?,?,?,?,?,?)'
+                'INSERT OR IGNORE INTO step('
+                'test_id,name,created_at,checked,checked_at,sla_seconds,position,object_id) '
+                'VALUES(?,?,?,?,?,?,?,?)'
             )
             data = data + (request_id,)
-        with self.connection as c:
+        if not c.execute(
+            sql,
+            data,
+        ).rowcount:
+            # Added by a previous attempt of the job issuing the step.
+            return
+        c.execute(
+            'UPDATE test SET steps_added=steps_added+1, last_step=? WHERE id=?',
+            (name, test_id),
+        )
+
+    def _get_step_object_ids(self, asset_id: str) -> List[str]:
+        with self._transaction() as c:
+            return [
+                row[0] for row in c.execute(
+                    'SELECT step.object_id FROM step JOIN test ON test.id=step.test_id '
+                    'WHERE test.object_id=? AND step.object_id IS NOT NULL',
+                    (asset_id,),
+                )
+            ]
+
+    def _check_step_and_enqueue(self, test_id, name, object_id, next_job, payload):
+        with self._transaction() as c:
+            return self._write_check_step_and_enqueue(
+                c,
+                test_id,
+                name,
+                object_id,
+                next_job,
+                payload,
+            )
+
+    def _write_check_step_and_enqueue(
+        self,
+        c,
+        test_id: int,
+        name: str,
+        object_id: str,
+        next_job: Callable[[int], Optional[str]],
+        payload: Dict,
+    ) -> Optional[int]:
+        steps_checked = self._write_check_step(c, test_id, name, object_id)
+        job = next_job(steps_checked) if steps_checked else None
+        if job:
+            now = datetime.now()
+            # The step issued by the job follows the checked ones in the scenario.
             c.execute(
-                sql,
-                data,
+                'INSERT INTO job('
+                'test_id,step,payload,status,available_at,created_at,position) '
+                'VALUES(?,?,?,?,?,?,?)',
+                (test_id, job, json.dumps(payload), 'pending', now, now, steps_checked),
             )
+        return steps_checked
+
+    def _claim_job(self, lease: float) -> Optional[Tuple]:
+        """
+        Return ``(id, test_id, step, payload, attempts, position, created_at)`` of the
+        oldest job due, leased for ``lease`` seconds: it is run again if not completed
+        by then.
+        """
+        now = datetime.now()
+        with self._transaction(immediate=True) as c:
+            job = c.execute(
+                'SELECT id, test_id, step, payload, attempts + 1, position, created_at '
+                'FROM job '
+                "WHERE status IN ('pending', 'running') AND available_at <= ? "
+                'ORDER BY id LIMIT 1',
+                (now,),
+            ).fetchone()
+            if job:
+                c.execute(
+                    "UPDATE job SET status='running', attempts=?, available_at=? WHERE id=?",
+                    (job[4], now + timedelta(seconds=lease), job[0]),
+                )
+            return job
+
+    def _get_next_job_delay(self) -> Optional[float]:
+        # Jobs left running by a stopped process are picked up by the next wake up.
+        with self._transaction() as c:
+            available_at = c.execute(
+                "SELECT MIN(available_at) FROM job WHERE status='pending'",
+            ).fetchone()[0]
+        if available_at:
+            return max(
+                0.0,
+                (datetime.fromisoformat(available_at) - datetime.now()).total_seconds(),
+            )
+
+    # The outcome of a job is only stored by the attempt that claimed it last, a worker
+    # whose lease expired meanwhile does not overwrite the attempt that took over.
+    def _complete_job(self, job_id: int, attempts: int) -> bool:
+        with self._transaction() as c:
+            return c.execute(
+                "UPDATE job SET status='done', done_at=?, last_error=NULL "
+                'WHERE id=? AND attempts=?',
+                (datetime.now(), job_id, attempts),
+            ).rowcount == 1
+
+    def _retry_job(self, job_id: int, attempts: int, error: str, delay: float) -> bool:
+        with self._transaction() as c:
+            return c.execute(
+                "UPDATE job SET status='pending', last_error=?, available_at=? "
+                'WHERE id=? AND attempts=?',
+                (error, datetime.now() + timedelta(seconds=delay), job_id, attempts),
+            ).rowcount == 1
+
+    def _fail_job(self, job_id: int, attempts: int, error: str) -> bool:
+        now = datetime.now()
+        with self._transaction() as c:
+            if not c.execute(
+                "UPDATE job SET status='failed', last_error=?, done_at=? "
+                'WHERE id=? AND attempts=?',
+                (error, now, job_id, attempts),
+            ).rowcount:
+                return False
+            test_id = c.execute('SELECT test_id FROM job WHERE id=?', (job_id,)).fetchone()[0]
+            # The test cannot go on without the step this job had to issue.
+            c.execute(
+                'UPDATE test '
+                'SET result=?, done_at=?, running=?, '
+                'total_duration=(julianday(?)-julianday(created_at))*86400 '
+                'WHERE done_at IS NULL AND id=?',
+                (ResultType.failed.value, now, False, now, test_id),
+            )
+            self._after_commit(functools.partial(self.due.forget, test_id))
+            return True
 
     def _is_running_a_test(self) -> bool:
         return not self._is_idle()
 
-    def _create_new_test(self, object_id: str) -> TstInstance:
-        if self._is_idle():
-            with self.connection as c:
+    def _create_new_test(
+        self,
+        object_id: str,
+        scenario: List[str] = None,
+        hub_id: str = None,
+        product_id: str = None,
+        account_id: str = None,
+        connection_id: str = None,
+    ) -> TstInstance:
+        scenario = scenario or DEFAULT_SCENARIO
+        now = datetime.now()
+        try:
+            with self._transaction(immediate=True) as c:
+                self._fail_abandoned_setups(c, now)
+                if not self._is_idle():
+                    return None
+                test_id = c.execute(
+                    'INSERT INTO test('
+                    'running,result,object_id,done_at,created_at,scenario,steps_expected,'
+                    'hub_id,product_id,account_id,connection_id,setup_status)'
+                    ' VALUES(?,?,?,?,?,?,?,?,?,?,?,?)',
+                    (
+                        True,
+                        None,
+                        object_id,
+                        None,
+                        now,
+                        ','.join(scenario),
+                        len(scenario),
+                        hub_id,
+                        product_id,
+                        account_id,
+                        connection_id,
+                        SetupStatus.pending.value,
+                    ),
+                ).lastrowid
+                # The setup is run by this process, the test is failed by the next one
+                # started elsewhere if the lease expires before the setup is finished.
+                self._write_lease(
+                    c,
+                    f'test:{test_id}',
+                    get_settings().test_setup_lease_seconds,
+                )
+                return self._build_test_objects(sql_filter=f'id={test_id}')[0]
+        except sqlite3.IntegrityError:
+            # Another process started a test in the meantime.
+            return None
+
+    def _fail_abandoned_setups(self, c, now: datetime) -> None:
+        abandoned = [
+            row[0] for row in c.execute(
+                'SELECT id FROM test '
+                'WHERE running IS True AND setup_status=? AND NOT EXISTS ('
+                "SELECT 1 FROM lease WHERE lease.name='test:'||test.id AND lease.expires_at > ?)",
+                (SetupStatus.pending.value, now),
+            )
+        ]
+        for test_id in abandoned:
+            c.execute(
+                'UPDATE test '
+                'SET setup_status=?, setup_error=?, result=?, done_at=?, running=?, '
+                'total_duration=(julianday(?)-julianday(created_at))*86400 '
+                'WHERE id=?',
+                (
+                    SetupStatus.failed.value,
+                    'Setup abandoned, the process running it stopped.',
+                    ResultType.failed.value,
+                    now,
+                    False,
+                    now,
+                    test_id,
+                ),
+            )
+        if abandoned:
+            self._after_commit(functools.partial(self._abandoned.extend, abandoned))
+
+    def _write_lease(self, c, name: str, ttl: float) -> bool:
+        now = datetime.now()
+        return c.execute(
+            'INSERT INTO lease(name,owner,expires_at) VALUES(?,?,?) '
+            'ON CONFLICT(name) DO UPDATE SET owner=excluded.owner, expires_at=excluded.expires_at '
+            'WHERE lease.owner=excluded.owner OR lease.expires_at <= ?',
+            (name, self.owner, now + timedelta(seconds=ttl), now),
+        ).rowcount == 1
+
+    def _bind_test_object(
+        self,
+        test_id: int,
+        object_id: str,
+        account_id: str,
+        connection_id: str,
+    ) -> None:
+        with self._transaction() as c:
+            c.execute(
+                'UPDATE test SET object_id=?, account_id=?, connection_id=? WHERE id=?',
+                (object_id, account_id, connection_id, test_id),
+            )
+
+    def _finish_setup(self, test_id: int, error: Optional[str]) -> None:
+        with self._transaction() as c:
+            c.execute('DELETE FROM lease WHERE name=?', (f'test:{test_id}',))
+            if not error:
                 c.execute(
-                    'INSERT INTO test(running,result,object_id,done_at,created_at)'
-                    ' VALUES(?,?,?,?,?)',
-                    (True, None, object_id, None, datetime.now()),
+                    'UPDATE test SET setup_status=? WHERE id=?',
+                    (SetupStatus.done.value, test_id),
                 )
-                tests = self._build_test_objects(sql_filter='running is True')
-                return tests[0]
+                return
+            now = datetime.now()
+            c.execute(
+                'UPDATE test '
+                'SET setup_status=?, setup_error=?, result=?, done_at=?, running=?, '
+                'total_duration=(julianday(?)-julianday(created_at))*86400 '
+                'WHERE id=?',
+                (
+                    SetupStatus.failed.value,
+                    error,
+                    ResultType.failed.value,
+                    now,
+                    False,
+                    now,
+                    test_id,
+                ),
+            )
+            self._after_commit(functools.partial(self.due.forget, test_id))
 
-    def _build_test_objects(self, sql_filter: str = None) -> List[TstInstance]:
-        with self.connection as c:
+    def _build_test_objects(
+        self,
+        sql_filter: str = None,
+        include_steps: bool = True,
+    ) -> List[TstInstance]:
+        with self._transaction() as c:
             tests = []
             test_cursor = c.execute('SELECT * FROM test')
             if sql_filter:
                 test_cursor = c.execute(f'SELECT * FROM test WHERE {sql_filter}')
             for test in test_cursor.fetchall():
-                step_cursor = c.execute(f'SELECT * FROM step WHERE test_id = {test[0]}')
-                steps = []
-                for step in step_cursor.fetchall():
-                    d = {
-                        step_cursor.description[i][0]: str(step[i])
-                        if step[i] else None
-                        for i in range(len(step_cursor.description))
-                    }
-                    steps.append(Step(**d))
+                steps = None
+                if include_steps:
+                    steps = self._build_step_objects(c, test[0])
                 data = {
                     test_cursor.description[i][0]: str(test[i])
-                    if test[i] else None
+                    if test[i] is not None else None
                     for i in range(len(test_cursor.description))
                 }
                 data['steps'] = steps
@@ -221,32 +1067,89 @@ class DB:
                 tests.append(test)
             return tests
 
-    def _list_tests(self) -> List[TstInstance]:
-        return self._build_test_objects()
+    @staticmethod
+    def _build_step_objects(c, test_id: int) -> List[Step]:
+        step_cursor = c.execute('SELECT * FROM step WHERE test_id=?', (test_id,))
+        steps = []
+        for step in step_cursor.fetchall():
+            d = {
+                step_cursor.description[i][0]: str(step[i])
+                if step[i] is not None else None
+                for i in range(len(step_cursor.description))
+            }
+            steps.append(Step(**d))
+        return steps
+
+    def _list_tests(self, include_steps: bool = True) -> List[TstInstance]:
+        return self._build_test_objects(include_steps=include_steps)
 
     def _get_test(self, test_id: int) -> TstInstance:
         tests = self._build_test_objects(sql_filter=f'id = "{test_id}"')
         return tests[0] if tests else None
 
     def _get_test_id_from_object_id(self, object_id: str) -> int:
-        with self.connection as c:
+        with self._transaction() as c:
             res = c.execute(f'SELECT id FROM test WHERE object_id="{object_id}"')
             data = res.fetchone()
             if data:
                 return data[0]
             return None
 
-    def _set_test_result(self, test_id: int, result: str) -> None:
-        with self.connection as con:
-            con.execute(
+    def _get_test_scenario(self, object_id: str) -> Tuple[Optional[int], List[str]]:
+        with self._transaction() as c:
+            res = c.execute('SELECT id, scenario FROM test WHERE object_id=?', (object_id,))
+            data = res.fetchone()
+            if not data:
+                return None, []
+            return data[0], data[1].split(',') if data[1] else list(DEFAULT_SCENARIO)
+
+    def _set_test_result(self, test_id: int, result: str, now: datetime = None) -> bool:
+        with self._transaction() as con:
+            now = now or datetime.now()
+            finished = con.execute(
                 'UPDATE test '
-                'SET result=?, done_at=?, running=? '
+                'SET result=?, done_at=?, running=?, '
+                'total_duration=(julianday(?)-julianday(created_at))*86400 '
                 f'WHERE done_at IS NULL AND id="{test_id}"',
-                (result, datetime.now(), False),
-            )
+                (result, now, False, now),
+            ).rowcount
+            self._after_commit(functools.partial(self.due.forget, int(test_id)))
+            return bool(finished)
+
+    def _get_tests_summary(self) -> Dict:
+        with self._transaction() as c:
+            running = c.execute('SELECT COUNT(*) FROM test WHERE running IS True').fetchone()[0]
+            # The bare columns of a MAX() aggregate are the ones of the row found.
+            last_results = c.execute(
+                'SELECT hub_id, id, result, MAX(done_at) FROM test '
+                'WHERE done_at IS NOT NULL GROUP BY hub_id',
+            ).fetchall()
+        return {
+            'running_tests': running,
+            'last_results': {
+                hub_id or 'unknown': {
+                    'test_id': test_id,
+                    'result': result,
+                    'done_at': datetime.fromisoformat(done_at),
+                }
+                for hub_id, test_id, result, done_at in last_results
+            },
+        }
+
+    def _finish_check(
+        self,
+        test_id: int,
+        steps: List[Tuple[str, str]],
+        result: str,
+        now: datetime,
+    ) -> bool:
+        with self._transaction() as c:
+            for name, object_id in steps:
+                self._write_check_step(c, test_id, name, object_id, now)
+            return self._set_test_result(test_id, result, now)
 
     def _update_step_object_id(self, test_id: int, name: str, object_id: str) -> None:
-        with self.connection as con:
+        with self._transaction() as con:
             con.execute(
                 'UPDATE step '
                 'SET object_id=? '
@@ -254,9 +1157,259 @@ class DB:
                 (object_id, test_id, name),
             )
 
+    def _archive_tests(
+        self,
+        before: Optional[datetime],
+        keep: Optional[int],
+        limit: int,
+    ) -> List[Dict]:
+        conditions, params = [], []
+        if before:
+            conditions.append('created_at < ?')
+            params.append(before)
+        if keep:
+            conditions.append('id <= (SELECT id FROM test ORDER BY id DESC LIMIT 1 OFFSET ?)')
+            params.append(keep)
+        if not conditions:
+            return []
+        with self._transaction() as c:
+            res = c.execute(
+                'SELECT id FROM test '
+                f'WHERE running IS False AND ({" OR ".join(conditions)}) '
+                'ORDER BY id LIMIT ?',
+                (*params, limit),
+            )
+            ids = ','.join(str(row[0]) for row in res.fetchall())
+        if not ids:
+            return []
+        archived = [
+            {
+                'id': test.id,
+                'result': test.result.value if test.result else None,
+                'object_id': test.object_id,
+                'scenario': test.scenario,
+                'done_at': test.done_at.isoformat() if test.done_at else None,
+                'created_at': test.created_at.isoformat() if test.created_at else None,
+                'steps': [
+                    {
+                        'name': step.name,
+                        'object_id': step.object_id,
+                        'created_at': step.created_at.isoformat(),
+                        'checked_at': step.checked_at.isoformat() if step.checked_at else None,
+                        'duration': (
+                            (step.checked_at - step.created_at).total_seconds()
+                            if step.checked_at else None
+                        ),
+                    }
+                    for step in test.steps
+                ],
+            }
+            for test in self._build_test_objects(sql_filter=f'id IN ({ids})')
+        ]
+        now = datetime.now()
+        with self._transaction() as c:
+            c.executemany(
+                'INSERT OR REPLACE INTO test_archive'
+                '(id,result,object_id,scenario,done_at,created_at,archived_at,steps) '
+                'VALUES(?,?,?,?,?,?,?,?)',
+                [
+                    (
+                        test['id'],
+                        test['result'],
+                        test['object_id'],
+                        ','.join(test['scenario'] or []),
+                        test['done_at'],
+                        test['created_at'],
+                        now,
+                        json.dumps(test['steps']),
+                    )
+                    for test in archived
+                ],
+            )
+            c.execute(f'DELETE FROM step WHERE test_id IN ({ids})')
+            c.execute(f'DELETE FROM job WHERE test_id IN ({ids})')
+            c.execute(f'DELETE FROM test WHERE id IN ({ids})')
+        return archived
+
+    def export_batches(
+        self,
+        since: datetime = None,
+        until: datetime = None,
+        hub_id: str = None,
+        batch_size: int = 1000,
+    ) -> Iterator[List[Tuple]]:
+        """
+        Yield one row per step, or per test without steps, in batches of ``batch_size``
+        rows. Blocking: iterate it from a worker thread. Each batch is read in its own
+        transaction so writers are not held back while the consumer processes it.
+        """
+        sql_filter, params = self._test_filters(since, until, hub_id)
+        last = (0, 0)
+        while True:
+            with self._transaction() as c:
+                rows = c.execute(
+                    'SELECT test.id, test.hub_id, test.product_id, test.object_id, '
+                    'test.result, test.created_at, test.done_at, '
+                    'step.name, step.object_id, step.created_at, step.checked_at, '
+                    '(julianday(step.checked_at)-julianday(step.created_at))*86400, '
+                    'COALESCE(step.rowid, 0) '
+                    'FROM test LEFT JOIN step ON step.test_id=test.id '
+                    f'WHERE (test.id, COALESCE(step.rowid, 0)) > (?, ?){sql_filter} '
+                    'ORDER BY test.id, COALESCE(step.rowid, 0) LIMIT ?',
+                    (*last, *params, batch_size),
+                ).fetchall()
+            if not rows:
+                return
+            last = (rows[-1][0], rows[-1][-1])
+            yield [row[:-1] for row in rows]
+            if len(rows) < batch_size:
+                return
+
+    def fetch_step_timings(
+        self,
+        since: datetime = None,
+        until: datetime = None,
+        hub_id: str = None,
+    ) -> List[Tuple]:
+        """
+        Return ``(test_id, hub_id, name, created_at, checked_at)`` for every step, with
+        Unix timestamps and -1 for steps not checked yet. Blocking.
+        """
+        sql_filter, params = self._test_filters(since, until, hub_id)
+        with self._transaction() as c:
+            return c.execute(
+                "SELECT test.id, COALESCE(test.hub_id, ''), step.name, "
+                f"{_EPOCH.format('step.created_at')}, "
+                f"COALESCE({_EPOCH.format('step.checked_at')}, -1) "
+                'FROM step JOIN test ON test.id=step.test_id '
+                f'WHERE step.created_at IS NOT NULL{sql_filter}',
+                params,
+            ).fetchall()
 
-db = DB()
+    def fetch_test_results(
+        self,
+        since: datetime = None,
+        until: datetime = None,
+        hub_id: str = None,
+    ) -> List[Tuple]:
+        """Return ``(hub_id, created_at, success)`` of every finished test. Blocking."""
+        sql_filter, params = self._test_filters(since, until, hub_id)
+        with self._transaction() as c:
+            return c.execute(
+                "SELECT COALESCE(test.hub_id, ''), "
+                f"{_EPOCH.format('test.created_at')}, COALESCE(test.result = ?, 0) "
+                f'FROM test WHERE test.done_at IS NOT NULL{sql_filter}',
+                (ResultType.success.value, *params),
+            ).fetchall()
+
+    @staticmethod
+    def _test_filters(
+        since: Optional[datetime],
+        until: Optional[datetime],
+        hub_id: Optional[str],
+    ) -> Tuple[str, List]:
+        conditions, params = [], []
+        if since:
+            conditions.append('test.created_at >= ?')
+            params.append(since)
+        if until:
+            conditions.append('test.created_at < ?')
+            params.append(until)
+        if hub_id:
+            conditions.append('test.hub_id = ?')
+            params.append(hub_id)
+        return ''.join(f' AND {condition}' for condition in conditions), params
+
+    def _get_hub_stats(self, since: Optional[datetime], hub_id: Optional[str]) -> List[Dict]:
+        sql_filter, params = self._test_filters(since, None, hub_id)
+        with self._transaction() as c:
+            res = c.execute(
+                'SELECT hub_id, '
+                'COUNT(*) AS tests, '
+                'COALESCE(SUM(running IS True), 0) AS running, '
+                'COALESCE(SUM(result = ?), 0) AS succeeded, '
+                'COALESCE(SUM(result = ?), 0) AS failed, '
+                'AVG(CASE WHEN result = ? THEN total_duration END) AS avg_duration, '
+                'MAX(created_at) AS last_test_at, '
+                'MAX(CASE WHEN result = ? THEN done_at END) AS last_failure_at, '
+                'COALESCE(SUM(sla_breaches), 0) AS sla_breaches '
+                'FROM test '
+                f'WHERE hub_id IS NOT NULL{sql_filter} '
+                'GROUP BY hub_id ORDER BY hub_id',
+                (
+                    ResultType.success.value,
+                    ResultType.failed.value,
+                    ResultType.success.value,
+                    ResultType.failed.value,
+                    *params,
+                ),
+            )
+            columns = [column[0] for column in res.description]
+            stats = [dict(zip(columns, row)) for row in res.fetchall()]
+            for hub in stats:
+                finished = hub['succeeded'] + hub['failed']
+                hub['success_rate'] = hub['succeeded'] / finished if finished else None
+                hub['last_failure_test_id'] = None
+                if hub['last_failure_at']:
+                    hub['last_failure_test_id'] = c.execute(
+                        'SELECT id FROM test WHERE hub_id=? AND done_at=? AND result=?',
+                        (hub['hub_id'], hub['last_failure_at'], ResultType.failed.value),
+                    ).fetchone()[0]
+            return stats
+
+    def _get_tests_without_dimensions(self, limit: int) -> List[Tuple[int, str]]:
+        with self._transaction() as c:
+            return c.execute(
+                'SELECT id, object_id FROM test '
+                'WHERE hub_id IS NULL AND object_id IS NOT NULL '
+                'AND dimensions_checked_at IS NULL '
+                'ORDER BY id DESC LIMIT ?',
+                (limit,),
+            ).fetchall()
+
+    def _set_test_dimensions(
+        self,
+        test_id: int,
+        hub_id: str,
+        product_id: str,
+        account_id: str,
+        connection_id: str,
+    ) -> None:
+        # The test is not selected again by the backfill, whatever its asset told.
+        with self._transaction() as c:
+            c.execute(
+                'UPDATE test SET '
+                'hub_id=COALESCE(hub_id, ?), '
+                'product_id=COALESCE(product_id, ?), '
+                'account_id=COALESCE(account_id, ?), '
+                'connection_id=COALESCE(connection_id, ?), '
+                'dimensions_checked_at=? '
+                'WHERE id=?',
+                (hub_id, product_id, account_id, connection_id, datetime.now(), test_id),
+            )
+
+    def _vacuum(self, pages: int) -> None:
+        with self._lock:
+            self.connection.commit()
+            if self.connection.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+                # Switching an existing database to incremental mode needs one full VACUUM.
+                self.connection.execute('PRAGMA auto_vacuum=INCREMENTAL')
+                self.connection.execute('VACUUM')
+            else:
+                self.connection.execute(f'PRAGMA incremental_vacuum({pages})').fetchall()
+
+
+db = None
 
 
 def get_db():
+    # Created on first use so importing the extension does not touch the file system.
+    global db
+    if db is None:
+        settings = get_settings()
+        db = DB(
+            settings.database_path,
+            group_commit=settings.db_group_commit,
+            timeout=settings.db_busy_timeout,
+        )
     return db
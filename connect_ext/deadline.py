@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2022, CloudBlue
+# All rights reserved.
+#
+import asyncio
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Awaitable, Optional
+
+from connect.client import ClientError
+
+
+class DeadlineExceeded(ClientError):
+    def __init__(self, operation: str):
+        super().__init__(f'{operation} did not finish before the deadline.', status_code=504)
+
+
+# Monotonic time by which the current request has to be answered.
+_deadline: ContextVar[Optional[float]] = ContextVar('deadline', default=None)
+
+
+def get_deadline() -> Optional[float]:
+    return _deadline.get()
+
+
+def remaining() -> Optional[float]:
+    """Return the seconds left before the deadline, ``None`` when there is none."""
+    deadline_at = _deadline.get()
+    if deadline_at is not None:
+        return deadline_at - time.monotonic()
+
+
+@contextmanager
+def deadline(seconds: Optional[float]):
+    """
+    Bound the calls made in the block to ``seconds``, or to the enclosing deadline if
+    it comes first. ``None`` lifts the deadline, e.g. to record what was done.
+    """
+    deadline_at = None
+    if seconds is not None:
+        deadline_at = time.monotonic() + seconds
+        if _deadline.get() is not None:
+            deadline_at = min(deadline_at, _deadline.get())
+    token = _deadline.set(deadline_at)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def check_deadline(operation: str) -> None:
+    budget = remaining()
+    if budget is not None and budget <= 0:
+        raise DeadlineExceeded(operation)
+
+
+async def bounded(awaitable: Awaitable, operation: str):
+    """Await ``awaitable`` and cancel it if it is still pending at the deadline."""
+    budget = remaining()
+    if budget is None:
+        return await awaitable
+    if budget <= 0:
+        # Close the coroutine to avoid the never awaited warning.
+        getattr(awaitable, 'close', lambda: None)()
+        raise DeadlineExceeded(operation)
+    try:
+        return await asyncio.wait_for(awaitable, budget)
+    except asyncio.TimeoutError:
+        raise DeadlineExceeded(operation) from None
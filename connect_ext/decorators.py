@@ -5,9 +5,8 @@
 #
 import functools
 import inspect
+import logging
 from datetime import datetime
-import pprint
-import traceback
 
 from fastapi.responses import JSONResponse
 from fastapi import status
@@ -16,7 +15,8 @@ from connect.client import ClientError
 
 def _send_notification(msg, kwargs):
     if 'logger' in kwargs:
-        kwargs['logger'].info(msg)
+        # The traceback is only formatted when debug logging is enabled.
+        kwargs['logger'].info(msg, exc_info=kwargs['logger'].isEnabledFor(logging.DEBUG))
 
 
 def safe_client(
@@ -31,8 +31,7 @@ def safe_client(
                 except ClientError as error:
                     msg = (
                         f'{error}\n'
-                        f'Exception occured at: {datetime.now()}\n '
-                        f'{pprint.pformat(traceback.format_exc())}',
+                        f'Exception occured at: {datetime.now()}',
                     )
                     _send_notification(msg, kwargs)
                     if response_func:
@@ -46,8 +45,7 @@ def safe_client(
                 except ClientError as error:
                     msg = (
                         f'{error}\n'
-                        f'Exception occured at: {datetime.now()}\n '
-                        f'{pprint.pformat(traceback.format_exc())}',
+                        f'Exception occured at: {datetime.now()}',
                     )
                     _send_notification(msg, kwargs)
                     if response_func:
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2022, CloudBlue
+# All rights reserved.
+#
+from typing import Dict
+
+from connect.client import AsyncConnectClient, ClientError
+
+from connect_ext.operations import get_asset
+
+
+async def backfill_dimensions(client: AsyncConnectClient, db, limit: int = 100) -> Dict:
+    """
+    Fill the hub, product, account and connection of tests created before they were
+    stored, reading them from the asset of each test. Each test is tried once, the
+    ones whose asset cannot be read anymore are left without them.
+    """
+    updated = 0
+    for test_id, asset_id in await db.get_tests_without_dimensions(limit):
+        try:
+            asset = await get_asset(client, asset_id)
+        except ClientError as e:
+            if e.status_code != 404:
+                raise
+            await db.set_test_dimensions(test_id, None, None, None, None)
+            continue
+        connection = asset.get('connection', {})
+        await db.set_test_dimensions(
+            test_id,
+            connection.get('hub', {}).get('id'),
+            asset.get('product', {}).get('id'),
+            # Tests are created with the account of the extension, the provider of the hub.
+            connection.get('provider', {}).get('id'),
+            connection.get('id'),
+        )
+        updated += 1
+    return {'updated': updated}
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2022, CloudBlue
+# All rights reserved.
+#
+import heapq
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Set, Tuple
+
+
+class DueSteps:
+    """
+    Unchecked steps ordered by the time they are due to be checked. Due steps move from
+    the heap to the overdue steps of their test, so the overdue steps of a test are found
+    in time proportional to their amount instead of scanning the step table.
+    Steps are identified by their rowid, the caller serializes the access. Steps checked
+    or tests finished before being due are left in the heap and skipped once popped.
+    """
+
+    def __init__(self):
+        # Highest rowid of the step table already tracked.
+        self.last_rowid = 0
+        self._heap: List[Tuple[datetime, int, int]] = []
+        # Steps of the heap still tracked, by test.
+        self._waiting: Dict[int, Set[int]] = {}
+        self._overdue: Dict[int, Set[int]] = {}
+
+    def __len__(self) -> int:
+        return sum(len(rowids) for rowids in self._waiting.values()) + sum(
+            len(rowids) for rowids in self._overdue.values()
+        )
+
+    def extend(self, steps: Iterable[Tuple[int, int, str, float]], last_rowid: int) -> None:
+        """
+        Track the ``(rowid, test_id, created_at, delay)`` steps, due ``delay`` seconds
+        after their creation, up to ``last_rowid``.
+        """
+        for rowid, test_id, created_at, delay in steps:
+            due_at = datetime.fromisoformat(created_at) + timedelta(seconds=delay)
+            heapq.heappush(self._heap, (due_at, rowid, test_id))
+            self._waiting.setdefault(test_id, set()).add(rowid)
+        self.last_rowid = max(self.last_rowid, last_rowid)
+
+    def overdue(self, test_id: int, now: datetime) -> List[int]:
+        """Return the rowids of the steps of ``test_id`` due before ``now``."""
+        while self._heap and self._heap[0][0] < now:
+            _, rowid, step_test_id = heapq.heappop(self._heap)
+            if rowid in _pop(self._waiting, step_test_id, [rowid]):
+                self._overdue.setdefault(step_test_id, set()).add(rowid)
+        return sorted(self._overdue.get(test_id, ()))
+
+    def tests(self) -> Set[int]:
+        """Return the tests with tracked steps."""
+        return set(self._waiting) | set(self._overdue)
+
+    def discard(self, test_id: int, rowids: Iterable[int]) -> None:
+        """Stop tracking steps, once checked or deleted."""
+        rowids = set(rowids)
+        _pop(self._waiting, test_id, rowids)
+        _pop(self._overdue, test_id, rowids)
+
+    def forget(self, test_id: int) -> None:
+        """Stop tracking the steps of a finished test."""
+        self._waiting.pop(test_id, None)
+        self._overdue.pop(test_id, None)
+        if len(self._heap) > 2 * len(self) + 64:
+            # Mostly steps no longer tracked, they are dropped instead of being popped.
+            self._heap = [
+                entry for entry in self._heap
+                if entry[1] in self._waiting.get(entry[2], ())
+            ]
+            heapq.heapify(self._heap)
+
+    def clear(self) -> None:
+        self.last_rowid = 0
+        self._heap = []
+        self._waiting = {}
+        self._overdue = {}
+
+
+def _pop(tracked: Dict[int, Set[int]], test_id: int, rowids: Iterable[int]) -> Set[int]:
+    """Remove ``rowids`` from the steps of ``test_id``, returning the ones tracked."""
+    steps = tracked.get(test_id)
+    if not steps:
+        return set()
+    removed = steps.intersection(rowids)
+    steps.difference_update(removed)
+    if not steps:
+        del tracked[test_id]
+    return removed
@@ -3,29 +3,67 @@
 # Copyright (c) 2022, CloudBlue
 # All rights reserved.
 #
+import asyncio
+
 from connect.eaas.core.decorators import (
     event,
+    schedulable,
 )
 from connect.eaas.core.extension import EventsApplicationBase
 from connect.eaas.core.responses import (
     BackgroundResponse,
+    ScheduledExecutionResponse,
 )
 
+from connect_ext.backpressure import get_event_gate
+from connect_ext.client import wrap_client
 from connect_ext.decorators import safe_client
+from connect_ext.instrumentation import instrumented
+from connect_ext.jobs import get_job_runner
 from connect_ext.db import get_db
-from connect_ext.operations import (
-    create_change_request,
-    create_request,
-)
-from connect_ext.models import ResultType
+from connect_ext.dimensions import backfill_dimensions
+from connect_ext.lifecycle import advance
+from connect_ext.models import StepName
+from connect_ext.monitoring import get_monitor
+from connect_ext.replay import get_recorder
+from connect_ext.retention import apply_retention
+from connect_ext.settings import get_settings
 
 
 class HubTestingEventsApplication(EventsApplicationBase):
 
     def __init__(self, client, logger, config):
-        super().__init__(client, logger, config)
+        super().__init__(wrap_client(client), logger, config)
         self.db = get_db()
         self.db.logger = logger
+        try:
+            # The extension runtime has no startup hook, the first application
+            # created on the event loop starts the monitoring tests.
+            get_monitor().start(self.client, self.db)
+        except RuntimeError:
+            pass
+
+    async def _advance(self, step: str, request):
+        event_type = f'asset_{step}_request_processing'
+        gate = get_event_gate(event_type)
+        if not await gate.acquire():
+            self.logger.info(f"handle_{event_type} {request['id']} rescheduled, too many events")
+            return BackgroundResponse.reschedule(get_settings().event_reschedule_countdown)
+        try:
+            self.logger.info(f"handle_{event_type} {request['id']}")
+            recorder = get_recorder()
+            if recorder:
+                # The scenario of the test is registered along with its purchase, for
+                # the replay to rebuild the test as it was set up.
+                scenario = None
+                if step == StepName.purchase.value:
+                    _, scenario = await self.db.get_test_scenario(request['asset']['id'])
+                await recorder.record(step, request, scenario)
+            await advance(self.db, step, request)
+        finally:
+            gate.release()
+        get_job_runner().wake(self.client, self.db)
+        return BackgroundResponse.done()
 
     @event(
         'asset_purchase_request_processing',
@@ -33,16 +71,10 @@ class HubTestingEventsApplication(EventsApplicationBase):
             'approved',
         ],
     )
+    @instrumented
     @safe_client(response_func=BackgroundResponse.fail)
     async def handle_asset_purchase_request_processing(self, request):
-        asset_id = request['asset']['id']
-        request_id = request['id']
-        self.logger.info(
-            f"handle_asset_purchase_request_processing {request_id}",
-        )
-        test_id = await self.db.get_test_id_from_object_id(asset_id)
-        await self.db.check_step(test_id, 'purchase', request_id)
-        return BackgroundResponse.done()
+        return await self._advance(StepName.purchase.value, request)
 
     @event(
         'asset_adjustment_request_processing',
@@ -50,22 +82,10 @@ class HubTestingEventsApplication(EventsApplicationBase):
             'approved',
         ],
     )
+    @instrumented
     @safe_client(response_func=BackgroundResponse.fail)
     async def handle_asset_adjustment_request_processing(self, request):
-        asset_id = request['asset']['id']
-        request_id = request['id']
-        self.logger.info(f"handle_asset_adjustment_request_processing {request_id}")
-        test_id = await self.db.get_test_id_from_object_id(asset_id)
-        await self.db.update_step_object_id(test_id, 'adjustment', request_id)
-        await self.db.check_step(test_id, 'adjustment', request_id)
-        r = await create_change_request(
-            client=self.client,
-            product_id=request['asset']['product']['id'],
-            request_id=request_id,
-            asset_id=asset_id,
-        )
-        await self.db.add_new_step(asset_id, 'change', r['id'])
-        return BackgroundResponse.done()
+        return await self._advance(StepName.adjustment.value, request)
 
     @event(
         'asset_change_request_processing',
@@ -73,20 +93,10 @@ class HubTestingEventsApplication(EventsApplicationBase):
             'approved',
         ],
     )
+    @instrumented
     @safe_client(response_func=BackgroundResponse.fail)
     async def handle_asset_change_request_processing(self, request):
-        asset_id = request['asset']['id']
-        request_id = request['id']
-        self.logger.info(f"handle_asset_change_request_processing {request_id}")
-        test_id = await self.db.get_test_id_from_object_id(asset_id)
-        await self.db.check_step(test_id, 'change', request_id)
-        r = await create_request(
-            client=self.client,
-            request_type='suspend',
-            asset_id=asset_id,
-        )
-        await self.db.add_new_step(asset_id, 'suspend', r['id'])
-        return BackgroundResponse.done()
+        return await self._advance(StepName.change.value, request)
 
     @event(
         'asset_suspend_request_processing',
@@ -94,22 +104,10 @@ class HubTestingEventsApplication(EventsApplicationBase):
             'approved',
         ],
     )
+    @instrumented
     @safe_client(response_func=BackgroundResponse.fail)
     async def handle_asset_suspend_request_processing(self, request):
-        asset_id = request['asset']['id']
-        request_id = request['id']
-        self.logger.info(
-            f"handle_asset_suspend_request_processing {request_id}",
-        )
-        test_id = await self.db.get_test_id_from_object_id(asset_id)
-        await self.db.check_step(test_id, 'suspend', request_id)
-        r = await create_request(
-            client=self.client,
-            request_type='resume',
-            asset_id=asset_id,
-        )
-        await self.db.add_new_step(asset_id, 'resume', r['id'])
-        return BackgroundResponse.done()
+        return await self._advance(StepName.suspend.value, request)
 
     @event(
         'asset_resume_request_processing',
@@ -117,20 +115,10 @@ class HubTestingEventsApplication(EventsApplicationBase):
             'approved',
         ],
     )
+    @instrumented
     @safe_client(response_func=BackgroundResponse.fail)
     async def handle_asset_resume_request_processing(self, request):
-        asset_id = request['asset']['id']
-        request_id = request['id']
-        self.logger.info(f"handle_asset_resume_request_processing {request_id}")
-        test_id = await self.db.get_test_id_from_object_id(asset_id)
-        await self.db.check_step(test_id, 'resume', request_id)
-        r = await create_request(
-            client=self.client,
-            request_type='cancel',
-            asset_id=request['asset']['id'],
-        )
-        await self.db.add_new_step(asset_id, 'cancel', r['id'])
-        return BackgroundResponse.done()
+        return await self._advance(StepName.resume.value, request)
 
     @event(
         'asset_cancel_request_processing',
@@ -138,16 +126,46 @@ class HubTestingEventsApplication(EventsApplicationBase):
             'approved',
         ],
     )
+    @instrumented
     @safe_client(response_func=BackgroundResponse.fail)
     async def handle_asset_cancel_request_processing(self, request):
-        asset_id = request['asset']['id']
-        request_id = request['id']
-        self.logger.info(f"handle_asset_cancel_request_processing {request_id}")
-        test_id = await self.db.get_test_id_from_object_id(asset_id)
-        await self.db.check_step(test_id, 'cancel', request_id)
-        if (
-            len(await self.db.get_steps_to_check(test_id=test_id)) == 0
-            and await self.db.get_step_count(test_id=test_id) == 6
-        ):
-            await self.db.set_test_result(test_id, ResultType.success.value)
-        return BackgroundResponse.done()
+        return await self._advance(StepName.cancel.value, request)
+
+    @schedulable(
+        'Apply test retention',
+        'Archives the finished tests past the retention window and reclaims space in data.db.',
+    )
+    async def execute_retention(self, schedule):
+        result = await apply_retention(self.db)
+        self.logger.info(f"Retention archived {result['archived']} tests")
+        return ScheduledExecutionResponse.done()
+
+    @schedulable(
+        'Backfill test dimensions',
+        'Stores the hub, product, account and connection of the tests created without them.',
+    )
+    async def execute_dimensions_backfill(self, schedule):
+        result = await backfill_dimensions(self.client, self.db)
+        self.logger.info(f"Dimensions backfilled for {result['updated']} tests")
+        return ScheduledExecutionResponse.done()
+
+    @schedulable(
+        'Run lifecycle jobs',
+        'Issues the lifecycle requests still queued, e.g. after a restart of the extension.',
+    )
+    async def execute_lifecycle_jobs(self, schedule):
+        runner = get_job_runner()
+        runner.wake(self.client, self.db)
+        await asyncio.gather(*runner.tasks)
+        return ScheduledExecutionResponse.done()
+
+    @schedulable(
+        'Run monitoring tests',
+        'Starts the monitoring tests due, in case no event started the scheduler yet.',
+    )
+    async def execute_monitoring(self, schedule):
+        monitor = get_monitor()
+        monitor.start(self.client, self.db)
+        tests = await monitor.run_due()
+        self.logger.info(f'{len(tests)} monitoring tests started')
+        return ScheduledExecutionResponse.done()
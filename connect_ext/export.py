@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2022, CloudBlue
+# All rights reserved.
+#
+"""
+Flat export of the tests and their steps for offline analysis.
+
+    python -m connect_ext.export --format parquet --output tests.parquet --hub HB-123
+
+Arrow and Parquet files need ``pyarrow``, CSV is always available.
+"""
+import argparse
+import csv
+import io
+from datetime import datetime
+from typing import Iterator, List, Tuple
+
+from connect_ext.db import DB
+from connect_ext.models import ExportFormat
+
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:  # pragma: no cover
+    pyarrow = None
+
+
+EXPORT_COLUMNS = (
+    ('test_id', 'int'),
+    ('hub_id', 'str'),
+    ('product_id', 'str'),
+    ('asset_id', 'str'),
+    ('result', 'str'),
+    ('test_created_at', 'datetime'),
+    ('test_done_at', 'datetime'),
+    ('step_name', 'str'),
+    ('step_request_id', 'str'),
+    ('step_created_at', 'datetime'),
+    ('step_checked_at', 'datetime'),
+    ('step_duration', 'float'),
+)
+
+
+class UnsupportedFormatError(Exception):
+    pass
+
+
+def check_format(fmt: ExportFormat) -> None:
+    if fmt != ExportFormat.csv and pyarrow is None:
+        raise UnsupportedFormatError(f'The {fmt.value} format needs pyarrow to be installed.')
+
+
+def iter_csv(batches: Iterator[List[Tuple]]) -> Iterator[str]:
+    """Yield the header and then one CSV chunk per batch of rows."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow([name for name, _ in EXPORT_COLUMNS])
+    for batch in batches:
+        writer.writerows(batch)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+
+def _schema():
+    types = {
+        'int': pyarrow.int64(),
+        'str': pyarrow.string(),
+        'datetime': pyarrow.timestamp('us'),
+        'float': pyarrow.float64(),
+    }
+    return pyarrow.schema([(name, types[kind]) for name, kind in EXPORT_COLUMNS])
+
+
+def _record_batch(schema, rows: List[Tuple]):
+    columns = []
+    for index, (_, kind) in enumerate(EXPORT_COLUMNS):
+        values = [row[index] for row in rows]
+        if kind == 'datetime':
+            values = [datetime.fromisoformat(value) if value else None for value in values]
+        columns.append(values)
+    return pyarrow.RecordBatch.from_arrays(
+        [pyarrow.array(values, type=field.type) for values, field in zip(columns, schema)],
+        schema=schema,
+    )
+
+
+class _ChunkSink(io.RawIOBase):
+    """Write-only file collecting what the Arrow writer produces until it is drained."""
+
+    def __init__(self):
+        super().__init__()
+        self.chunks = []
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self) -> bytes:
+        data, self.chunks = b''.join(self.chunks), []
+        return data
+
+
+def iter_arrow(batches: Iterator[List[Tuple]]) -> Iterator[bytes]:
+    """Yield an Arrow IPC stream, one record batch per batch of rows."""
+    schema = _schema()
+    sink = _ChunkSink()
+    with pyarrow.ipc.new_stream(sink, schema) as writer:
+        for batch in batches:
+            writer.write_batch(_record_batch(schema, batch))
+            yield sink.drain()
+    yield sink.drain()
+
+
+def write_export(db: DB, fmt: ExportFormat, output: str, **filters) -> int:
+    """Write the export to the ``output`` file and return the amount of rows written."""
+    check_format(fmt)
+    count = 0
+    batches = db.export_batches(**filters)
+    if fmt == ExportFormat.csv:
+        with open(output, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f)
+            writer.writerow([name for name, _ in EXPORT_COLUMNS])
+            for batch in batches:
+                writer.writerows(batch)
+                count += len(batch)
+        return count
+    schema = _schema()
+    if fmt == ExportFormat.arrow:
+        writer = pyarrow.ipc.new_file(output, schema)
+    else:
+        writer = pyarrow.parquet.ParquetWriter(output, schema)
+    with writer:
+        for batch in batches:
+            record_batch = _record_batch(schema, batch)
+            writer.write_table(pyarrow.Table.from_batches([record_batch]))
+            count += len(batch)
+    return count
+
+
+def main(argv: List[str] = None) -> None:
+    parser = argparse.ArgumentParser(description='Export the tests and their steps.')
+    parser.add_argument('--database', default='data.db')
+    parser.add_argument('--format', choices=[f.value for f in ExportFormat], default='csv')
+    parser.add_argument('--output', required=True)
+    parser.add_argument('--since', type=datetime.fromisoformat)
+    parser.add_argument('--until', type=datetime.fromisoformat)
+    parser.add_argument('--hub')
+    args = parser.parse_args(argv)
+    try:
+        count = write_export(
+            DB(args.database),
+            ExportFormat(args.format),
+            args.output,
+            since=args.since,
+            until=args.until,
+            hub_id=args.hub,
+        )
+    except UnsupportedFormatError as e:
+        parser.error(str(e))
+    print(f'{count} rows exported to {args.output}')
+
+
+if __name__ == '__main__':  # pragma: no cover
+    main()
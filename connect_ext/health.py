@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2022, CloudBlue
+# All rights reserved.
+#
+import time
+from collections import deque
+from typing import Deque, Dict, Optional
+
+from connect_ext.settings import get_settings
+
+
+class HealthCounters:
+    """
+    Database calls of a process, counted as they are made so health probes read memory
+    only, and the last summary of the tests read from the database. The tests are
+    written by every process sharing the file, they are read back from the test table
+    instead of being counted here.
+    """
+
+    def __init__(self, window: int):
+        # Database calls submitted to the executor and not completed yet.
+        self.db_pending = 0
+        self.db_latencies: Deque[float] = deque(maxlen=window)
+        self._tests: Optional[Dict] = None
+        self._tests_read_at = 0.0
+
+    def observe_db(self, latency: float) -> None:
+        self.db_latencies.append(latency)
+
+    def cached_tests(self, ttl: float) -> Optional[Dict]:
+        """The summary of the tests if it was read less than ``ttl`` seconds ago."""
+        if self._tests is not None and time.monotonic() - self._tests_read_at < ttl:
+            return self._tests
+
+    def cache_tests(self, summary: Dict) -> None:
+        self._tests = summary
+        self._tests_read_at = time.monotonic()
+
+    def stats(self) -> Dict:
+        latencies = list(self.db_latencies)
+        return {
+            'pending': self.db_pending,
+            'latency_last': latencies[-1] if latencies else None,
+            'latency_avg': sum(latencies) / len(latencies) if latencies else None,
+            'latency_max': max(latencies) if latencies else None,
+        }
+
+
+class ErrorRate:
+    """Share of failed calls among the last ``window`` ones."""
+
+    def __init__(self, window: int):
+        self.calls = 0
+        self.errors = 0
+        self.outcomes: Deque[bool] = deque(maxlen=window)
+
+    def add(self, failed: bool) -> None:
+        self.calls += 1
+        self.errors += failed
+        self.outcomes.append(failed)
+
+    def rate(self) -> float:
+        return sum(self.outcomes) / len(self.outcomes) if self.outcomes else 0.0
+
+    def stats(self) -> Dict:
+        return {'calls': self.calls, 'errors': self.errors, 'error_rate': self.rate()}
+
+
+_outbound: Optional[ErrorRate] = None
+
+
+def get_outbound_errors() -> ErrorRate:
+    global _outbound
+    if _outbound is None:
+        _outbound = ErrorRate(get_settings().health_window)
+    return _outbound
+
+
+def reset() -> None:
+    global _outbound
+    _outbound = None
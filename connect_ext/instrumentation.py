@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2022, CloudBlue
+# All rights reserved.
+#
+import functools
+import logging
+import random
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Optional
+
+from connect_ext.profiler import record_event
+from connect_ext.settings import get_settings
+
+
+class CallStats:
+    """Time spent by a route or event handler invocation, split by kind of work."""
+
+    def __init__(self):
+        self.counts: Dict[str, int] = {}
+        self.durations: Dict[str, float] = {}
+
+    def add(self, kind: str, duration: float) -> None:
+        self.counts[kind] = self.counts.get(kind, 0) + 1
+        self.durations[kind] = self.durations.get(kind, 0.0) + duration
+
+
+_current: ContextVar[Optional[CallStats]] = ContextVar('call_stats', default=None)
+
+
+@contextmanager
+def measure(kind: str):
+    """Account the time spent in the block to the ``kind`` of the current invocation."""
+    stats = _current.get()
+    if stats is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        stats.add(kind, time.perf_counter() - started)
+
+
+def _get_logger(args, kwargs):
+    if 'logger' in kwargs:
+        return kwargs['logger']
+    if args and hasattr(args[0], 'logger'):
+        return args[0].logger
+    return logging.getLogger('connect_ext')
+
+
+def _log_if_slow(name: str, duration: float, stats: CallStats, logger) -> None:
+    settings = get_settings()
+    if duration < settings.slow_call_threshold:
+        return
+    if random.random() >= settings.slow_call_sample_rate:
+        return
+    record = {
+        'call': name,
+        'duration': round(duration, 6),
+        'db_calls': stats.counts.get('db', 0),
+        'db_time': round(stats.durations.get('db', 0.0), 6),
+        'outbound_calls': stats.counts.get('outbound', 0),
+        'outbound_time': round(stats.durations.get('outbound', 0.0), 6),
+    }
+    logger.warning(f'Slow call {name} took {duration:.3f}s', extra={'performance': record})
+
+
+def instrumented(func):
+    """
+    Record the duration, the database time and the outbound Connect calls of each
+    invocation of a route or event handler, and log the ones slower than the
+    configured threshold.
+    """
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        stats = CallStats()
+        token = _current.set(stats)
+        started = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            _current.reset(token)
+            record_event()
+            _log_if_slow(
+                func.__qualname__,
+                time.perf_counter() - started,
+                stats,
+                _get_logger(args, kwargs),
+            )
+    return wrapper
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2022, CloudBlue
+# All rights reserved.
+#
+import asyncio
+import json
+import logging
+from datetime import datetime
+from typing import List, Optional
+
+from connect.client import AsyncConnectClient
+
+from connect_ext.alerts import notify_finished
+from connect_ext.lifecycle import issue_step
+from connect_ext.resilience import get_backoff_delay
+from connect_ext.settings import get_settings
+
+
+logger = logging.getLogger('connect_ext')
+
+
+class JobRunner:
+    """
+    Run the lifecycle jobs queued in the database with up to ``workers`` of them at
+    once. Failed jobs are retried with backoff until ``max_attempts``, jobs left
+    running by a stopped process are run again once their lease expires.
+    """
+
+    def __init__(self, workers: int, max_attempts: int, lease: float):
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.lease = lease
+        self.client: Optional[AsyncConnectClient] = None
+        self.db = None
+        self.tasks: List[asyncio.Task] = []
+        self._loop = None
+
+    def wake(self, client: AsyncConnectClient, db) -> None:
+        """Start the missing workers on the running event loop."""
+        self.client = client
+        self.db = db
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self.tasks = []
+        self.tasks = [task for task in self.tasks if not task.done()]
+        while len(self.tasks) < self.workers:
+            self.tasks.append(loop.create_task(self.drain()))
+
+    async def drain(self) -> None:
+        """Run jobs until none is left, waiting for the ones retried later."""
+        while True:
+            job = await self.db.claim_job(self.lease)
+            if not job:
+                delay = await self.db.get_next_job_delay()
+                if delay is None:
+                    return
+                await asyncio.sleep(delay)
+                continue
+            await self._run(*job)
+
+    async def _run(
+        self,
+        job_id: int,
+        test_id: int,
+        step: str,
+        payload: str,
+        attempts: int,
+        position: Optional[int],
+        created_at: str,
+    ):
+        try:
+            # Creating requests is not idempotent, a retried job looks for the request
+            # of its step first so Connect does not get it twice.
+            await issue_step(
+                self.client,
+                self.db,
+                step,
+                json.loads(payload),
+                position,
+                datetime.fromisoformat(created_at) if attempts > 1 else None,
+            )
+        except Exception as e:
+            if attempts >= self.max_attempts:
+                logger.warning(f'Job {job_id} issuing {step} for test {test_id} failed: {e}')
+                if await self.db.fail_job(job_id, attempts, str(e)):
+                    await notify_finished(self.db, test_id)
+            else:
+                await self.db.retry_job(job_id, attempts, str(e), get_backoff_delay(attempts))
+            return
+        await self.db.complete_job(job_id, attempts)
+
+
+_runner: Optional[JobRunner] = None
+
+
+def get_job_runner() -> JobRunner:
+    global _runner
+    if _runner is None:
+        settings = get_settings()
+        _runner = JobRunner(
+            settings.job_workers,
+            settings.job_max_attempts,
+            settings.job_lease_seconds,
+        )
+    return _runner
+
+
+def reset() -> None:
+    global _runner
+    _runner = None
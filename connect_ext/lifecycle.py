@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2022, CloudBlue
+# All rights reserved.
+#
+import functools
+from datetime import datetime
+from logging import LoggerAdapter
+from typing import Awaitable, Callable, Dict, List, NamedTuple, Optional
+
+from connect.client import AsyncConnectClient
+
+from connect_ext.alerts import notify_finished
+from connect_ext.deadline import deadline
+from connect_ext.models import ResultType, StepName, TestRequest, TstInstance
+from connect_ext.operations import (
+    change_draft_to_pending,
+    create_change_request,
+    create_draft_request,
+    create_request,
+    find_request,
+    get_account_id,
+    get_request_by_id,
+    validate_request,
+)
+from connect_ext.settings import get_settings
+
+
+class StepSpec(NamedTuple):
+    # Coroutine issuing the request of this step, ``None`` when another party creates it.
+    issue: Optional[Callable[[AsyncConnectClient, Dict], Awaitable[Dict]]] = None
+    # The request id is not known upfront and has to be bound when its event arrives.
+    bind_object_id: bool = False
+
+
+async def _issue_change(client: AsyncConnectClient, request: Dict) -> Dict:
+    return await create_change_request(
+        client=client,
+        product_id=request['asset']['product']['id'],
+        request_id=request['id'],
+        asset_id=request['asset']['id'],
+    )
+
+
+def _issue_request(request_type: str):
+    async def issue(client: AsyncConnectClient, request: Dict) -> Dict:
+        return await create_request(
+            client=client,
+            request_type=request_type,
+            asset_id=request['asset']['id'],
+        )
+    return issue
+
+
+STEPS = {
+    StepName.purchase.value: StepSpec(),
+    StepName.adjustment.value: StepSpec(bind_object_id=True),
+    StepName.change.value: StepSpec(issue=_issue_change),
+    StepName.suspend.value: StepSpec(issue=_issue_request('suspend')),
+    StepName.resume.value: StepSpec(issue=_issue_request('resume')),
+    StepName.cancel.value: StepSpec(issue=_issue_request('cancel')),
+}
+
+
+def next_step(scenario: List[str], steps_checked: int) -> Optional[str]:
+    """Return the step that follows once ``steps_checked`` steps have been approved."""
+    if steps_checked < len(scenario):
+        return scenario[steps_checked]
+
+
+def next_job(scenario: List[str], steps_checked: int) -> Optional[str]:
+    """Return the step to issue once ``steps_checked`` steps have been approved, if any."""
+    following = next_step(scenario, steps_checked)
+    if following and STEPS[following].issue:
+        return following
+
+
+async def advance(db, step: str, request: Dict) -> None:
+    """
+    Check ``step`` for the approved ``request`` and queue the issue of the next step
+    of the test scenario, or finish the test when every step has been checked.
+    """
+    asset_id = request['asset']['id']
+    request_id = request['id']
+    test_id, scenario = await db.get_test_scenario(asset_id)
+    if not test_id:
+        return
+    if STEPS[step].bind_object_id:
+        await db.update_step_object_id(test_id, step, request_id)
+    steps_checked = await db.check_step_and_enqueue(
+        test_id,
+        step,
+        request_id,
+        functools.partial(next_job, scenario),
+        # Only what the issuers read, the payload is stored until the job runs.
+        {
+            'id': request_id,
+            'asset': {
+                'id': asset_id,
+                'product': {'id': request['asset'].get('product', {}).get('id')},
+            },
+        },
+    )
+    if steps_checked and not next_step(scenario, steps_checked):
+        await db.set_test_result(test_id, ResultType.success.value)
+        await notify_finished(db, test_id)
+
+
+async def issue_step(
+    client: AsyncConnectClient,
+    db,
+    step: str,
+    request: Dict,
+    position: int = None,
+    reuse_after: datetime = None,
+) -> None:
+    """
+    Issue the request of ``step`` and register it as the step at ``position`` of the
+    test. With ``reuse_after``, the pending request of ``step`` created since then for
+    the asset and not registered yet is registered instead, if any: a previous attempt
+    may have created it before failing.
+    """
+    asset_id = request['asset']['id']
+    r = None
+    if reuse_after:
+        r = await find_request(
+            client,
+            asset_id,
+            step,
+            reuse_after,
+            await db.get_step_object_ids(asset_id),
+        )
+    if not r:
+        r = await STEPS[step].issue(client, request)
+    await db.add_new_step(asset_id, step, r['id'], position)
+
+
+async def setup_test(
+    client: AsyncConnectClient,
+    db,
+    request: TestRequest,
+    progress: Dict,
+) -> TstInstance:
+    """
+    Create the purchase request of the registered test ``progress['test_id']`` and
+    bind its asset to the test, recording in ``progress`` the stage reached and the
+    objects created so far.
+    """
+    test_id = progress['test_id']
+    progress['stage'] = 'get_account_id'
+    account_id = await get_account_id(client)
+
+    progress['stage'] = 'create_draft_request'
+    r = await create_draft_request(
+        client,
+        'production',
+        account_id,
+        request.product_id,
+        request.hub_id,
+    )
+    request_id = progress['request_id'] = r['id']
+
+    progress['stage'] = 'validate_request'
+    r = await get_request_by_id(client, request_id)
+    await validate_request(client, r)
+    asset_id = progress['asset_id'] = r['asset']['id']
+
+    progress['stage'] = 'bind_test_object'
+    await db.bind_test_object(
+        test_id,
+        asset_id,
+        account_id=account_id,
+        connection_id=r['asset'].get('connection', {}).get('id'),
+    )
+
+    progress['stage'] = 'change_draft_to_pending'
+    await change_draft_to_pending(client, request_id)
+
+    progress['stage'] = 'add_new_step'
+    await db.add_new_step(asset_id, 'purchase', r['id'])
+    await db.add_new_step(asset_id, 'adjustment')
+    progress['stage'] = 'done'
+    await db.finish_setup(test_id)
+    return await db.get_test(test_id)
+
+
+async def run_setup(
+    client: AsyncConnectClient,
+    db,
+    request: TestRequest,
+    progress: Dict,
+    logger: LoggerAdapter,
+) -> TstInstance:
+    """Run the setup of a test within its deadline, failing the test if it does not end."""
+    try:
+        with deadline(get_settings().start_test_timeout):
+            return await setup_test(client, db, request, progress)
+    except Exception as e:
+        # The only log of the failure, the setup workers do not log it again.
+        logger.warning(f'Test setup failed: {e}', extra={'partial_state': progress})
+        with deadline(None):
+            await db.finish_setup(progress['test_id'], f"{e} (stage: {progress['stage']})")
+            await notify_finished(db, progress['test_id'])
+        raise
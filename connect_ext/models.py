@@ -7,7 +7,7 @@ from typing import List, Optional, Union
 from datetime import datetime
 from enum import Enum
 
-from pydantic import BaseModel, validator
+from pydantic import BaseModel, Field, validator
 
 
 class ResultType(Enum):
@@ -15,6 +15,31 @@ class ResultType(Enum):
     failed = 'failed'
 
 
+class SetupStatus(str, Enum):
+    pending = 'pending'
+    done = 'done'
+    failed = 'failed'
+
+
+class StepName(str, Enum):
+    purchase = 'purchase'
+    adjustment = 'adjustment'
+    change = 'change'
+    suspend = 'suspend'
+    resume = 'resume'
+    cancel = 'cancel'
+
+
+DEFAULT_SCENARIO = [
+    StepName.purchase.value,
+    StepName.adjustment.value,
+    StepName.change.value,
+    StepName.suspend.value,
+    StepName.resume.value,
+    StepName.cancel.value,
+]
+
+
 class Step(BaseModel):
     test_id: Optional[int]
     name: str
@@ -22,6 +47,9 @@ class Step(BaseModel):
     created_at: datetime
     checked: Optional[bool]
     checked_at: Optional[datetime]
+    sla_seconds: Optional[float]
+    sla_met: Optional[bool]
+    sla_margin: Optional[float]
 
     class Config:
         fields = {'test_id': {'exclude': True}}
@@ -42,6 +70,19 @@ class TstInstance(BaseModel):
     object_id: Optional[str]
     done_at: Optional[datetime]
     created_at: Optional[datetime]
+    scenario: Optional[List[str]]
+    steps_expected: Optional[int]
+    steps_added: Optional[int]
+    steps_checked: Optional[int]
+    last_step: Optional[str]
+    total_duration: Optional[float]
+    hub_id: Optional[str]
+    product_id: Optional[str]
+    account_id: Optional[str]
+    connection_id: Optional[str]
+    setup_status: Optional[SetupStatus]
+    setup_error: Optional[str]
+    sla_breaches: Optional[int]
     steps: Optional[List[Step]]
 
     @validator('running')
@@ -58,11 +99,83 @@ class TstInstance(BaseModel):
     def validate_done_at(value):
         return value or None
 
+    @validator('scenario', pre=True)
+    def validate_scenario(value):
+        if isinstance(value, str):
+            value = value.split(',')
+        return value or None
+
+    @validator('steps_added', 'steps_checked', 'sla_breaches', always=True)
+    def validate_step_counters(value):
+        return value or 0
+
 
 class ErrorResponse(BaseModel):
     detail: str
 
 
+class HubStats(BaseModel):
+    hub_id: str
+    tests: int
+    running: int
+    succeeded: int
+    failed: int
+    success_rate: Optional[float]
+    avg_duration: Optional[float]
+    last_test_at: Optional[datetime]
+    last_failure_at: Optional[datetime]
+    last_failure_test_id: Optional[int]
+    sla_breaches: int = 0
+
+
+class ExportFormat(str, Enum):
+    csv = 'csv'
+    arrow = 'arrow'
+    parquet = 'parquet'
+
+
+class ProfilerRequest(BaseModel):
+    seconds: float = Field(10, gt=0, le=300)
+    events: Optional[int] = Field(None, gt=0)
+    interval: float = Field(0.005, ge=0.001, le=1)
+
+
+class ProfilerStatus(BaseModel):
+    running: bool
+    started_at: Optional[datetime]
+    stopped_at: Optional[datetime]
+    samples: int
+    events: int
+
+
 class TestRequest(BaseModel):
     product_id: str
     hub_id: str
+    scenario: Optional[List[StepName]]
+
+    @validator('scenario')
+    def validate_scenario(value):
+        if not value:
+            return None
+        if value[:2] != [StepName.purchase, StepName.adjustment]:
+            raise ValueError('The scenario must start with purchase and adjustment.')
+        suspended = False
+        for position, step in enumerate(value[2:], start=2):
+            if step in (StepName.purchase, StepName.adjustment):
+                raise ValueError(f'The {step.value} step can only be run once.')
+            if step == StepName.cancel and position != len(value) - 1:
+                raise ValueError('The cancel step must be the last one.')
+            if step == StepName.change and suspended:
+                raise ValueError('A suspended asset cannot be changed.')
+            if step == StepName.suspend and suspended:
+                raise ValueError('The asset is already suspended.')
+            if step == StepName.resume and not suspended:
+                raise ValueError('Only a suspended asset can be resumed.')
+            if step in (StepName.suspend, StepName.resume):
+                suspended = step == StepName.suspend
+        return [step.value for step in value]
+
+
+class MonitorTarget(TestRequest):
+    # Seconds between two tests of the hub and product.
+    interval: float = Field(3600, gt=0)
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2022, CloudBlue
+# All rights reserved.
+#
+import asyncio
+import functools
+import heapq
+import logging
+import random
+import time
+from typing import Dict, List, Optional, Tuple
+
+from connect.client import AsyncConnectClient
+
+from connect_ext.lifecycle import run_setup
+from connect_ext.models import MonitorTarget, TstInstance
+from connect_ext.settings import get_settings
+from connect_ext.workers import get_setup_pool
+
+
+logger = logging.getLogger('connect_ext')
+
+
+class MonitorScheduler:
+    """
+    Start a test of each target every ``interval`` seconds, spread by a random jitter
+    of ``jitter`` times the interval so targets of the same cadence do not collide.
+    A run due while a test is running is skipped until the next one instead of being
+    queued, so slow hubs cannot pile tests up.
+    """
+
+    def __init__(self, targets: List[MonitorTarget], jitter: float):
+        self.targets = targets
+        self.jitter = jitter
+        self.client: Optional[AsyncConnectClient] = None
+        self.db = None
+        self.task: Optional[asyncio.Task] = None
+        self._loop = None
+        self.started = 0
+        self.skipped = 0
+        self.failed = 0
+        now = time.monotonic()
+        # (monotonic time of the next run, target index), the first runs are spread
+        # over the jitter window.
+        self._heap: List[Tuple[float, int]] = [
+            (now + target.interval * random.uniform(0, jitter), index)
+            for index, target in enumerate(targets)
+        ]
+        heapq.heapify(self._heap)
+
+    def _next_run(self, now: float, target: MonitorTarget) -> float:
+        return now + target.interval * (1 + random.uniform(-self.jitter, self.jitter))
+
+    def start(self, client: AsyncConnectClient, db) -> None:
+        """Run the scheduler on the running event loop unless it already runs."""
+        self.client = client
+        self.db = db
+        loop = asyncio.get_running_loop()
+        if not self._heap or (self._loop is loop and not self.task.done()):
+            return
+        self._loop = loop
+        self.task = loop.create_task(self.run(), name='monitoring')
+
+    async def run(self) -> None:
+        while True:
+            delay = self._heap[0][0] - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            await self.run_due()
+
+    async def run_due(self) -> List[TstInstance]:
+        """Start the tests of the targets due, the one waiting the longest first."""
+        tests = []
+        now = time.monotonic()
+        while self._heap and self._heap[0][0] <= now:
+            _, index = heapq.heappop(self._heap)
+            target = self.targets[index]
+            heapq.heappush(self._heap, (self._next_run(now, target), index))
+            try:
+                test = await self._start(target)
+            except Exception:
+                self.failed += 1
+                logger.exception(f'Monitoring test of {target.hub_id} could not be started')
+                continue
+            if test:
+                tests.append(test)
+        return tests
+
+    async def _start(self, target: MonitorTarget) -> Optional[TstInstance]:
+        test = None
+        if await self.db.is_idle():
+            test = await self.db.create_new_test(
+                object_id=None,
+                scenario=target.scenario,
+                hub_id=target.hub_id,
+                product_id=target.product_id,
+            )
+        if not test:
+            self.skipped += 1
+            logger.info(f'Monitoring test of {target.hub_id} skipped, a test is running')
+            return None
+        self.started += 1
+        progress = {'stage': None, 'test_id': test.id}
+        get_setup_pool().submit(
+            functools.partial(run_setup, self.client, self.db, target, progress, logger),
+        )
+        return test
+
+    def stats(self) -> Dict:
+        return {
+            'targets': len(self.targets),
+            'started': self.started,
+            'skipped': self.skipped,
+            'failed': self.failed,
+        }
+
+
+_scheduler: Optional[MonitorScheduler] = None
+
+
+def get_monitor() -> MonitorScheduler:
+    global _scheduler
+    if _scheduler is None:
+        settings = get_settings()
+        _scheduler = MonitorScheduler(settings.monitor_targets, settings.monitor_jitter)
+    return _scheduler
+
+
+def reset() -> None:
+    global _scheduler
+    _scheduler = None
@@ -5,10 +5,13 @@
 #
 import uuid
 import random
-from typing import Dict
+from datetime import datetime, timezone
+from typing import Dict, Iterable
 
 from connect.client import AsyncConnectClient
 
+from connect_ext.resilience import resilient
+
 
 async def _get_connection_id(
     client: AsyncConnectClient,
@@ -65,6 +68,12 @@ async def _get_tiers(client: AsyncConnectClient, account_id: str):
     return tiers
 
 
+@resilient('accounts')
+async def get_account_id(client: AsyncConnectClient):
+    return (await client.accounts.all().first())['id']
+
+
+@resilient('requests', idempotent=False)
 async def create_draft_request(
     client: AsyncConnectClient,
     connection_type: str,
@@ -98,11 +107,13 @@ async def create_draft_request(
     return response
 
 
+@resilient('requests', idempotent=False)
 async def change_draft_to_pending(client: AsyncConnectClient, request_id: str):
     response = await client.requests[request_id]('purchase').post()
     return response
 
 
+@resilient('requests', idempotent=False)
 async def create_change_request(
     client: AsyncConnectClient,
     product_id: str,
@@ -123,19 +134,43 @@ async def create_change_request(
     return response
 
 
+@resilient('requests')
 async def get_request_by_id(client: AsyncConnectClient, request_id: str):
     return await client.requests[request_id].get()
 
 
+@resilient('requests')
+async def find_request(
+    client: AsyncConnectClient,
+    asset_id: str,
+    request_type: str,
+    created_after: datetime,
+    exclude: Iterable[str] = (),
+):
+    created_after = created_after.astimezone(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S')
+    f = f'asset.id={asset_id}&type={request_type}&status=pending&gt(created,{created_after})'
+    if exclude:
+        f += f'&out(id,({",".join(exclude)}))'
+    return await client.requests.filter(f).first()
+
+
+@resilient('requests')
 async def validate_request(client: AsyncConnectClient, request: Dict):
     response = await client.requests[request['id']]('validate').post(payload=request)
     return response
 
 
+@resilient('requests')
 async def update_request(client: AsyncConnectClient, request_id: str, body: Dict):
     return await client.requests[request_id].update(payload=body)
 
 
+@resilient('assets')
+async def get_asset(client: AsyncConnectClient, asset_id: str):
+    return await client.assets[asset_id].get()
+
+
+@resilient('requests', idempotent=False)
 async def create_request(client: AsyncConnectClient, request_type: str, asset_id: str):
     body = {
         'type': request_type,
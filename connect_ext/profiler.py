@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2022, CloudBlue
+# All rights reserved.
+#
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+from typing import Dict, Optional
+
+
+class StackSampler:
+    """
+    Sample the stacks of every thread of the process each ``interval`` seconds until
+    ``duration`` seconds have passed or ``max_events`` invocations have completed.
+    Nothing runs while the sampler is stopped.
+    """
+
+    def __init__(self, duration: float, interval: float, max_events: int = None):
+        self.duration = duration
+        self.interval = interval
+        self.max_events = max_events
+        self.stacks = Counter()
+        self.samples = 0
+        self.events = 0
+        self.started_at = None
+        self.stopped_at = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, name='stack-sampler', daemon=True)
+
+    @property
+    def running(self) -> bool:
+        return self._thread.is_alive()
+
+    def start(self) -> None:
+        self.started_at = datetime.now()
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._thread.join()
+
+    def record_event(self) -> None:
+        self.events += 1
+        if self.max_events and self.events >= self.max_events:
+            self._stop.set()
+
+    def _sample(self) -> None:
+        deadline = time.monotonic() + self.duration
+        own_id = threading.get_ident()
+        while not self._stop.wait(self.interval) and time.monotonic() < deadline:
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id != own_id:
+                    self.stacks[self._collapse(frame)] += 1
+            self.samples += 1
+        self.stopped_at = datetime.now()
+
+    @staticmethod
+    def _collapse(frame) -> str:
+        names = []
+        while frame:
+            names.append(f"{frame.f_globals.get('__name__', '?')}:{frame.f_code.co_name}")
+            frame = frame.f_back
+        return ';'.join(reversed(names))
+
+    def status(self) -> Dict:
+        return {
+            'running': self.running,
+            'started_at': self.started_at,
+            'stopped_at': self.stopped_at,
+            'samples': self.samples,
+            'events': self.events,
+        }
+
+    def report(self) -> str:
+        """Return the samples in the collapsed stack format read by flamegraph tools."""
+        return '\n'.join(f'{stack} {count}' for stack, count in self.stacks.most_common())
+
+
+_sampler: Optional[StackSampler] = None
+
+
+def get_sampler() -> Optional[StackSampler]:
+    return _sampler
+
+
+def start_sampler(duration: float, interval: float, max_events: int = None) -> StackSampler:
+    global _sampler
+    _sampler = StackSampler(duration, interval, max_events)
+    _sampler.start()
+    return _sampler
+
+
+def record_event() -> None:
+    if _sampler is not None and _sampler.running:
+        _sampler.record_event()
@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2022, CloudBlue
+# All rights reserved.
+#
+"""
+Recording of the asset request events handled by the extension, and replay of a
+recording against a fresh database, to benchmark the events pipeline or rebuild the
+tests after a data loss.
+
+    python -m connect_ext.replay events.ndjson.gz --database replay.db --speed 10
+
+The Connect calls of the lifecycle jobs are answered from the recording itself.
+"""
+import argparse
+import asyncio
+import gzip
+import json
+import logging
+import threading
+import time
+from collections import defaultdict, deque
+from typing import Deque, Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+from connect.client import ClientError
+
+from connect_ext.db import DB
+from connect_ext.jobs import JobRunner
+from connect_ext.lifecycle import advance
+from connect_ext.models import DEFAULT_SCENARIO, StepName
+from connect_ext.settings import get_settings
+
+
+logger = logging.getLogger('connect_ext')
+
+
+class RecordedEvent(NamedTuple):
+    # Unix time the event was received at.
+    at: float
+    step: str
+    request: Dict
+    # Scenario of the test, recorded with its purchase event only.
+    scenario: Optional[List[str]] = None
+
+
+class EventRecorder:
+    """Append the events received to a gzipped NDJSON file, one gzip member per event."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.recorded = 0
+        self._lock = threading.Lock()
+
+    def _append(self, line: str) -> None:
+        with self._lock, gzip.open(self.path, 'at', encoding='utf-8') as log:
+            log.write(line)
+        self.recorded += 1
+
+    async def record(self, step: str, request: Dict, scenario: List[str] = None) -> None:
+        """Record the event in the background of the event loop, never failing the caller."""
+        event = {'at': time.time(), 'step': step, 'request': request}
+        if scenario:
+            event['scenario'] = scenario
+        line = json.dumps(event, separators=(',', ':'))
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, self._append, line + '\n')
+        except Exception as e:
+            logger.warning(f'Event {step} {request.get("id")} could not be recorded: {e}')
+
+
+_recorder: Optional[EventRecorder] = None
+
+
+def get_recorder() -> Optional[EventRecorder]:
+    global _recorder
+    path = get_settings().event_record_path
+    if path and (_recorder is None or _recorder.path != path):
+        _recorder = EventRecorder(path)
+    return _recorder if path else None
+
+
+def reset() -> None:
+    global _recorder
+    _recorder = None
+
+
+def load_events(path: str) -> Iterator[RecordedEvent]:
+    with gzip.open(path, 'rt', encoding='utf-8') as log:
+        for line in log:
+            if line.strip():
+                yield RecordedEvent(**json.loads(line))
+
+
+class _Requests:
+    def __init__(self, request_ids: Dict[Tuple[str, str], Deque[str]]):
+        self.request_ids = request_ids
+
+    async def create(self, payload: Dict) -> Dict:
+        request_ids = self.request_ids.get((payload['asset']['id'], payload['type']))
+        if not request_ids:
+            raise ClientError(
+                f"No {payload['type']} request of {payload['asset']['id']} was recorded.",
+                status_code=404,
+            )
+        return {**payload, 'id': request_ids.popleft()}
+
+
+class _Items:
+    def all(self) -> '_Items':
+        return self
+
+    async def first(self) -> Dict:
+        return {'id': 'PRD-000-000-000-0001', 'quantity': 1}
+
+
+class _Product:
+    items = _Items()
+
+
+class ReplayClient:
+    """
+    Stand-in for the Connect client of the lifecycle jobs: the requests they create
+    get the ids of the requests of the same type and asset found in the recording.
+    """
+
+    def __init__(self, events: List[RecordedEvent]):
+        request_ids = defaultdict(deque)
+        for event in events:
+            request_ids[(event.request['asset']['id'], event.step)].append(event.request['id'])
+        self.requests = _Requests(request_ids)
+        self.products = defaultdict(_Product)
+
+
+async def _register_test(db: DB, request: Dict, scenario: List[str]) -> bool:
+    """Register the test of a purchase request as its setup did, if not known yet."""
+    asset = request['asset']
+    test_id, _ = await db.get_test_scenario(asset['id'])
+    if test_id:
+        return True
+    test = await db.create_new_test(
+        object_id=asset['id'],
+        scenario=scenario,
+        hub_id=asset.get('connection', {}).get('hub', {}).get('id'),
+        product_id=asset.get('product', {}).get('id'),
+    )
+    if not test:
+        return False
+    await db.finish_setup(test.id)
+    await db.add_new_step(asset['id'], StepName.purchase.value, request['id'])
+    await db.add_new_step(asset['id'], StepName.adjustment.value)
+    return True
+
+
+async def replay(
+    events: List[RecordedEvent],
+    db: DB,
+    speed: float = 1.0,
+    scenario: List[str] = None,
+) -> Dict:
+    """
+    Handle the recorded ``events`` in order, ``speed`` times faster than they were
+    received or as fast as possible with a speed of 0. Each event is handled once the
+    jobs of the previous one are done, so the replay is deterministic. The tests get
+    the scenario recorded with their purchase, or ``scenario`` for the recordings
+    without one.
+    """
+    client = ReplayClient(events)
+    runner = JobRunner(workers=1, max_attempts=1, lease=get_settings().job_lease_seconds)
+    skipped = 0
+    started = time.monotonic()
+    for event in events:
+        if speed > 0:
+            delay = (event.at - events[0].at) / speed - (time.monotonic() - started)
+            if delay > 0:
+                await asyncio.sleep(delay)
+        if event.step == StepName.purchase.value and not await _register_test(
+            db,
+            event.request,
+            event.scenario or scenario or DEFAULT_SCENARIO,
+        ):
+            skipped += 1
+            continue
+        await advance(db, event.step, event.request)
+        runner.wake(client, db)
+        await asyncio.gather(*runner.tasks)
+    elapsed = time.monotonic() - started
+    return {
+        'events': len(events),
+        'skipped': skipped,
+        'elapsed': elapsed,
+        'events_per_second': len(events) / elapsed if elapsed else None,
+    }
+
+
+def main(argv: List[str] = None) -> None:
+    parser = argparse.ArgumentParser(description='Replay recorded events against a database.')
+    parser.add_argument('log')
+    parser.add_argument('--database', default='replay.db')
+    parser.add_argument('--speed', type=float, default=1.0)
+    parser.add_argument(
+        '--scenario',
+        type=lambda value: value.split(','),
+        help='Comma separated steps of the tests whose scenario was not recorded.',
+    )
+    args = parser.parse_args(argv)
+    events = list(load_events(args.log))
+    result = asyncio.run(
+        replay(events, DB(args.database), speed=args.speed, scenario=args.scenario),
+    )
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == '__main__':  # pragma: no cover
+    main()
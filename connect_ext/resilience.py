@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2022, CloudBlue
+# All rights reserved.
+#
+import asyncio
+import functools
+import random
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Dict, Optional
+
+from connect.client import ClientError
+
+from connect_ext.deadline import check_deadline, DeadlineExceeded, remaining
+from connect_ext.settings import get_settings
+
+
+class CircuitOpenError(ClientError):
+    pass
+
+
+class CircuitBreaker:
+    """
+    Fail fast once ``failure_threshold`` consecutive calls failed, letting a single
+    trial call through after ``reset_timeout`` seconds.
+    """
+
+    def __init__(self, name: str, failure_threshold: int, reset_timeout: float):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return 'half_open'
+        return 'open'
+
+    def before_call(self) -> None:
+        if self.state == 'open':
+            raise CircuitOpenError(
+                f'Circuit for {self.name} is open, Connect calls are suspended.',
+                status_code=503,
+            )
+        if self.state == 'half_open':
+            # Only one trial call, the others keep failing fast until it succeeds.
+            self.opened_at = time.monotonic()
+
+    def record_success(self) -> None:
+        self.failures = 0
+        self.opened_at = None
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        if self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+
+
+_breakers: Dict[str, CircuitBreaker] = {}
+
+
+def get_breaker(endpoint: str) -> CircuitBreaker:
+    if endpoint not in _breakers:
+        settings = get_settings()
+        _breakers[endpoint] = CircuitBreaker(
+            endpoint,
+            settings.circuit_failure_threshold,
+            settings.circuit_reset_timeout,
+        )
+    return _breakers[endpoint]
+
+
+def reset() -> None:
+    _breakers.clear()
+
+
+def _is_server_error(error: ClientError) -> bool:
+    return error.status_code is None or error.status_code >= 500
+
+
+def _is_retryable(error: ClientError, idempotent: bool) -> bool:
+    if error.status_code == 429:
+        return True
+    # A 5xx or a network error on a non idempotent call may have been processed already.
+    return idempotent and _is_server_error(error)
+
+
+def _get_retry_after(client) -> Optional[float]:
+    response = getattr(client, 'response', None)
+    value = response.headers.get('Retry-After') if response is not None else None
+    if not isinstance(value, str) or not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+
+def get_backoff_delay(attempt: int, retry_after: float = None) -> float:
+    settings = get_settings()
+    if retry_after is not None:
+        return min(retry_after, settings.retry_backoff_max)
+    ceiling = min(settings.retry_backoff_max, settings.retry_backoff_base * 2 ** attempt)
+    return random.uniform(0, ceiling)
+
+
+def resilient(endpoint: str, idempotent: bool = True):
+    """
+    Retry the decorated operation with jittered exponential backoff on throttling and
+    server errors, behind the circuit breaker of ``endpoint``.
+    The Connect client must be the first argument of the operation.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(client, *args, **kwargs):
+            breaker = get_breaker(endpoint)
+            max_attempts = get_settings().retry_max_attempts
+            attempt = 0
+            while True:
+                check_deadline(func.__name__)
+                breaker.before_call()
+                try:
+                    result = await func(client, *args, **kwargs)
+                except DeadlineExceeded:
+                    raise
+                except ClientError as error:
+                    if not _is_retryable(error, idempotent):
+                        # Connect answered a client error, a server error is not retried
+                        # in case it was processed but still counts against Connect.
+                        if _is_server_error(error):
+                            breaker.record_failure()
+                        else:
+                            breaker.record_success()
+                        raise
+                    breaker.record_failure()
+                    attempt += 1
+                    if attempt >= max_attempts or breaker.state == 'open':
+                        raise
+                    delay = get_backoff_delay(attempt, _get_retry_after(client))
+                    budget = remaining()
+                    if budget is not None and delay >= budget:
+                        raise DeadlineExceeded(func.__name__) from error
+                    await asyncio.sleep(delay)
+                else:
+                    breaker.record_success()
+                    return result
+        return wrapper
+    return decorator
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2022, CloudBlue
+# All rights reserved.
+#
+import asyncio
+import gzip
+import json
+from datetime import datetime, timedelta
+from typing import Dict, List
+
+from connect_ext.settings import get_settings
+
+
+def _append_ndjson(path: str, tests: List[Dict]) -> None:
+    # Each call appends a gzip member, gzip readers decompress them as one stream.
+    with gzip.open(path, 'at', encoding='utf-8') as archive:
+        for test in tests:
+            archive.write(json.dumps(test) + '\n')
+
+
+async def apply_retention(db) -> Dict:
+    """
+    Archive finished tests older than the retention window, or beyond the amount of
+    tests to keep, in small batches so writers are never blocked for long, then
+    reclaim the freed pages of the database file.
+    """
+    settings = get_settings()
+    before = None
+    if settings.retention_max_age_days:
+        before = datetime.now() - timedelta(days=settings.retention_max_age_days)
+    archived = 0
+    for _ in range(settings.retention_max_batches):
+        tests = await db.archive_tests(
+            before,
+            settings.retention_max_count,
+            settings.retention_batch_size,
+        )
+        if tests and settings.retention_archive_path:
+            await asyncio.get_running_loop().run_in_executor(
+                None,
+                _append_ndjson,
+                settings.retention_archive_path,
+                tests,
+            )
+        archived += len(tests)
+        if len(tests) < settings.retention_batch_size:
+            break
+    await db.vacuum(settings.retention_vacuum_pages)
+    return {'archived': archived}
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2022, CloudBlue
+# All rights reserved.
+#
+from typing import Dict, List, Optional
+
+from pydantic import BaseSettings
+
+from connect_ext.models import MonitorTarget
+
+
+class Settings(BaseSettings):
+    """Tuning knobs of the extension, read from environment variables of the same name."""
+
+    retry_max_attempts: int = 4
+    retry_backoff_base: float = 0.5
+    retry_backoff_max: float = 30.0
+    circuit_failure_threshold: int = 5
+    circuit_reset_timeout: float = 30.0
+    rate_limit_per_second: float = 10.0
+    rate_limit_burst: int = 20
+    rate_limit_families: Dict[str, float] = {
+        'requests': 5.0,
+        'marketplaces': 2.0,
+        'listings': 2.0,
+        'hubs': 2.0,
+    }
+    retention_max_age_days: Optional[int] = 90
+    retention_max_count: Optional[int] = None
+    retention_batch_size: int = 50
+    retention_max_batches: int = 20
+    retention_archive_path: Optional[str] = None
+    retention_vacuum_pages: int = 500
+    database_path: str = 'data.db'
+    db_busy_timeout: float = 5.0
+    db_group_commit: bool = False
+    db_group_commit_interval: float = 0.005
+    db_group_commit_max_ops: int = 50
+    slow_call_threshold: float = 2.0
+    slow_call_sample_rate: float = 1.0
+    http_max_connections: int = 20
+    http_max_keepalive_connections: int = 10
+    http_keepalive_expiry: float = 30.0
+    http2: bool = False
+    start_test_timeout: float = 60.0
+    setup_workers: int = 2
+    sla_default_seconds: float = 120.0
+    sla_step_seconds: Dict[str, float] = {}
+    sla_hub_step_seconds: Dict[str, Dict[str, float]] = {}
+    test_setup_lease_seconds: float = 120.0
+    event_concurrency: int = 10
+    event_queue_size: int = 50
+    event_reschedule_countdown: int = 60
+    event_record_path: Optional[str] = None
+    job_workers: int = 2
+    job_max_attempts: int = 5
+    job_lease_seconds: float = 300.0
+    monitor_targets: List[MonitorTarget] = []
+    monitor_jitter: float = 0.1
+    alert_consecutive_failures: int = 3
+    alert_step_latency_seconds: Dict[str, float] = {}
+    alert_latency_percentile: float = 95.0
+    alert_min_samples: int = 5
+    alert_window: int = 50
+    alert_cooldown_seconds: float = 3600.0
+    alert_queue_size: int = 100
+    alert_webhook_url: Optional[str] = None
+    alert_webhook_timeout: float = 10.0
+    health_window: int = 100
+    health_max_outbound_error_rate: float = 0.5
+    health_max_db_pending: int = 100
+    health_cache_seconds: float = 5.0
+
+
+settings = None
+
+
+def get_settings() -> Settings:
+    global settings
+    if settings is None:
+        settings = Settings()
+    return settings
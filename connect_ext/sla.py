@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2022, CloudBlue
+# All rights reserved.
+#
+from typing import Optional
+
+from connect_ext.settings import get_settings
+
+
+def get_sla_seconds(hub_id: Optional[str], step: str) -> float:
+    """
+    Return the seconds allowed to the ``step`` requests of ``hub_id`` to be approved:
+    the threshold of the hub for the step, else the one of the step, else the default.
+    """
+    settings = get_settings()
+    hub_thresholds = settings.sla_hub_step_seconds.get(hub_id, {}) if hub_id else {}
+    if step in hub_thresholds:
+        return hub_thresholds[step]
+    return settings.sla_step_seconds.get(step, settings.sla_default_seconds)
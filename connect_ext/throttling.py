@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2022, CloudBlue
+# All rights reserved.
+#
+import asyncio
+import time
+from typing import Dict, Optional
+
+from connect_ext.settings import get_settings
+
+
+class TokenBucket:
+    """Allow ``rate`` calls per second on average with bursts of up to ``burst`` calls."""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated_at = time.monotonic()
+        self.waiting = 0
+        self.acquired = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    async def acquire(self) -> None:
+        if self.rate <= 0:
+            return
+        started = time.monotonic()
+        self.waiting += 1
+        try:
+            while True:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    break
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+        finally:
+            self.waiting -= 1
+        waited = time.monotonic() - started
+        self.acquired += 1
+        self.total_wait += waited
+        self.max_wait = max(self.max_wait, waited)
+
+    def stats(self) -> Dict:
+        return {
+            'rate': self.rate,
+            'burst': self.burst,
+            'queue_depth': self.waiting,
+            'acquired': self.acquired,
+            'avg_wait': self.total_wait / self.acquired if self.acquired else 0.0,
+            'max_wait': self.max_wait,
+        }
+
+
+class RateLimiter:
+    """
+    Token buckets shared by every outbound Connect call: a global one and one per
+    endpoint family, the family being the first segment of the API path.
+    """
+
+    def __init__(self, rate: float, burst: int, families: Dict[str, float]):
+        self.bucket = TokenBucket(rate, burst)
+        self.families = {
+            family: TokenBucket(family_rate, max(1, int(family_rate)))
+            for family, family_rate in families.items()
+        }
+
+    @staticmethod
+    def get_family(path: str) -> str:
+        return path.lstrip('/').split('/', 1)[0].split('?', 1)[0]
+
+    async def acquire(self, path: str) -> None:
+        family = self.families.get(self.get_family(path))
+        if family:
+            await family.acquire()
+        await self.bucket.acquire()
+
+    def stats(self) -> Dict:
+        return {
+            'global': self.bucket.stats(),
+            'families': {name: bucket.stats() for name, bucket in self.families.items()},
+        }
+
+
+_rate_limiter: Optional[RateLimiter] = None
+
+
+def get_rate_limiter() -> RateLimiter:
+    global _rate_limiter
+    if _rate_limiter is None:
+        settings = get_settings()
+        _rate_limiter = RateLimiter(
+            settings.rate_limit_per_second,
+            settings.rate_limit_burst,
+            settings.rate_limit_families,
+        )
+    return _rate_limiter
+
+
+def reset() -> None:
+    global _rate_limiter
+    _rate_limiter = None
@@ -3,29 +3,51 @@
 # Copyright (c) 2022, CloudBlue
 # All rights reserved.
 #
-from typing import List, Union
+import asyncio
+import functools
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple, Union
 from logging import LoggerAdapter
 
 from fastapi import Depends, status
-from fastapi.responses import JSONResponse
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from connect.eaas.core.decorators import (
     router,
     web_app,
 )
 from connect.eaas.core.extension import WebApplicationBase
 from connect.eaas.core.inject.common import get_logger
-from connect.eaas.core.inject.asynchronous import get_extension_client
 from connect.client import AsyncConnectClient
 
-from connect_ext.models import ErrorResponse, ResultType, TestRequest, TstInstance
+from connect_ext.alerts import get_notifier, notify_finished
+from connect_ext.backpressure import get_event_gate_stats
+from connect_ext.client import get_client
+from connect_ext.models import (
+    DEFAULT_SCENARIO,
+    ErrorResponse,
+    ExportFormat,
+    HubStats,
+    ProfilerRequest,
+    ProfilerStatus,
+    ResultType,
+    Step,
+    TestRequest,
+    TstInstance,
+)
 from connect_ext.decorators import safe_client
 from connect_ext.db import get_db
-from connect_ext.operations import (
-    change_draft_to_pending,
-    create_draft_request,
-    get_request_by_id,
-    validate_request,
-)
+from connect_ext.deadline import DeadlineExceeded
+from connect_ext.health import get_outbound_errors
+from connect_ext.instrumentation import instrumented, measure
+from connect_ext.lifecycle import run_setup
+from connect_ext.monitoring import get_monitor
+from connect_ext.operations import get_request_by_id
+from connect_ext.profiler import get_sampler, start_sampler
+from connect_ext.settings import get_settings
+from connect_ext.sla import get_sla_seconds
+from connect_ext.throttling import get_rate_limiter
+from connect_ext.workers import get_setup_pool
 
 
 ERROR_RESPONSE_DICT = {
@@ -40,77 +62,264 @@ ERROR_RESPONSE_DICT = {
 }
 
 
+def _is_due(test: TstInstance, step: Step, now: datetime) -> bool:
+    sla_seconds = step.sla_seconds
+    if sla_seconds is None:
+        sla_seconds = get_sla_seconds(test.hub_id, step.name)
+    return step.created_at + timedelta(seconds=sla_seconds) <= now
+
+
+def _finished_snapshot(
+    test: TstInstance,
+    approved: List[Tuple[str, str]],
+    result: ResultType,
+    now: datetime,
+) -> TstInstance:
+    """The ``test`` snapshot with the writes of ``DB.finish_check`` applied."""
+    approved = set(approved)
+    steps = []
+    breaches = 0
+    for step in test.steps or []:
+        if (step.name, step.object_id) in approved and not step.checked:
+            update = {'checked': True, 'checked_at': now}
+            if step.sla_seconds is not None:
+                margin = step.sla_seconds - (now - step.created_at).total_seconds()
+                update.update(sla_met=margin >= 0, sla_margin=margin)
+                breaches += margin < 0
+            step = step.copy(update=update)
+        steps.append(step)
+    return test.copy(
+        update={
+            'running': False,
+            'result': result,
+            'done_at': now,
+            'steps_checked': (test.steps_checked or 0) + len(approved),
+            'sla_breaches': (test.sla_breaches or 0) + breaches,
+            'total_duration': (now - test.created_at).total_seconds(),
+            'steps': steps,
+        },
+    )
+
+
 @web_app(router)
 class TstWebApplication(WebApplicationBase):
 
     @router.post(
         '/tests',
         summary="Create and start test",
-        description="This endpoint creates a new test. Only 1 test could be run at the same time.",
+        description=(
+            "This endpoint creates a new test. Only 1 test could be run at the same time. "
+            "With background set to true the test is registered and returned right away "
+            "with a 202 status, its setup_status tells when it has been set up."
+        ),
         status_code=status.HTTP_201_CREATED,
         response_model=Union[TstInstance, ErrorResponse],
         responses=ERROR_RESPONSE_DICT,
     )
+    @instrumented
     @safe_client()
     async def start_test(
         self,
         request: TestRequest,
+        background: bool = False,
         logger: LoggerAdapter = Depends(get_logger),
         db: any = Depends(get_db),
-        client: AsyncConnectClient = Depends(get_extension_client),
+        client: AsyncConnectClient = Depends(get_client),
     ):
-        product_id = request.product_id
-        hub_id = request.hub_id
-        logger.info(f'CLIENT CLASS ->{type(client)}')
-        logger.info(f'DB CLASS ->{db}')
-
         if not await db.is_idle():
             error = {'detail': 'Test still running. Wait a second or call /tests/{id}/check.'}
             logger.info(error)
             return JSONResponse(content=error, status_code=status.HTTP_400_BAD_REQUEST)
 
-        account_id = (await client.accounts.all().first())['id']
-
-        r = await create_draft_request(
-            client,
-            'production',
-            account_id,
-            product_id,
-            hub_id,
+        test = await db.create_new_test(
+            object_id=None,
+            scenario=request.scenario,
+            hub_id=request.hub_id,
+            product_id=request.product_id,
         )
-        request_id = r['id']
-        logger.info(r)
-
-        r = await get_request_by_id(client, request_id)
-        await validate_request(client, r)
-        asset_id = r['asset']['id']
-        test = await db.create_new_test(object_id=asset_id)
         if not test:
             error = {'detail': 'Test still running.'}
             logger.info(error)
             return JSONResponse(content=error, status_code=status.HTTP_400_BAD_REQUEST)
 
-        await change_draft_to_pending(client, request_id)
-        await db.add_new_step(asset_id, 'purchase', r['id'])
-        await db.add_new_step(asset_id, 'adjustment')
-        test = await db.get_test(test.id)
-        return test
+        progress = {'stage': None, 'test_id': test.id}
+        if background:
+            get_setup_pool().submit(
+                functools.partial(run_setup, client, db, request, progress, logger),
+            )
+            return JSONResponse(
+                content=jsonable_encoder(test),
+                status_code=status.HTTP_202_ACCEPTED,
+            )
+        try:
+            return await run_setup(client, db, request, progress, logger)
+        except DeadlineExceeded as e:
+            return JSONResponse(
+                content={'detail': str(e), 'partial_state': progress},
+                status_code=status.HTTP_504_GATEWAY_TIMEOUT,
+            )
 
     @router.get(
         '/tests',
         summary="List tests",
-        description="This endpoint return the test list.",
+        description=(
+            "This endpoint return the test list. Set include_steps to false to only get "
+            "the summary of each test."
+        ),
         response_model=Union[List[TstInstance], ErrorResponse],
         responses=ERROR_RESPONSE_DICT,
 
     )
+    @instrumented
     @safe_client()
     async def get_test_list(
         self,
+        include_steps: bool = True,
+        db: any = Depends(get_db),
+        logger: LoggerAdapter = Depends(get_logger),
+    ):
+        return await db.list_tests(include_steps=include_steps)
+
+    @router.get(
+        '/tests/export',
+        summary="Export tests",
+        description=(
+            "This endpoint streams one row per step of the tests created in the given "
+            "time range, optionally filtered by hub, as CSV or as an Arrow IPC stream. "
+            "Parquet files are produced by the connect_ext.export command."
+        ),
+        responses=ERROR_RESPONSE_DICT,
+    )
+    @instrumented
+    @safe_client()
+    async def export_tests(
+        self,
+        format: ExportFormat = ExportFormat.csv,
+        since: Optional[datetime] = None,
+        until: Optional[datetime] = None,
+        hub_id: Optional[str] = None,
+        db: any = Depends(get_db),
+        logger: LoggerAdapter = Depends(get_logger),
+    ):
+        # Loads pyarrow, which would slow down the start of the extension.
+        from connect_ext.export import check_format, iter_arrow, iter_csv, UnsupportedFormatError
+
+        try:
+            check_format(format)
+        except UnsupportedFormatError as e:
+            return JSONResponse(
+                content={'detail': str(e)},
+                status_code=status.HTTP_400_BAD_REQUEST,
+            )
+        if format == ExportFormat.parquet:
+            return JSONResponse(
+                content={'detail': 'Parquet files cannot be streamed, use connect_ext.export.'},
+                status_code=status.HTTP_400_BAD_REQUEST,
+            )
+        batches = db.export_batches(since=since, until=until, hub_id=hub_id)
+        if format == ExportFormat.arrow:
+            return StreamingResponse(
+                iter_arrow(batches),
+                media_type='application/vnd.apache.arrow.stream',
+            )
+        return StreamingResponse(
+            iter_csv(batches),
+            media_type='text/csv',
+            headers={'Content-Disposition': 'attachment; filename="tests.csv"'},
+        )
+
+    @router.get(
+        '/analytics',
+        summary="Get analytics report",
+        description=(
+            "This endpoint returns the duration percentiles of each step per hub, the "
+            "steps slower than k times the median of the same step on their hub and the "
+            "rolling step durations and success rate of the tests per hub, over the "
+            "window_buckets time buckets up to each bucket."
+        ),
+        responses=ERROR_RESPONSE_DICT,
+    )
+    @instrumented
+    @safe_client()
+    async def get_analytics(
+        self,
+        since: Optional[datetime] = None,
+        until: Optional[datetime] = None,
+        hub_id: Optional[str] = None,
+        k: float = 3.0,
+        bucket_hours: float = 24.0,
+        window_buckets: int = 7,
         db: any = Depends(get_db),
         logger: LoggerAdapter = Depends(get_logger),
     ):
-        return await db.list_tests()
+        # Loads numpy, which would slow down the start of the extension.
+        from connect_ext.analytics import AnalyticsUnavailableError, build_report, check_numpy
+
+        try:
+            check_numpy()
+        except AnalyticsUnavailableError as e:
+            return JSONResponse(
+                content={'detail': str(e)},
+                status_code=status.HTTP_400_BAD_REQUEST,
+            )
+        with measure('db'):
+            return await asyncio.get_running_loop().run_in_executor(
+                None,
+                functools.partial(
+                    build_report,
+                    db,
+                    since=since,
+                    until=until,
+                    hub_id=hub_id,
+                    k=k,
+                    bucket_hours=bucket_hours,
+                    window_buckets=window_buckets,
+                ),
+            )
+
+    @router.get(
+        '/hubs/stats',
+        summary="List hub statistics",
+        description=(
+            "This endpoint returns, for each hub, the amount of tests, their success rate, "
+            "the average duration of the successful ones and the last failure."
+        ),
+        response_model=Union[List[HubStats], ErrorResponse],
+        responses=ERROR_RESPONSE_DICT,
+    )
+    @instrumented
+    @safe_client()
+    async def get_hubs_stats(
+        self,
+        since: Optional[datetime] = None,
+        db: any = Depends(get_db),
+        logger: LoggerAdapter = Depends(get_logger),
+    ):
+        return await db.get_hub_stats(since=since)
+
+    @router.get(
+        '/hubs/{hub_id}/stats',
+        summary="Get hub statistics",
+        description="This endpoint returns the statistics of the tests of a hub.",
+        response_model=Union[HubStats, ErrorResponse],
+        responses=ERROR_RESPONSE_DICT,
+    )
+    @instrumented
+    @safe_client()
+    async def get_hub_stats(
+        self,
+        hub_id: str,
+        since: Optional[datetime] = None,
+        db: any = Depends(get_db),
+        logger: LoggerAdapter = Depends(get_logger),
+    ):
+        stats = await db.get_hub_stats(since=since, hub_id=hub_id)
+        if stats:
+            return stats[0]
+        return JSONResponse(
+            content={'detail': f'there are no tests for the hub {hub_id}'},
+            status_code=status.HTTP_404_NOT_FOUND,
+        )
 
     @router.get(
         '/tests/{id}',
@@ -119,6 +328,7 @@ class TstWebApplication(WebApplicationBase):
         response_model=Union[TstInstance, ErrorResponse],
         responses=ERROR_RESPONSE_DICT,
     )
+    @instrumented
     @safe_client()
     async def get_test(
         self,
@@ -141,49 +351,199 @@ class TstWebApplication(WebApplicationBase):
         response_model=TstInstance,
         responses=ERROR_RESPONSE_DICT,
     )
+    @instrumented
     @safe_client()
     async def check_test(
         self,
         id,
         db: any = Depends(get_db),
         logger: LoggerAdapter = Depends(get_logger),
-        client: AsyncConnectClient = Depends(get_extension_client),
+        client: AsyncConnectClient = Depends(get_client),
     ):
         test = await db.get_test(id)
-        error = None
-        status_code = status.HTTP_400_BAD_REQUEST
         if not test:
             error = f'test with id {id} does not exist.'
-            status_code = status.HTTP_404_NOT_FOUND
-        elif not test.running:
+            logger.info(error)
+            return JSONResponse(content={'detail': error}, status_code=status.HTTP_404_NOT_FOUND)
+        if not test.running:
             return test
-        else:
-            requests = await db.get_steps_to_check(test_id=id)
-            logger.info(f'check_request_status {requests}')
-            for r in requests:
-                logger.info(f'check_request_status {r}')
-                request = await get_request_by_id(client, r[0])
-                if request['status'] != 'approved':
-                    error = (
-                        f"The {request['type']} {r[0]} is in {request['status']} "
-                        f"status instead of approved.",
-                    )
-                    break
-                else:
-                    await db.check_step(id, r[0])
-
-            if not error:
-                steps_done = await db.get_step_count(id)
-                if steps_done != 6:
-                    test = await db.get_test(id)
-                    error = f'The step {test.steps[steps_done-1].name} has not finished!'
-
-            logger.info('The check process has been done!!')
 
+        # Only the requests of the steps past their threshold are polled, the approved
+        # steps of the test are final and the more recent ones are left to their events.
+        now = datetime.now()
+        error = None
+        approved = []
+        for step in test.steps or []:
+            if step.checked or not step.object_id or not _is_due(test, step, now):
+                continue
+            logger.debug(f'check_request_status {step.object_id}')
+            request = await get_request_by_id(client, step.object_id)
+            if request['status'] != 'approved':
+                error = (
+                    f"The {request['type']} {step.object_id} is in {request['status']} "
+                    f"status instead of approved."
+                )
+                break
+            approved.append((step.name, step.object_id))
+
+        if not error:
+            steps_done = (test.steps_checked or 0) + len(approved)
+            scenario = test.scenario or DEFAULT_SCENARIO
+            if steps_done < len(scenario):
+                error = f'The step {scenario[steps_done]} has not finished!'
+
+        result = ResultType.failed if error else ResultType.success
+        if await db.finish_check(id, approved, result.value, now):
+            test = _finished_snapshot(test, approved, result, now)
+        else:
+            # Finished meanwhile by its events, the stored result is the one reported.
+            test = await db.get_test(id)
+        await notify_finished(db, test.id, test)
         if error:
-            await db.set_test_result(id, ResultType.failed.value)
             logger.info(error)
-            return JSONResponse(content={'detail': error}, status_code=status_code)
-        else:
-            await db.set_test_result(id, ResultType.success.value)
-            return await db.get_test(id)
+            return JSONResponse(
+                content={'detail': error},
+                status_code=status.HTTP_400_BAD_REQUEST,
+            )
+        return test
+
+    @router.get(
+        '/rate-limits',
+        summary="Outbound rate limits",
+        description=(
+            "This endpoint returns the queue depth and wait times of the rate limiter "
+            "applied to the calls made to Connect."
+        ),
+        response_model=Dict,
+    )
+    @instrumented
+    async def get_rate_limits(self):
+        return get_rate_limiter().stats()
+
+    @router.get(
+        '/event-gates',
+        summary="Event concurrency",
+        description=(
+            "This endpoint returns, per event type, the events being handled, the ones "
+            "waiting for a slot and the ones rescheduled because the queue was full."
+        ),
+        response_model=Dict,
+    )
+    @instrumented
+    async def get_event_gates(self):
+        return get_event_gate_stats()
+
+    @router.get(
+        '/health',
+        summary="Health",
+        description=(
+            "This endpoint returns 200 while the extension is healthy and 503 while too "
+            "many database calls are pending. The error rate of the calls to Connect is "
+            "reported without failing the probe. The running tests are read from the "
+            "database at most every few seconds."
+        ),
+        response_model=Dict,
+    )
+    async def get_health(self, db: any = Depends(get_db)):
+        settings = get_settings()
+        problems = []
+        if db.health.db_pending > settings.health_max_db_pending:
+            problems.append(f'{db.health.db_pending} database calls pending.')
+        # An outage of Connect is shared by every replica, it must not take them all
+        # out of the load balancer.
+        error_rate = get_outbound_errors().rate()
+        tests = await db.get_tests_summary()
+        return JSONResponse(
+            content={
+                'status': 'degraded' if problems else 'ok',
+                'running_tests': tests['running_tests'],
+                'problems': problems,
+                'connect_degraded': error_rate > settings.health_max_outbound_error_rate,
+            },
+            status_code=(
+                status.HTTP_503_SERVICE_UNAVAILABLE if problems else status.HTTP_200_OK
+            ),
+        )
+
+    @router.get(
+        '/status',
+        summary="Status",
+        description=(
+            "This endpoint returns the running tests, the last result of each hub, the "
+            "database latency and pending calls, the error rate of the calls to Connect "
+            "and the state of the queues of the extension. The tests are read from the "
+            "database at most every few seconds, the rest from counters kept in memory."
+        ),
+        response_model=Dict,
+    )
+    @instrumented
+    async def get_status(self, db: any = Depends(get_db)):
+        return {
+            **await db.get_tests_summary(),
+            'db': {
+                **db.health.stats(),
+                'writer_queue': len(db.writer.queue) if db.writer else 0,
+            },
+            'outbound': get_outbound_errors().stats(),
+            'setup_workers': get_setup_pool().stats(),
+            'event_gates': get_event_gate_stats(),
+            'rate_limits': get_rate_limiter().stats(),
+            'alerts': get_notifier().stats(),
+            'monitoring': get_monitor().stats(),
+        }
+
+    @router.post(
+        '/admin/profiler',
+        summary="Start profiler",
+        description=(
+            "This endpoint starts sampling the stacks of the extension process for the "
+            "given amount of seconds or until the given amount of route calls and events "
+            "have been processed."
+        ),
+        status_code=status.HTTP_202_ACCEPTED,
+        response_model=Union[ProfilerStatus, ErrorResponse],
+        responses=ERROR_RESPONSE_DICT,
+    )
+    async def start_profiler(self, request: ProfilerRequest):
+        sampler = get_sampler()
+        if sampler and sampler.running:
+            return JSONResponse(
+                content={'detail': 'The profiler is already running.'},
+                status_code=status.HTTP_400_BAD_REQUEST,
+            )
+        return start_sampler(request.seconds, request.interval, request.events).status()
+
+    @router.get(
+        '/admin/profiler',
+        summary="Get profiler status",
+        description="This endpoint returns the status of the last profiling session.",
+        response_model=Union[ProfilerStatus, ErrorResponse],
+        responses=ERROR_RESPONSE_DICT,
+    )
+    async def get_profiler_status(self):
+        sampler = get_sampler()
+        if not sampler:
+            return JSONResponse(
+                content={'detail': 'The profiler has not been started.'},
+                status_code=status.HTTP_404_NOT_FOUND,
+            )
+        return sampler.status()
+
+    @router.get(
+        '/admin/profiler/report',
+        summary="Get profiler report",
+        description=(
+            "This endpoint returns the samples of the last profiling session in the "
+            "collapsed stack format used to build flame graphs."
+        ),
+        response_class=PlainTextResponse,
+        responses=ERROR_RESPONSE_DICT,
+    )
+    async def get_profiler_report(self):
+        sampler = get_sampler()
+        if not sampler:
+            return JSONResponse(
+                content={'detail': 'The profiler has not been started.'},
+                status_code=status.HTTP_404_NOT_FOUND,
+            )
+        return PlainTextResponse(sampler.report())
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2022, CloudBlue
+# All rights reserved.
+#
+import asyncio
+import contextvars
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from connect_ext.settings import get_settings
+
+
+class WorkerPool:
+    """
+    Run submitted jobs in the background with at most ``size`` of them at once.
+    Workers are started on the running event loop when the first job is submitted, in
+    a context of their own: they do not inherit the deadline or the instrumentation of
+    the route or event that started them. Jobs log their own failures, the pool only
+    counts them.
+    """
+
+    def __init__(self, name: str, size: int):
+        self.name = name
+        self.size = size
+        self.queue: Optional[asyncio.Queue] = None
+        self.workers: List[asyncio.Task] = []
+        self.completed = 0
+        self.failed = 0
+        self._loop = None
+
+    def submit(self, job: Callable[[], Awaitable]) -> None:
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            # Workers of a previous event loop are gone with it.
+            self._loop = loop
+            self.queue = asyncio.Queue()
+            self.workers = [
+                contextvars.Context().run(
+                    loop.create_task,
+                    self._work(),
+                    name=f'{self.name}-{index}',
+                )
+                for index in range(self.size)
+            ]
+        self.queue.put_nowait(job)
+
+    async def _work(self) -> None:
+        while True:
+            job = await self.queue.get()
+            try:
+                await job()
+                self.completed += 1
+            except Exception:
+                self.failed += 1
+            finally:
+                self.queue.task_done()
+
+    async def join(self) -> None:
+        """Wait until every submitted job has been run."""
+        if self.queue is not None:
+            await self.queue.join()
+
+    def stats(self) -> Dict:
+        return {
+            'size': self.size,
+            'queued': self.queue.qsize() if self.queue else 0,
+            'completed': self.completed,
+            'failed': self.failed,
+        }
+
+
+_setup_pool: Optional[WorkerPool] = None
+
+
+def get_setup_pool() -> WorkerPool:
+    global _setup_pool
+    if _setup_pool is None:
+        _setup_pool = WorkerPool('test-setup', get_settings().setup_workers)
+    return _setup_pool
+
+
+def reset() -> None:
+    global _setup_pool
+    _setup_pool = None
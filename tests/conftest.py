@@ -8,6 +8,18 @@ import os
 import pytest
 from connect.client import AsyncConnectClient, ConnectClient
 
+from connect_ext import (
+    alerts,
+    backpressure,
+    client,
+    health,
+    jobs,
+    monitoring,
+    replay,
+    resilience,
+    throttling,
+    workers,
+)
 from connect_ext.db import DB
 
 
@@ -37,6 +49,31 @@ def db(mocker):
     yield mocker.patch('connect_ext.db.db', DB(':memory:'))
 
 
+@pytest.fixture(autouse=True)
+def reset_resilience():
+    alerts.reset()
+    backpressure.reset()
+    resilience.reset()
+    throttling.reset()
+    client.reset()
+    workers.reset()
+    jobs.reset()
+    monitoring.reset()
+    health.reset()
+    replay.reset()
+    yield
+    alerts.reset()
+    backpressure.reset()
+    resilience.reset()
+    throttling.reset()
+    client.reset()
+    workers.reset()
+    jobs.reset()
+    monitoring.reset()
+    health.reset()
+    replay.reset()
+
+
 @pytest.fixture(autouse=True)
 def patch_api_key(mocker):
     mocker.patch.dict(os.environ, {'API_KEY': 'ApiKey API_KEY'})
@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2022, CloudBlue
+# All rights reserved.
+#
+import asyncio
+import json
+import threading
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import httpx
+import pytest
+
+from connect_ext.alerts import (
+    ConsecutiveFailuresRule,
+    get_notifier,
+    Notifier,
+    notify_finished,
+    RollingStats,
+    StepLatencyRule,
+    webhook_sink,
+)
+from connect_ext.models import Step, TstInstance
+from connect_ext.settings import Settings
+
+
+def _test(result='failed', hub_id='HB-1', **durations):
+    now = datetime.now()
+    return TstInstance(
+        id=1,
+        result=result,
+        hub_id=hub_id,
+        steps=[
+            Step(
+                name=name,
+                created_at=now - timedelta(seconds=duration),
+                checked=True,
+                checked_at=now,
+            )
+            for name, duration in durations.items()
+        ],
+    )
+
+
+@pytest.fixture
+def webhook_server():
+    received = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):  # noqa: N802
+            received.append(json.loads(self.rfile.read(int(self.headers['Content-Length']))))
+            self.send_response(204)
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{server.server_port}/alerts', received
+    server.shutdown()
+    server.server_close()
+
+
+def test_rolling_stats():
+    stats = RollingStats(window=3)
+    for duration in (10, 20, 30, 40):
+        stats.update(_test('failed', purchase=duration))
+
+    assert stats.consecutive_failures['HB-1'] == 4
+    assert stats.percentile('HB-1', 'purchase', 50) == (pytest.approx(30, abs=0.1), 3)
+    assert stats.percentile('HB-1', 'purchase', 95) == (pytest.approx(40, abs=0.1), 3)
+
+    stats.update(_test('success'))
+    assert stats.consecutive_failures['HB-1'] == 0
+
+
+@pytest.mark.asyncio
+async def test_consecutive_failures_with_cooldown():
+    sent = []
+
+    async def sink(alert):
+        sent.append(alert)
+
+    notifier = Notifier([ConsecutiveFailuresRule(2)], [sink], 10, cooldown=60, queue_size=10)
+
+    assert notifier.observe(_test()) == []
+    assert [alert.value for alert in notifier.observe(_test())] == [2]
+    assert notifier.observe(_test()) == []
+    assert notifier.observe(_test(hub_id='HB-2')) == []
+    await notifier.join()
+
+    assert [alert.hub_id for alert in sent] == ['HB-1']
+    assert notifier.stats() == {'sent': 1, 'suppressed': 1, 'dropped': 0, 'failed': 0, 'queued': 0}
+
+
+@pytest.mark.asyncio
+async def test_step_latency():
+    notifier = Notifier(
+        [StepLatencyRule({'purchase': 100}, percentile=95, min_samples=3)],
+        [],
+        10,
+        cooldown=0,
+        queue_size=10,
+    )
+
+    assert notifier.observe(_test('success', purchase=500)) == []
+    assert notifier.observe(_test('success', purchase=50, change=500)) == []
+    alerts = notifier.observe(_test('success', purchase=50))
+
+    assert [(alert.step, alert.threshold) for alert in alerts] == [('purchase', 100)]
+    assert alerts[0].value == pytest.approx(500, abs=0.1)
+
+
+@pytest.mark.asyncio
+async def test_alert_storm_dropped():
+    release = asyncio.Event()
+
+    async def slow_sink(alert):
+        await release.wait()
+
+    notifier = Notifier([ConsecutiveFailuresRule(1)], [slow_sink], 10, cooldown=0, queue_size=2)
+    for _ in range(5):
+        notifier.observe(_test())
+    release.set()
+    await notifier.join()
+
+    assert notifier.stats()['dropped'] == 3
+    assert notifier.stats()['sent'] == 2
+
+
+@pytest.mark.asyncio
+async def test_webhook_sink(webhook_server):
+    url, received = webhook_server
+    notifier = Notifier(
+        [ConsecutiveFailuresRule(1)],
+        [webhook_sink(url, timeout=5)],
+        10,
+        cooldown=60,
+        queue_size=10,
+    )
+
+    notifier.observe(_test())
+    await notifier.join()
+
+    assert len(received) == 1
+    assert received[0]['rule'] == 'consecutive_failures'
+    assert received[0]['hub_id'] == 'HB-1'
+    assert notifier.stats()['sent'] == 1
+
+
+@pytest.mark.asyncio
+async def test_webhook_sink_reuses_client(webhook_server, mocker):
+    url, received = webhook_server
+    async_client = mocker.patch('connect_ext.alerts.httpx.AsyncClient', wraps=httpx.AsyncClient)
+    send = webhook_sink(url, timeout=5)
+    stats = RollingStats(10)
+    stats.update(_test())
+    alert = ConsecutiveFailuresRule(1).evaluate(stats, _test())[0]
+
+    await send(alert)
+    await send(alert)
+
+    assert len(received) == 2
+    assert async_client.call_count == 1
+
+
+@pytest.mark.asyncio
+async def test_abandoned_setups_notified(db, mocker, webhook_server):
+    url, received = webhook_server
+    mocker.patch(
+        'connect_ext.settings.settings',
+        Settings(alert_consecutive_failures=1, alert_webhook_url=url),
+    )
+    abandoned = await db.create_new_test('AS-1', hub_id='HB-1')
+    db.connection.execute('DELETE FROM lease')
+
+    assert await db.create_new_test('AS-2', hub_id='HB-1')
+    await get_notifier().join()
+
+    assert [alert['test_id'] for alert in received] == [abandoned.id]
+
+
+@pytest.mark.asyncio
+async def test_notify_finished(db, mocker, webhook_server):
+    url, received = webhook_server
+    mocker.patch(
+        'connect_ext.settings.settings',
+        Settings(alert_consecutive_failures=1, alert_webhook_url=url),
+    )
+    test = db._create_new_test('AS-123', hub_id='HB-1')
+    db._set_test_result(test.id, 'failed')
+
+    await notify_finished(db, test.id)
+    await get_notifier().join()
+
+    assert [alert['test_id'] for alert in received] == [test.id]
+
+
+@pytest.mark.asyncio
+async def test_notify_finished_never_fails(mocker):
+    db = mocker.AsyncMock()
+    db.get_test.side_effect = Exception('database is locked')
+
+    await notify_finished(db, 1)
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2022, CloudBlue
+# All rights reserved.
+#
+from datetime import datetime, timedelta
+
+import numpy
+import pytest
+
+from connect_ext import analytics
+from connect_ext.analytics import AnalyticsUnavailableError, build_report, main
+
+
+def _add_test(db, hub_id, durations, result='success', created_at=None):
+    created_at = created_at or datetime(2022, 10, 3, 12)
+    c = db.connection
+    test_id = c.execute(
+        'INSERT INTO test(running, result, hub_id, created_at, done_at) VALUES(?,?,?,?,?)',
+        (False, result, hub_id, created_at, created_at + timedelta(hours=1)),
+    ).lastrowid
+    for name, duration in durations.items():
+        c.execute(
+            'INSERT INTO step(test_id, name, created_at, checked, checked_at) '
+            'VALUES(?,?,?,?,?)',
+            (
+                test_id,
+                name,
+                created_at,
+                duration is not None,
+                created_at + timedelta(seconds=duration) if duration is not None else None,
+            ),
+        )
+    c.commit()
+    return test_id
+
+
+def test_grouped_percentiles():
+    rng = numpy.random.default_rng(1)
+    values = rng.random(100)
+    values[3] = numpy.nan
+    groups = rng.integers(0, 3, 100)
+
+    result = analytics.grouped_percentiles(groups, values, 4, (50, 90))
+
+    for group in range(3):
+        expected = numpy.nanpercentile(values[groups == group], (50, 90))
+        assert numpy.allclose(result[group], expected)
+    assert numpy.isnan(result[3]).all()
+
+
+def test_build_report(db):
+    for _ in range(4):
+        _add_test(db, 'HB-1', {'purchase': 10, 'change': 20})
+    slow = _add_test(db, 'HB-1', {'purchase': 100, 'change': None}, result='failed')
+    _add_test(db, 'HB-2', {'purchase': 30}, created_at=datetime(2022, 10, 4, 12))
+
+    report = build_report(db, k=3)
+
+    steps = {(s['hub_id'], s['step']): s for s in report['steps']}
+    assert steps[('HB-1', 'purchase')]['count'] == 5
+    assert steps[('HB-1', 'purchase')]['p50'] == pytest.approx(10, abs=1e-3)
+    assert steps[('HB-1', 'change')]['checked'] == 4
+    assert steps[('HB-2', 'purchase')]['p99'] == pytest.approx(30, abs=1e-3)
+
+    assert [(a['test_id'], a['step']) for a in report['anomalies']] == [(slow, 'purchase')]
+    assert report['anomalies'][0]['median'] == pytest.approx(10, abs=1e-3)
+
+    assert [(s['hub_id'], s['bucket_start']) for s in report['durations']] == [
+        ('HB-1', '2022-10-03T00:00:00'),
+        ('HB-2', '2022-10-04T00:00:00'),
+    ]
+    rates = {s['hub_id']: s for s in report['success_rate']}
+    assert rates['HB-1']['tests'] == 5
+    assert rates['HB-1']['success_rate'] == pytest.approx(0.8)
+    assert rates['HB-2']['success_rate'] == 1.0
+
+
+def test_rolling_series(db):
+    _add_test(db, 'HB-1', {'purchase': 10}, created_at=datetime(2022, 10, 3, 12))
+    _add_test(db, 'HB-1', {'purchase': 30}, result='failed', created_at=datetime(2022, 10, 4, 12))
+    _add_test(db, 'HB-1', {'purchase': 50}, created_at=datetime(2022, 10, 7, 12))
+
+    report = build_report(db, window_buckets=2)
+
+    assert [(s['bucket_start'], s['window_start'], s['p50']) for s in report['durations']] == [
+        ('2022-10-03T00:00:00', '2022-10-02T00:00:00', pytest.approx(10, abs=1e-3)),
+        ('2022-10-04T00:00:00', '2022-10-03T00:00:00', pytest.approx(20, abs=1e-3)),
+        ('2022-10-07T00:00:00', '2022-10-06T00:00:00', pytest.approx(50, abs=1e-3)),
+    ]
+    assert [(s['tests'], s['success_rate']) for s in report['success_rate']] == [
+        (1, 1.0),
+        (2, 0.5),
+        (1, 1.0),
+    ]
+
+    report = build_report(db, window_buckets=1)
+    assert [s['p50'] for s in report['durations']] == [
+        pytest.approx(10, abs=1e-3),
+        pytest.approx(30, abs=1e-3),
+        pytest.approx(50, abs=1e-3),
+    ]
+
+
+def test_build_report_filters(db):
+    _add_test(db, 'HB-1', {'purchase': 10})
+    _add_test(db, 'HB-2', {'purchase': 10})
+
+    report = build_report(db, hub_id='HB-2')
+    assert [s['hub_id'] for s in report['steps']] == ['HB-2']
+
+    report = build_report(db, since=datetime(2023, 1, 1))
+    assert report == {'steps': [], 'anomalies': [], 'durations': [], 'success_rate': []}
+
+
+def test_build_report_without_numpy(mocker, db):
+    mocker.patch.object(analytics, 'numpy', None)
+    with pytest.raises(AnalyticsUnavailableError):
+        build_report(db)
+
+
+def test_main(tmp_path, capsys):
+    main(['--database', str(tmp_path / 'data.db'), '--hub', 'HB-1'])
+    assert '"anomalies": []' in capsys.readouterr().out
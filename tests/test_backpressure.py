@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2022, CloudBlue
+# All rights reserved.
+#
+import asyncio
+
+import pytest
+
+from connect_ext.backpressure import ConcurrencyGate, get_event_gate, get_event_gate_stats
+
+
+@pytest.mark.asyncio
+async def test_gate_queues_then_rejects():
+    gate = ConcurrencyGate(limit=2, queue_size=1)
+    assert await gate.acquire()
+    assert await gate.acquire()
+
+    waiting = asyncio.create_task(gate.acquire())
+    await asyncio.sleep(0)
+    assert not waiting.done()
+    assert not await gate.acquire()
+
+    gate.release()
+    assert await waiting
+    assert gate.stats() == {
+        'limit': 2,
+        'active': 2,
+        'queue_depth': 0,
+        'max_queue_depth': 1,
+        'admitted': 3,
+        'rejected': 1,
+    }
+
+
+@pytest.mark.asyncio
+async def test_event_gates_per_type():
+    purchase = get_event_gate('asset_purchase_request_processing')
+
+    assert get_event_gate('asset_purchase_request_processing') is purchase
+    assert get_event_gate('asset_cancel_request_processing') is not purchase
+    assert list(get_event_gate_stats()) == [
+        'asset_cancel_request_processing',
+        'asset_purchase_request_processing',
+    ]
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2022, CloudBlue
+# All rights reserved.
+#
+import asyncio
+
+import pytest
+from connect.client import AsyncConnectClient, ClientError
+
+from connect_ext.client import get_http_session, wrap_client
+from connect_ext.health import get_outbound_errors
+from connect_ext.settings import Settings
+
+
+@pytest.mark.asyncio
+async def test_clients_share_http_session(async_connect_client):
+    first = wrap_client(async_connect_client)
+    second = wrap_client(async_connect_client)
+
+    assert first is not second
+    assert first.session is second.session
+    assert first.session is get_http_session(async_connect_client.endpoint)
+    assert get_http_session('https://other.org/public/v1') is not first.session
+
+
+def test_http_session_per_event_loop():
+    async def get_session():
+        return get_http_session('https://example.org/public/v1')
+
+    sessions = []
+    for _ in range(2):
+        loop = asyncio.new_event_loop()
+        sessions.append(loop.run_until_complete(get_session()))
+        loop.close()
+    assert sessions[0] is not sessions[1]
+
+
+@pytest.mark.asyncio
+async def test_http_session_settings(mocker):
+    mocker.patch(
+        'connect_ext.settings.settings',
+        Settings(http_max_connections=5, http_max_keepalive_connections=2, http2=True),
+    )
+    mocker.patch('connect_ext.client.importlib.util.find_spec', return_value=None)
+    async_client = mocker.patch('connect_ext.client.httpx.AsyncClient')
+
+    get_http_session('https://example.org/public/v1')
+
+    limits = async_client.call_args.kwargs['limits']
+    assert limits.max_connections == 5
+    assert limits.max_keepalive_connections == 2
+    assert async_client.call_args.kwargs['http2'] is False
+
+
+@pytest.mark.asyncio
+async def test_outbound_errors_counted(async_connect_client, mocker):
+    execute = mocker.patch.object(
+        AsyncConnectClient,
+        'execute',
+        side_effect=[{'id': 'PR-1'}, ClientError('Boom', status_code=500)],
+    )
+    client = wrap_client(async_connect_client)
+
+    await client.execute('GET', 'requests/PR-1')
+    with pytest.raises(ClientError):
+        await client.execute('GET', 'requests/PR-2')
+
+    assert execute.call_count == 2
+    assert get_outbound_errors().stats() == {'calls': 2, 'errors': 1, 'error_rate': 0.5}
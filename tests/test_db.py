@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2022, CloudBlue
+# All rights reserved.
+#
+import asyncio
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import pytest
+
+from connect_ext.db import DB
+from connect_ext.settings import Settings
+
+
+@pytest.fixture
+def group_commit_db(mocker):
+    mocker.patch(
+        'connect_ext.settings.settings',
+        Settings(db_group_commit_interval=0.01, db_group_commit_max_ops=3),
+    )
+    db = DB(':memory:', group_commit=True)
+    db._create_new_test('AS-123')
+    return db
+
+
+@pytest.mark.asyncio
+async def test_group_commit_batches_writes(group_commit_db, mocker):
+    execute_batch = mocker.spy(group_commit_db, '_execute_batch')
+
+    await asyncio.gather(
+        group_commit_db.add_new_step('AS-123', 'purchase', 'PR-001'),
+        group_commit_db.add_new_step('AS-123', 'adjustment'),
+        group_commit_db.add_new_step('AS-123', 'change', 'PR-003'),
+    )
+    checked = await asyncio.gather(
+        group_commit_db.check_step(1, 'purchase', 'PR-001'),
+        group_commit_db.check_step(1, 'change', 'PR-003'),
+    )
+
+    assert execute_batch.call_count == 2
+    assert sorted(checked) == [1, 2]
+    test = group_commit_db._get_test(1)
+    assert test.steps_added == 3
+    assert test.steps_checked == 2
+
+
+@pytest.mark.asyncio
+async def test_group_commit_isolates_failed_writes(group_commit_db, mocker):
+    def failing_write(c):
+        raise ValueError('boom')
+
+    results = await asyncio.gather(
+        group_commit_db.add_new_step('AS-123', 'purchase', 'PR-001'),
+        group_commit_db.writer.submit(failing_write),
+        return_exceptions=True,
+    )
+
+    assert results[0] is None
+    assert isinstance(results[1], ValueError)
+    assert group_commit_db._get_test(1).steps_added == 1
+
+
+@pytest.mark.asyncio
+async def test_group_commit_with_cancelled_submitter(group_commit_db):
+    cancelled = asyncio.ensure_future(group_commit_db.add_new_step('AS-123', 'purchase', 'PR-001'))
+    others = asyncio.gather(
+        group_commit_db.add_new_step('AS-123', 'adjustment'),
+        group_commit_db.add_new_step('AS-123', 'change', 'PR-003'),
+    )
+    await asyncio.sleep(0)
+    cancelled.cancel()
+
+    assert await asyncio.wait_for(others, 1) == [None, None]
+    assert cancelled.cancelled()
+    assert group_commit_db._get_test(1).steps_added == 3
+
+
+@pytest.mark.asyncio
+async def test_check_step_without_group_commit(db):
+    db._create_new_test('AS-123')
+    await db.add_new_step('AS-123', 'purchase', 'PR-001')
+    assert await db.check_step(1, 'purchase', 'PR-001') == 1
+    assert await db.check_step(1, 'purchase', 'PR-001') is None
+
+
+def test_get_hub_stats(db):
+    for hub_id, result in [('HB-1', 'success'), ('HB-1', 'failed'), ('HB-2', 'success')]:
+        test = db._create_new_test('AS-123', hub_id=hub_id, product_id='PRD-123')
+        db._set_test_result(test.id, result)
+    db._create_new_test('AS-123', hub_id='HB-1')
+
+    stats = {hub['hub_id']: hub for hub in db._get_hub_stats(None, None)}
+
+    assert stats['HB-1']['tests'] == 3
+    assert stats['HB-1']['running'] == 1
+    assert stats['HB-1']['success_rate'] == 0.5
+    assert stats['HB-1']['last_failure_test_id'] == 2
+    assert stats['HB-1']['avg_duration'] >= 0
+    assert stats['HB-2']['success_rate'] == 1.0
+    assert stats['HB-2']['last_failure_at'] is None
+    assert db._get_hub_stats(None, 'HB-3') == []
+
+
+def test_dimension_columns_added(tmp_path):
+    path = str(tmp_path / 'data.db')
+    connection = sqlite3.connect(path)
+    connection.execute(
+        'CREATE TABLE test(id INTEGER PRIMARY KEY AUTOINCREMENT, running BOOLEAN, '
+        'result VARCHAR(255), object_id VARCHAR(255), done_at DATETIME, created_at DATETIME)',
+    )
+    connection.execute(
+        'CREATE TABLE step(test_id INTEGER, name VARCHAR(255), object_id VARCHAR(255), '
+        'created_at DATETIME, checked BOOLEAN, checked_at DATETIME)',
+    )
+    connection.executemany(
+        'INSERT INTO step(test_id, name) VALUES(?, ?)',
+        [(1, 'purchase'), (2, 'purchase'), (1, 'adjustment')],
+    )
+    connection.commit()
+    connection.close()
+
+    db = DB(path)
+
+    columns = {row[1] for row in db.connection.execute('PRAGMA table_info(test)')}
+    assert {'hub_id', 'product_id', 'account_id', 'connection_id'} <= columns
+    indexes = {row[1] for row in db.connection.execute('PRAGMA index_list(test)')}
+    assert {'test_hub_id', 'test_product_id'} <= indexes
+    columns = {row[1] for row in db.connection.execute('PRAGMA table_info(step)')}
+    assert {'sla_seconds', 'sla_met', 'sla_margin', 'position'} <= columns
+    assert db.connection.execute(
+        'SELECT test_id, name, position FROM step ORDER BY rowid',
+    ).fetchall() == [(1, 'purchase', 0), (2, 'purchase', 0), (1, 'adjustment', 1)]
+
+
+def test_single_test_started_by_concurrent_processes(tmp_path):
+    path = str(tmp_path / 'data.db')
+    stores = [DB(path) for _ in range(4)]
+    barrier = threading.Barrier(len(stores))
+
+    def start(db):
+        barrier.wait()
+        return db._create_new_test('AS-123')
+
+    with ThreadPoolExecutor(len(stores)) as executor:
+        tests = list(executor.map(start, stores))
+
+    assert len([test for test in tests if test]) == 1
+    assert stores[0].connection.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+
+
+def test_second_running_test_rejected(db):
+    db._create_new_test('AS-123')
+
+    with pytest.raises(sqlite3.IntegrityError):
+        db.connection.execute('INSERT INTO test(running) VALUES(1)')
+
+
+def test_abandoned_setup_failed_by_other_process(tmp_path):
+    path = str(tmp_path / 'data.db')
+    crashed, other = DB(path), DB(path)
+    test = crashed._create_new_test(None)
+
+    assert other._create_new_test(None) is None
+
+    crashed.connection.execute(
+        'UPDATE lease SET expires_at=?',
+        (datetime.now() - timedelta(seconds=1),),
+    )
+    new_test = other._create_new_test(None)
+
+    assert new_test.id == test.id + 1
+    abandoned = other._get_test(test.id)
+    assert abandoned.result.value == 'failed'
+    assert abandoned.setup_status.value == 'failed'
+    assert 'abandoned' in abandoned.setup_error
+
+
+def test_finished_setup_not_abandoned(db, mocker):
+    mocker.patch('connect_ext.settings.settings', Settings(test_setup_lease_seconds=0))
+    test = db._create_new_test(None)
+    db._finish_setup(test.id, None)
+
+    assert db._create_new_test(None) is None
+    assert db._get_test(test.id).running
+
+
+def test_steps_to_check_tracked_incrementally(tmp_path, mocker):
+    mocker.patch('connect_ext.settings.settings', Settings(sla_default_seconds=0))
+    path = str(tmp_path / 'data.db')
+    db, other = DB(path), DB(path)
+    test = db._create_new_test('AS-123')
+    db._add_new_step('AS-123', 'purchase', 'PR-001')
+    db._add_new_step('AS-123', 'adjustment', None)
+
+    assert [row[0] for row in db._get_steps_to_check(test.id)] == ['PR-001']
+
+    # Added and checked by another process.
+    other._add_new_step('AS-123', 'change', 'PR-002')
+    other._check_step(test.id, 'purchase', 'PR-001')
+    statements = []
+    db.connection.set_trace_callback(statements.append)
+
+    assert [row[0] for row in db._get_steps_to_check(test.id)] == ['PR-002']
+    assert not any('created_at <' in statement for statement in statements)
+
+    db._check_step(test.id, 'adjustment', None)
+    assert len(db.due) == 1
+
+    db._set_test_result(test.id, 'success')
+    assert len(db.due) == 0
+
+
+def test_steps_of_test_finished_by_other_process_forgotten(tmp_path, mocker):
+    mocker.patch('connect_ext.settings.settings', Settings(sla_default_seconds=0))
+    path = str(tmp_path / 'data.db')
+    db, other = DB(path), DB(path)
+    test = db._create_new_test('AS-123')
+    db._add_new_step('AS-123', 'purchase', 'PR-001')
+    db._add_new_step('AS-123', 'adjustment', 'PR-002')
+    assert len(db._get_steps_to_check(test.id)) == 2
+
+    other._set_test_result(test.id, 'failed')
+
+    assert db._get_steps_to_check(test.id) == []
+    assert len(db.due) == 0
+
+
+def test_rolled_back_check_keeps_step_tracked(db, mocker):
+    mocker.patch('connect_ext.settings.settings', Settings(sla_default_seconds=3600))
+    test = db._create_new_test('AS-123')
+    db._add_new_step('AS-123', 'purchase', 'PR-001')
+    db._get_steps_to_check(test.id)
+    assert len(db.due) == 1
+
+    with pytest.raises(ValueError):
+        with db._transaction():
+            db._check_step(test.id, 'purchase', 'PR-001')
+            raise ValueError('boom')
+    assert len(db.due) == 1
+
+    db._check_step(test.id, 'purchase', 'PR-001')
+    assert len(db.due) == 0
+
+
+def test_check_step_records_sla(db, mocker):
+    mocker.patch(
+        'connect_ext.settings.settings',
+        Settings(sla_step_seconds={'purchase': 60}, sla_hub_step_seconds={'HB-1': {'change': 5}}),
+    )
+    test = db._create_new_test('AS-123', hub_id='HB-1')
+    db._add_new_step('AS-123', 'purchase', 'PR-001')
+    db._add_new_step('AS-123', 'change', 'PR-002')
+    db.connection.execute(
+        "UPDATE step SET created_at=? WHERE name='change'",
+        (datetime.now() - timedelta(seconds=10),),
+    )
+
+    db._check_step(test.id, 'purchase', 'PR-001')
+    db._check_step(test.id, 'change', 'PR-002')
+
+    test = db._get_test(test.id)
+    purchase, change = test.steps
+    assert purchase.sla_seconds == 60
+    assert purchase.sla_met is True
+    assert 0 < purchase.sla_margin <= 60
+    assert change.sla_seconds == 5
+    assert change.sla_met is False
+    assert change.sla_margin == pytest.approx(-5, abs=1)
+    assert test.sla_breaches == 1
+    assert db._get_hub_stats(None, 'HB-1')[0]['sla_breaches'] == 1
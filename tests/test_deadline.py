@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2022, CloudBlue
+# All rights reserved.
+#
+import asyncio
+
+import pytest
+from connect.client import ClientError
+
+from connect_ext.client import wrap_client
+from connect_ext.deadline import (
+    bounded,
+    check_deadline,
+    deadline,
+    DeadlineExceeded,
+    remaining,
+)
+from connect_ext.resilience import resilient
+
+
+def test_deadline_nesting():
+    assert remaining() is None
+    with deadline(10):
+        with deadline(60):
+            assert remaining() <= 10
+        with deadline(None):
+            assert remaining() is None
+        assert 0 < remaining() <= 10
+    assert remaining() is None
+
+
+def test_check_deadline():
+    check_deadline('call')
+    with deadline(0):
+        with pytest.raises(DeadlineExceeded) as e:
+            check_deadline('call')
+    assert e.value.status_code == 504
+    assert 'call' in str(e.value)
+
+
+@pytest.mark.asyncio
+async def test_bounded():
+    assert await bounded(asyncio.sleep(0, result=1), 'sleep') == 1
+    with deadline(0.01):
+        assert await bounded(asyncio.sleep(0, result=2), 'sleep') == 2
+        with pytest.raises(DeadlineExceeded):
+            await bounded(asyncio.sleep(1), 'sleep')
+    with deadline(0):
+        with pytest.raises(DeadlineExceeded):
+            await bounded(asyncio.sleep(1), 'sleep')
+
+
+@pytest.mark.asyncio
+async def test_resilient_stops_at_deadline(mocker):
+    client = mocker.MagicMock()
+    client.response.headers = {'Retry-After': '5'}
+    func = mocker.AsyncMock(side_effect=ClientError(status_code=429))
+
+    with deadline(1):
+        with pytest.raises(DeadlineExceeded):
+            await resilient('requests')(func)(client)
+    assert func.await_count == 1
+
+    func = mocker.AsyncMock(side_effect=DeadlineExceeded('call'))
+    with deadline(1):
+        with pytest.raises(DeadlineExceeded):
+            await resilient('requests')(func)(client)
+    assert func.await_count == 1
+
+
+@pytest.mark.asyncio
+async def test_client_keeps_response_under_deadline(
+    async_client_mocker_factory,
+    async_connect_client,
+):
+    client = wrap_client(async_connect_client)
+    mocker = async_client_mocker_factory()
+    mocker.requests.all().first().mock(return_value=[{'id': 'PR-123'}])
+
+    with deadline(10):
+        assert await client.requests.all().first() == {'id': 'PR-123'}
+    assert client.response is not None
+
+
+@pytest.mark.asyncio
+async def test_db_call_interrupted_at_deadline(db):
+    slow_query = (
+        'WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n) '
+        'SELECT COUNT(*) FROM (SELECT i FROM n LIMIT 100000000)'
+    )
+
+    def count():
+        with db._transaction() as c:
+            return c.execute(slow_query).fetchone()
+
+    with deadline(0.05):
+        with pytest.raises(DeadlineExceeded):
+            await db._run(count)
+    with deadline(0):
+        with pytest.raises(DeadlineExceeded):
+            await db.is_idle()
+    assert await db.is_idle() is True
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2022, CloudBlue
+# All rights reserved.
+#
+import pytest
+from connect.client import ClientError
+
+from connect_ext.dimensions import backfill_dimensions
+
+
+@pytest.mark.asyncio
+async def test_backfill_dimensions(db, async_connect_client, mocker):
+    db._create_new_test('AS-1')
+    db._set_test_result(1, 'success')
+    db._create_new_test('AS-2', hub_id='HB-2')
+    db._set_test_result(2, 'success')
+    db._create_new_test('AS-3')
+    asset = {
+        'id': 'AS-1',
+        'product': {'id': 'PRD-1'},
+        'connection': {'id': 'CT-1', 'hub': {'id': 'HB-1'}, 'provider': {'id': 'PA-1'}},
+    }
+    get_asset = mocker.patch(
+        'connect_ext.dimensions.get_asset',
+        side_effect=[ClientError(status_code=404), asset],
+    )
+
+    result = await backfill_dimensions(async_connect_client, db)
+
+    assert result == {'updated': 1}
+    assert [call.args[1] for call in get_asset.call_args_list] == ['AS-3', 'AS-1']
+    test = db._get_test(1)
+    assert (test.hub_id, test.product_id, test.account_id, test.connection_id) == (
+        'HB-1', 'PRD-1', 'PA-1', 'CT-1',
+    )
+    assert db._get_test(3).hub_id is None
+
+    # Tests tried once are not selected again, the older ones are reached.
+    assert await db.get_tests_without_dimensions(100) == []
+
+
+@pytest.mark.asyncio
+async def test_backfill_dimensions_pages_past_tried_tests(db, async_connect_client, mocker):
+    for index in range(3):
+        db._create_new_test(f'AS-{index}')
+        db._set_test_result(index + 1, 'success')
+    get_asset = mocker.patch(
+        'connect_ext.dimensions.get_asset',
+        return_value={'id': 'AS', 'connection': {}},
+    )
+
+    assert await backfill_dimensions(async_connect_client, db, limit=2) == {'updated': 2}
+    assert await backfill_dimensions(async_connect_client, db, limit=2) == {'updated': 1}
+    assert await backfill_dimensions(async_connect_client, db, limit=2) == {'updated': 0}
+    assert [call.args[1] for call in get_asset.call_args_list] == ['AS-2', 'AS-1', 'AS-0']
+
+
+@pytest.mark.asyncio
+async def test_backfill_dimensions_error(db, async_connect_client, mocker):
+    db._create_new_test('AS-1')
+    mocker.patch(
+        'connect_ext.dimensions.get_asset',
+        side_effect=ClientError(status_code=500),
+    )
+
+    with pytest.raises(ClientError):
+        await backfill_dimensions(async_connect_client, db)
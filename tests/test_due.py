@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2022, CloudBlue
+# All rights reserved.
+#
+from datetime import datetime, timedelta
+
+from connect_ext.due import DueSteps
+
+
+def _steps(now, *ages):
+    return [
+        (rowid, 1, str(now - timedelta(seconds=age)), 120)
+        for rowid, age in enumerate(ages, start=1)
+    ]
+
+
+def test_overdue_steps_of_test():
+    now = datetime.now()
+    due = DueSteps()
+    due.extend(_steps(now, 300, 10, 200), 3)
+    due.extend([(4, 2, str(now - timedelta(seconds=500)), 120)], 4)
+
+    assert due.overdue(1, now) == [1, 3]
+    assert due.overdue(2, now) == [4]
+    assert due.overdue(1, now + timedelta(seconds=120)) == [1, 2, 3]
+    assert due.last_rowid == 4
+
+
+def test_discard_and_forget():
+    now = datetime.now()
+    due = DueSteps()
+    due.extend(_steps(now, 300, 10), 2)
+    due.extend([(3, 2, str(now), 120)], 3)
+
+    assert due.overdue(1, now) == [1]
+    due.discard(1, [1])
+    assert due.overdue(1, now) == []
+    assert len(due) == 2
+
+    due.forget(1)
+    assert due.overdue(1, now + timedelta(hours=1)) == []
+    assert len(due) == 1
+
+
+def test_steps_discarded_before_due():
+    now = datetime.now()
+    due = DueSteps()
+    due.extend(_steps(now, 10, 10, 10), 3)
+    due.extend([(4, 2, str(now), 120)], 4)
+
+    due.discard(1, [1, 2])
+    due.forget(2)
+
+    assert len(due) == 1
+    assert due.tests() == {1}
+    assert due.overdue(1, now + timedelta(hours=1)) == [3]
+    assert due.overdue(2, now + timedelta(hours=1)) == []
+    assert len(due) == 1
+
+
+def test_forgotten_steps_dropped_from_heap():
+    now = datetime.now()
+    due = DueSteps()
+    for test_id in range(1, 101):
+        due.extend([(test_id, test_id, str(now), 120)], test_id)
+
+    for test_id in range(1, 100):
+        due.forget(test_id)
+
+    assert len(due) == 1
+    assert len(due._heap) < 100
+    assert due.overdue(100, now + timedelta(hours=1)) == [100]
+
+
+def test_clear():
+    due = DueSteps()
+    due.extend(_steps(datetime.now(), 300), 1)
+
+    due.clear()
+
+    assert len(due) == 0
+    assert due.last_rowid == 0
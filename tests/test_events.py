@@ -5,7 +5,26 @@
 #
 import pytest
 
+from connect_ext.backpressure import get_event_gate
 from connect_ext.events import HubTestingEventsApplication
+from connect_ext.models import DEFAULT_SCENARIO
+from connect_ext.settings import Settings
+
+
+def _get_extension(client, logger, mocker, steps_checked, scenario=DEFAULT_SCENARIO):
+    ext = HubTestingEventsApplication(client, logger, {})
+    ext.db = mocker.AsyncMock()
+    ext.db.get_test_scenario = mocker.AsyncMock(return_value=(1, scenario))
+    ext.db.check_step_and_enqueue = mocker.AsyncMock(return_value=steps_checked)
+    ext.runner = mocker.patch('connect_ext.events.get_job_runner').return_value
+    return ext
+
+
+def _assert_checked(ext, step, request_id, steps_checked, next_job):
+    args = ext.db.check_step_and_enqueue.await_args.args
+    assert args[:3] == (1, step, request_id)
+    assert args[3](steps_checked) == next_job
+    return args[4]
 
 
 @pytest.mark.asyncio
@@ -15,13 +34,14 @@ async def test_handle_asset_purchase_request_processing(
     mocker,
 ):
     request = {'id': 'PR-123', 'asset': {'id': 'AS-123'}}
-    ext = HubTestingEventsApplication(async_connect_client, logger, {})
-    ext.db = mocker.AsyncMock()
-    ext.db.get_test_id_from_object_id = mocker.AsyncMock(return_value=1)
+    ext = _get_extension(async_connect_client, logger, mocker, 1)
     result = await ext.handle_asset_purchase_request_processing(request)
     assert result.status == 'success'
-    ext.db.get_test_id_from_object_id.assert_awaited()
-    ext.db.check_step.assert_awaited_with(1, 'purchase', 'PR-123')
+    ext.db.get_test_scenario.assert_awaited_with('AS-123')
+    _assert_checked(ext, 'purchase', 'PR-123', 1, None)
+    ext.db.update_step_object_id.assert_not_awaited()
+    ext.db.set_test_result.assert_not_awaited()
+    ext.runner.wake.assert_called_once_with(ext.client, ext.db)
 
 
 @pytest.mark.asyncio
@@ -31,113 +51,114 @@ async def test_handle_asset_adjustment_request_processing(
     mocker,
 ):
     request = {'id': 'PR-123', 'asset': {'id': 'AS-123', 'product': {'id': 'PRD-123'}}}
-    ext = HubTestingEventsApplication(async_connect_client, logger, {})
-    ext.db = mocker.AsyncMock()
-    ext.db.get_test_id_from_object_id = mocker.AsyncMock(return_value=1)
-    change_request = {'id': 'PR-123-002'}
-    mocked_create_change_request = mocker.AsyncMock(return_value=change_request)
-    mocker.patch('connect_ext.events.create_change_request', mocked_create_change_request)
+    ext = _get_extension(async_connect_client, logger, mocker, 2)
     result = await ext.handle_asset_adjustment_request_processing(request)
     assert result.status == 'success'
     ext.db.update_step_object_id.assert_awaited_with(1, 'adjustment', request['id'])
-    ext.db.check_step.assert_awaited_with(1, 'adjustment', request['id'])
-    mocked_create_change_request.assert_awaited_with(
-        client=ext.client,
-        product_id='PRD-123',
-        request_id=request['id'],
-        asset_id='AS-123',
-    )
-    ext.db.add_new_step.assert_awaited_with('AS-123', 'change', change_request['id'])
+    payload = _assert_checked(ext, 'adjustment', 'PR-123', 2, 'change')
+    assert payload == request
 
 
 @pytest.mark.asyncio
-async def test_handle_asset_change_request_processing(
+@pytest.mark.parametrize(
+    ('handler', 'step', 'steps_checked', 'next_job'),
+    (
+        ('handle_asset_change_request_processing', 'change', 3, 'suspend'),
+        ('handle_asset_suspend_request_processing', 'suspend', 4, 'resume'),
+        ('handle_asset_resume_request_processing', 'resume', 5, 'cancel'),
+    ),
+)
+async def test_handle_asset_request_processing_enqueues_next_step(
     async_connect_client,
     logger,
     mocker,
+    handler,
+    step,
+    steps_checked,
+    next_job,
 ):
     request = {'id': 'PR-123', 'asset': {'id': 'AS-123'}}
-    ext = HubTestingEventsApplication(async_connect_client, logger, {})
-    ext.db = mocker.AsyncMock()
-    ext.db.get_test_id_from_object_id = mocker.AsyncMock(return_value=1)
-    change_request = {'id': 'PR-123-002'}
-    mocked_create_request = mocker.AsyncMock(return_value=change_request)
-    mocker.patch('connect_ext.events.create_request', mocked_create_request)
-    result = await ext.handle_asset_change_request_processing(request)
+    ext = _get_extension(async_connect_client, logger, mocker, steps_checked)
+    result = await getattr(ext, handler)(request)
     assert result.status == 'success'
-    ext.db.check_step.assert_awaited_with(1, 'change', request['id'])
-    mocked_create_request.assert_awaited_with(
-        client=ext.client,
-        request_type='suspend',
-        asset_id='AS-123',
-    )
-    ext.db.add_new_step.assert_awaited_with('AS-123', 'suspend', change_request['id'])
+    _assert_checked(ext, step, 'PR-123', steps_checked, next_job)
+    ext.db.set_test_result.assert_not_awaited()
 
 
 @pytest.mark.asyncio
-async def test_handle_asset_suspend_request_processing(
+async def test_handle_asset_cancel_request_processing_success(
     async_connect_client,
     logger,
     mocker,
 ):
     request = {'id': 'PR-123', 'asset': {'id': 'AS-123'}}
-    ext = HubTestingEventsApplication(async_connect_client, logger, {})
-    ext.db = mocker.AsyncMock()
-    ext.db.get_test_id_from_object_id = mocker.AsyncMock(return_value=1)
-    change_request = {'id': 'PR-123-002'}
-    mocked_create_request = mocker.AsyncMock(return_value=change_request)
-    mocker.patch('connect_ext.events.create_request', mocked_create_request)
-    result = await ext.handle_asset_suspend_request_processing(request)
+    ext = _get_extension(async_connect_client, logger, mocker, 6)
+    result = await ext.handle_asset_cancel_request_processing(request)
+
     assert result.status == 'success'
-    ext.db.check_step.assert_awaited_with(1, 'suspend', request['id'])
-    mocked_create_request.assert_awaited_with(
-        client=ext.client,
-        request_type='resume',
-        asset_id='AS-123',
-    )
-    ext.db.add_new_step.assert_awaited_with('AS-123', 'resume', change_request['id'])
+    _assert_checked(ext, 'cancel', 'PR-123', 6, None)
+    ext.db.set_test_result.assert_awaited_with(1, 'success')
 
 
 @pytest.mark.asyncio
-async def test_handle_asset_resume_request_processing(
+async def test_handle_event_already_checked(
     async_connect_client,
     logger,
     mocker,
 ):
     request = {'id': 'PR-123', 'asset': {'id': 'AS-123'}}
-    ext = HubTestingEventsApplication(async_connect_client, logger, {})
-    ext.db = mocker.AsyncMock()
-    ext.db.get_test_id_from_object_id = mocker.AsyncMock(return_value=1)
-    change_request = {'id': 'PR-123-002'}
-    mocked_create_request = mocker.AsyncMock(return_value=change_request)
-    mocker.patch('connect_ext.events.create_request', mocked_create_request)
-    result = await ext.handle_asset_resume_request_processing(request)
+    ext = _get_extension(async_connect_client, logger, mocker, None)
+    result = await ext.handle_asset_change_request_processing(request)
+
     assert result.status == 'success'
-    ext.db.check_step.assert_awaited_with(1, 'resume', request['id'])
-    mocked_create_request.assert_awaited_with(
-        client=ext.client,
-        request_type='cancel',
-        asset_id='AS-123',
-    )
-    ext.db.add_new_step.assert_awaited_with('AS-123', 'cancel', change_request['id'])
+    ext.db.set_test_result.assert_not_awaited()
 
 
 @pytest.mark.asyncio
-async def test_handle_asset_cancel_request_processing_success(
+async def test_handle_event_unknown_asset(
     async_connect_client,
     logger,
     mocker,
 ):
     request = {'id': 'PR-123', 'asset': {'id': 'AS-123'}}
-    ext = HubTestingEventsApplication(async_connect_client, logger, {})
-    ext.db = mocker.AsyncMock()
-    ext.db.get_test_id_from_object_id = mocker.AsyncMock(return_value=1)
-    ext.db.get_steps_to_check = mocker.AsyncMock(return_value=[])
-    ext.db.get_step_count = mocker.AsyncMock(return_value=6)
-    result = await ext.handle_asset_cancel_request_processing(request)
+    ext = _get_extension(async_connect_client, logger, mocker, 1)
+    ext.db.get_test_scenario = mocker.AsyncMock(return_value=(None, []))
+    result = await ext.handle_asset_purchase_request_processing(request)
 
     assert result.status == 'success'
-    ext.db.check_step.assert_awaited_with(1, 'cancel', request['id'])
-    ext.db.get_steps_to_check.assert_awaited_with(test_id=1)
-    ext.db.get_step_count.assert_awaited_with(test_id=1)
-    ext.db.set_test_result.assert_awaited_with(1, 'success')
+    ext.db.check_step_and_enqueue.assert_not_awaited()
+
+
+@pytest.mark.asyncio
+async def test_handle_event_custom_scenario(
+    async_connect_client,
+    logger,
+    mocker,
+):
+    request = {'id': 'PR-123', 'asset': {'id': 'AS-123', 'product': {'id': 'PRD-123'}}}
+    scenario = ['purchase', 'adjustment', 'change', 'change', 'cancel']
+    ext = _get_extension(async_connect_client, logger, mocker, 3, scenario=scenario)
+    result = await ext.handle_asset_change_request_processing(request)
+
+    assert result.status == 'success'
+    _assert_checked(ext, 'change', 'PR-123', 3, 'change')
+
+
+@pytest.mark.asyncio
+async def test_handle_event_rescheduled_when_saturated(async_connect_client, logger, mocker):
+    mocker.patch(
+        'connect_ext.settings.settings',
+        Settings(event_concurrency=1, event_queue_size=0, event_reschedule_countdown=120),
+    )
+    request = {'id': 'PR-123', 'asset': {'id': 'AS-123'}}
+    ext = _get_extension(async_connect_client, logger, mocker, 1)
+    assert await get_event_gate('asset_purchase_request_processing').acquire()
+
+    result = await ext.handle_asset_purchase_request_processing(request)
+
+    assert result.status == 'reschedule'
+    assert result.countdown == 120
+    ext.db.check_step_and_enqueue.assert_not_awaited()
+    result = await ext.handle_asset_cancel_request_processing(request)
+    assert result.status == 'success'
+    assert get_event_gate('asset_cancel_request_processing').stats()['active'] == 0
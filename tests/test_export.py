@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2022, CloudBlue
+# All rights reserved.
+#
+import csv
+import io
+from datetime import datetime, timedelta
+
+import pyarrow
+import pyarrow.ipc
+import pyarrow.parquet
+import pytest
+
+from connect_ext import export
+from connect_ext.db import DB
+from connect_ext.export import iter_csv, main, UnsupportedFormatError, write_export
+from connect_ext.models import ExportFormat
+
+
+def _fill(db, tests):
+    for index, hub_id in enumerate(tests):
+        db._create_new_test(f'AS-{index}', hub_id=hub_id, product_id='PRD-123')
+        db._add_new_step(f'AS-{index}', 'purchase', f'PR-{index}-001')
+        db._add_new_step(f'AS-{index}', 'adjustment', None)
+        db._check_step(index + 1, 'purchase', f'PR-{index}-001')
+        db._set_test_result(index + 1, 'success')
+
+
+def _read_csv(chunks):
+    return list(csv.DictReader(io.StringIO(''.join(chunks))))
+
+
+def test_export_batches_paginates(db):
+    _fill(db, ['HB-1', 'HB-2', 'HB-1'])
+    batches = list(db.export_batches(batch_size=4))
+
+    assert [len(batch) for batch in batches] == [4, 2]
+    rows = [row for batch in batches for row in batch]
+    assert [(row[0], row[7]) for row in rows] == [
+        (1, 'purchase'), (1, 'adjustment'),
+        (2, 'purchase'), (2, 'adjustment'),
+        (3, 'purchase'), (3, 'adjustment'),
+    ]
+
+
+def test_export_batches_filters(db):
+    _fill(db, ['HB-1', 'HB-2', 'HB-1'])
+    db.connection.execute('INSERT INTO test(running, hub_id) VALUES(0, "HB-1")')
+
+    rows = _read_csv(iter_csv(db.export_batches(hub_id='HB-1')))
+    assert {row['test_id'] for row in rows} == {'1', '3', '4'}
+    assert rows[-1]['step_name'] == ''
+    assert rows[0]['hub_id'] == 'HB-1'
+    assert rows[0]['product_id'] == 'PRD-123'
+    assert rows[0]['step_request_id'] == 'PR-0-001'
+    assert float(rows[0]['step_duration']) >= 0
+    assert rows[1]['step_checked_at'] == ''
+
+    assert list(db.export_batches(since=datetime.now() + timedelta(days=1))) == []
+    assert list(db.export_batches(until=datetime.now() - timedelta(days=1))) == []
+
+
+def test_write_export_csv(tmp_path):
+    path = str(tmp_path / 'data.db')
+    _fill(DB(path), ['HB-1', 'HB-2'])
+    output = tmp_path / 'tests.csv'
+
+    main(['--database', path, '--output', str(output), '--hub', 'HB-2'])
+
+    rows = list(csv.DictReader(output.open()))
+    assert [row['test_id'] for row in rows] == ['2', '2']
+    assert write_export(DB(path), ExportFormat.csv, str(output)) == 4
+
+
+def test_write_export_without_pyarrow(mocker, db, tmp_path):
+    mocker.patch.object(export, 'pyarrow', None)
+    with pytest.raises(UnsupportedFormatError):
+        write_export(db, ExportFormat.parquet, str(tmp_path / 'tests.parquet'))
+
+
+def test_export_arrow(db, tmp_path):
+    _fill(db, ['HB-1', 'HB-2'])
+
+    table = pyarrow.ipc.open_stream(b''.join(export.iter_arrow(db.export_batches()))).read_all()
+    assert table.num_rows == 4
+    assert table.schema.field('step_created_at').type == pyarrow.timestamp('us')
+    assert table.column('hub_id').to_pylist() == ['HB-1', 'HB-1', 'HB-2', 'HB-2']
+
+    output = str(tmp_path / 'tests.parquet')
+    assert write_export(db, ExportFormat.parquet, output, hub_id='HB-2') == 2
+    assert pyarrow.parquet.read_table(output).column('test_id').to_pylist() == [2, 2]
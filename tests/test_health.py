@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2022, CloudBlue
+# All rights reserved.
+#
+import pytest
+
+from connect_ext.db import DB
+from connect_ext.health import ErrorRate, HealthCounters
+from connect_ext.settings import Settings
+
+
+@pytest.fixture
+def no_cache(mocker):
+    mocker.patch('connect_ext.settings.settings', Settings(health_cache_seconds=0))
+
+
+def test_health_counters():
+    health = HealthCounters(window=2)
+
+    for latency in (0.1, 0.2, 0.4):
+        health.observe_db(latency)
+
+    stats = health.stats()
+    assert stats['pending'] == 0
+    assert stats['latency_last'] == 0.4
+    assert abs(stats['latency_avg'] - 0.3) < 1e-9
+    assert stats['latency_max'] == 0.4
+
+
+def test_health_tests_cache():
+    health = HealthCounters(window=2)
+    assert health.cached_tests(60) is None
+
+    health.cache_tests({'running_tests': 1})
+
+    assert health.cached_tests(60) == {'running_tests': 1}
+    assert health.cached_tests(0) is None
+
+
+def test_error_rate_window():
+    errors = ErrorRate(window=2)
+    for failed in (True, True, False):
+        errors.add(failed)
+
+    assert errors.stats() == {'calls': 3, 'errors': 2, 'error_rate': 0.5}
+
+
+@pytest.mark.asyncio
+async def test_tests_summary(db, no_cache):
+    test = db._create_new_test('AS-1', hub_id='HB-1')
+    assert (await db.get_tests_summary())['running_tests'] == 1
+
+    db._set_test_result(test.id, 'success')
+    other = db._create_new_test('AS-2', hub_id='HB-1')
+    db._finish_setup(other.id, 'Boom')
+
+    summary = await db.get_tests_summary()
+    assert summary['running_tests'] == 0
+    assert summary['last_results']['HB-1']['test_id'] == other.id
+    assert summary['last_results']['HB-1']['result'] == 'failed'
+
+
+@pytest.mark.asyncio
+async def test_tests_summary_written_by_other_process(tmp_path, no_cache):
+    path = str(tmp_path / 'data.db')
+    web, events = DB(path), DB(path)
+    assert (await web.get_tests_summary())['running_tests'] == 0
+
+    test = events._create_new_test('AS-1', hub_id='HB-1')
+    assert (await web.get_tests_summary())['running_tests'] == 1
+
+    events._set_test_result(test.id, 'failed')
+    summary = await web.get_tests_summary()
+    assert summary['running_tests'] == 0
+    assert summary['last_results'] == {
+        'HB-1': {
+            'test_id': test.id,
+            'result': 'failed',
+            'done_at': events._get_test(test.id).done_at,
+        },
+    }
+
+
+@pytest.mark.asyncio
+async def test_tests_summary_cached(db, mocker):
+    mocker.patch('connect_ext.settings.settings', Settings(health_cache_seconds=60))
+    assert (await db.get_tests_summary())['running_tests'] == 0
+
+    db._create_new_test('AS-1')
+
+    assert (await db.get_tests_summary())['running_tests'] == 0
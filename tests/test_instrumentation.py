@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2022, CloudBlue
+# All rights reserved.
+#
+import pytest
+
+from connect_ext.instrumentation import instrumented, measure
+from connect_ext.settings import Settings
+
+
+@pytest.fixture
+def settings(mocker):
+    settings = Settings(slow_call_threshold=0, slow_call_sample_rate=1)
+    mocker.patch('connect_ext.settings.settings', settings)
+    return settings
+
+
+@pytest.mark.asyncio
+async def test_instrumented_logs_slow_calls(settings, db, logger):
+    db._create_new_test('AS-123')
+
+    @instrumented
+    async def handler(logger=None):
+        with measure('outbound'):
+            pass
+        return await db.get_test(1)
+
+    test = await handler(logger=logger)
+
+    assert test.id == 1
+    logger.warning.assert_called_once()
+    record = logger.warning.call_args.kwargs['extra']['performance']
+    assert record['call'].endswith('handler')
+    assert record['db_calls'] == 1
+    assert record['db_time'] > 0
+    assert record['outbound_calls'] == 1
+
+
+@pytest.mark.asyncio
+async def test_instrumented_skips_fast_calls(settings, logger):
+    settings.slow_call_threshold = 60
+
+    @instrumented
+    async def handler(logger=None):
+        return 'done'
+
+    assert await handler(logger=logger) == 'done'
+    logger.warning.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_instrumented_samples_slow_calls(settings, mocker):
+    settings.slow_call_sample_rate = 0.5
+    mocker.patch('connect_ext.instrumentation.random.random', return_value=0.7)
+
+    class Handler:
+        logger = mocker.MagicMock()
+
+        @instrumented
+        async def handle(self):
+            raise ValueError()
+
+    handler = Handler()
+    with pytest.raises(ValueError):
+        await handler.handle()
+    handler.logger.warning.assert_not_called()
+
+
+def test_measure_outside_invocation():
+    with measure('db'):
+        pass
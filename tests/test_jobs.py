@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2022, CloudBlue
+# All rights reserved.
+#
+import functools
+from datetime import datetime, timedelta
+
+import pytest
+from connect.client import ClientError
+
+from connect_ext.jobs import JobRunner
+from connect_ext.lifecycle import next_job
+from connect_ext.models import DEFAULT_SCENARIO
+from connect_ext.settings import Settings
+
+
+REQUEST = {'id': 'PR-123-002', 'asset': {'id': 'AS-123', 'product': {'id': 'PRD-123'}}}
+
+
+@pytest.fixture(autouse=True)
+def settings(mocker):
+    settings = Settings(retry_backoff_base=0, retry_backoff_max=0)
+    mocker.patch('connect_ext.settings.settings', settings)
+    return settings
+
+
+@pytest.fixture
+def running_test(db):
+    db._create_new_test('AS-123')
+    db._add_new_step('AS-123', 'purchase', 'PR-123-001')
+    db._add_new_step('AS-123', 'adjustment', 'PR-123-002')
+    db._check_step(1, 'purchase', 'PR-123-001')
+    return 1
+
+
+def _jobs(db):
+    return db.connection.execute(
+        'SELECT step, status, attempts, last_error FROM job ORDER BY id',
+    ).fetchall()
+
+
+def _enqueue(db, test_id):
+    return db._check_step_and_enqueue(
+        test_id,
+        'adjustment',
+        'PR-123-002',
+        functools.partial(next_job, DEFAULT_SCENARIO),
+        REQUEST,
+    )
+
+
+@pytest.mark.asyncio
+async def test_check_step_enqueues_next_step(db, running_test):
+    assert _enqueue(db, running_test) == 2
+    assert _jobs(db) == [('change', 'pending', 0, None)]
+
+    assert _enqueue(db, running_test) is None
+    assert len(_jobs(db)) == 1
+
+
+@pytest.mark.asyncio
+async def test_runner_issues_queued_steps(db, running_test, async_connect_client, mocker):
+    create_change_request = mocker.patch(
+        'connect_ext.lifecycle.create_change_request',
+        return_value={'id': 'PR-123-003'},
+    )
+    _enqueue(db, running_test)
+
+    runner = JobRunner(workers=2, max_attempts=3, lease=60)
+    runner.wake(async_connect_client, db)
+    await runner.tasks[0]
+    await runner.tasks[1]
+
+    create_change_request.assert_awaited_once_with(
+        client=async_connect_client,
+        product_id='PRD-123',
+        request_id='PR-123-002',
+        asset_id='AS-123',
+    )
+    assert _jobs(db) == [('change', 'done', 1, None)]
+    test = db._get_test(running_test)
+    assert test.last_step == 'change'
+    assert test.steps[-1].object_id == 'PR-123-003'
+
+
+@pytest.mark.asyncio
+async def test_runner_retries_failed_jobs(db, running_test, async_connect_client, mocker):
+    mocker.patch(
+        'connect_ext.lifecycle.create_change_request',
+        side_effect=[ClientError('Unavailable'), {'id': 'PR-123-003'}],
+    )
+    find_request = mocker.patch('connect_ext.lifecycle.find_request', return_value=None)
+    _enqueue(db, running_test)
+
+    runner = JobRunner(workers=1, max_attempts=3, lease=60)
+    runner.wake(async_connect_client, db)
+    await runner.tasks[0]
+
+    assert _jobs(db) == [('change', 'done', 2, None)]
+    created_at = db.connection.execute('SELECT created_at FROM job').fetchone()[0]
+    find_request.assert_awaited_once_with(
+        async_connect_client,
+        'AS-123',
+        'change',
+        datetime.fromisoformat(created_at),
+        ['PR-123-001', 'PR-123-002'],
+    )
+
+
+@pytest.mark.asyncio
+async def test_runner_retry_reuses_created_request(
+    db,
+    running_test,
+    async_connect_client,
+    mocker,
+):
+    create_change_request = mocker.patch(
+        'connect_ext.lifecycle.create_change_request',
+        side_effect=ClientError('Bad gateway', status_code=502),
+    )
+    mocker.patch('connect_ext.lifecycle.find_request', return_value={'id': 'PR-123-003'})
+    _enqueue(db, running_test)
+
+    runner = JobRunner(workers=1, max_attempts=3, lease=60)
+    runner.wake(async_connect_client, db)
+    await runner.tasks[0]
+
+    create_change_request.assert_awaited_once()
+    assert _jobs(db) == [('change', 'done', 2, None)]
+    assert db._get_test(running_test).steps[-1].object_id == 'PR-123-003'
+
+
+@pytest.mark.asyncio
+async def test_runner_retry_does_not_add_step_twice(
+    db,
+    running_test,
+    async_connect_client,
+    mocker,
+):
+    mocker.patch(
+        'connect_ext.lifecycle.create_change_request',
+        return_value={'id': 'PR-123-003'},
+    )
+    find_request = mocker.patch('connect_ext.lifecycle.find_request', return_value=None)
+    # The step is stored but the attempt fails before the job is completed.
+    mocker.patch.object(
+        db,
+        'complete_job',
+        mocker.AsyncMock(side_effect=[ClientError('Unavailable'), True]),
+    )
+    mocker.patch('connect_ext.jobs.get_backoff_delay', return_value=0)
+    _enqueue(db, running_test)
+
+    runner = JobRunner(workers=1, max_attempts=3, lease=60)
+    runner.wake(async_connect_client, db)
+    with pytest.raises(ClientError):
+        await runner.tasks[0]
+    db.connection.execute("UPDATE job SET available_at=?", (datetime.now(),))
+    runner.wake(async_connect_client, db)
+    await runner.tasks[0]
+
+    find_request.assert_awaited_once()
+    assert find_request.call_args.args[4] == ['PR-123-001', 'PR-123-002', 'PR-123-003']
+    test = db._get_test(running_test)
+    assert [step.name for step in test.steps] == ['purchase', 'adjustment', 'change']
+    assert test.steps_added == 3
+
+
+def test_add_new_step_once_per_position(db, running_test):
+    db._add_new_step('AS-123', 'change', 'PR-123-003', 2)
+    db._add_new_step('AS-123', 'change', 'PR-123-004', 2)
+    db._add_new_step('AS-123', 'suspend', 'PR-123-005')
+
+    test = db._get_test(running_test)
+    assert [(step.name, step.object_id) for step in test.steps] == [
+        ('purchase', 'PR-123-001'),
+        ('adjustment', 'PR-123-002'),
+        ('change', 'PR-123-003'),
+        ('suspend', 'PR-123-005'),
+    ]
+    assert test.steps_added == 4
+
+
+@pytest.mark.asyncio
+async def test_runner_fails_test_after_max_attempts(
+    db,
+    running_test,
+    async_connect_client,
+    mocker,
+):
+    mocker.patch(
+        'connect_ext.lifecycle.create_change_request',
+        side_effect=ClientError('Unavailable'),
+    )
+    mocker.patch('connect_ext.lifecycle.find_request', return_value=None)
+    _enqueue(db, running_test)
+
+    runner = JobRunner(workers=1, max_attempts=2, lease=60)
+    runner.wake(async_connect_client, db)
+    await runner.tasks[0]
+
+    assert _jobs(db) == [('change', 'failed', 2, 'Unavailable')]
+    test = db._get_test(running_test)
+    assert test.running is False
+    assert test.result.value == 'failed'
+
+
+def test_claim_job_lease(db, running_test):
+    _enqueue(db, running_test)
+
+    job = db._claim_job(60)
+    assert job[2:] == ('change', job[3], 1, 2, job[6])
+    assert db._claim_job(60) is None
+    assert db._get_next_job_delay() is None
+
+    # A job still running when its lease expires is claimed again.
+    db.connection.execute(
+        'UPDATE job SET available_at=?',
+        (datetime.now() - timedelta(seconds=1),),
+    )
+    assert db._claim_job(60)[4] == 2
+    db._retry_job(job[0], 2, 'Unavailable', 30)
+    assert db._claim_job(60) is None
+    assert 29 < db._get_next_job_delay() <= 30
+
+
+def test_stale_attempt_does_not_overwrite_job(db, running_test):
+    _enqueue(db, running_test)
+    stale = db._claim_job(60)
+    db.connection.execute(
+        'UPDATE job SET available_at=?',
+        (datetime.now() - timedelta(seconds=1),),
+    )
+    current = db._claim_job(60)
+
+    assert db._fail_job(stale[0], stale[4], 'Unavailable') is False
+    assert db._retry_job(stale[0], stale[4], 'Unavailable', 30) is False
+    assert db._complete_job(stale[0], stale[4]) is False
+    assert _jobs(db) == [('change', 'running', 2, None)]
+    assert db._get_test(running_test).running is True
+
+    assert db._complete_job(current[0], current[4]) is True
+    assert _jobs(db) == [('change', 'done', 2, None)]
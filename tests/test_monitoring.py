@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2022, CloudBlue
+# All rights reserved.
+#
+import asyncio
+import time
+
+import pytest
+
+from connect_ext.events import HubTestingEventsApplication
+from connect_ext.models import MonitorTarget
+from connect_ext.monitoring import get_monitor, MonitorScheduler
+from connect_ext.settings import Settings
+from connect_ext.workers import get_setup_pool
+
+
+TARGETS = [
+    MonitorTarget(hub_id='HB-1', product_id='PRD-1', interval=60),
+    MonitorTarget(
+        hub_id='HB-2',
+        product_id='PRD-2',
+        interval=600,
+        scenario=['purchase', 'adjustment'],
+    ),
+]
+
+
+@pytest.fixture
+def run_setup(mocker):
+    return mocker.patch('connect_ext.monitoring.run_setup')
+
+
+def _make_due(scheduler):
+    scheduler._heap = [(0, index) for index, _ in enumerate(scheduler.targets)]
+
+
+@pytest.mark.asyncio
+async def test_run_due_skips_while_running(db, run_setup, async_connect_client):
+    scheduler = MonitorScheduler(TARGETS, jitter=0.1)
+    scheduler.client, scheduler.db = async_connect_client, db
+    _make_due(scheduler)
+
+    tests = await scheduler.run_due()
+    await get_setup_pool().join()
+
+    assert [(test.hub_id, test.product_id) for test in tests] == [('HB-1', 'PRD-1')]
+    assert scheduler.stats() == {'targets': 2, 'started': 1, 'skipped': 1, 'failed': 0}
+    client, _, target, progress, _ = run_setup.await_args.args
+    assert client is async_connect_client
+    assert target.hub_id == 'HB-1'
+    assert progress == {'stage': None, 'test_id': tests[0].id}
+    now = time.monotonic()
+    next_runs = sorted(scheduler._heap)
+    assert now + 54 <= next_runs[0][0] <= now + 66
+    assert now + 540 <= next_runs[1][0] <= now + 660
+    assert await scheduler.run_due() == []
+
+
+@pytest.mark.asyncio
+async def test_run_due_failure_is_isolated(db, run_setup, mocker):
+    scheduler = MonitorScheduler(TARGETS, jitter=0)
+    scheduler.db = mocker.AsyncMock()
+    scheduler.db.is_idle.side_effect = [Exception('database is locked'), True]
+    scheduler.db.create_new_test.return_value = db._create_new_test(None)
+    _make_due(scheduler)
+
+    tests = await scheduler.run_due()
+
+    assert len(tests) == 1
+    assert scheduler.stats()['failed'] == 1
+
+
+@pytest.mark.asyncio
+async def test_start_runs_once_per_loop(db, run_setup, mocker):
+    scheduler = MonitorScheduler(TARGETS[:1], jitter=0)
+    _make_due(scheduler)
+    start = mocker.patch.object(scheduler, '_start')
+
+    scheduler.start(None, db)
+    task = scheduler.task
+    scheduler.start(None, db)
+    await asyncio.sleep(0)
+
+    assert scheduler.task is task
+    start.assert_awaited_once_with(TARGETS[0])
+    task.cancel()
+
+
+@pytest.mark.asyncio
+async def test_no_targets_not_started(db):
+    scheduler = MonitorScheduler([], jitter=0.1)
+
+    scheduler.start(None, db)
+
+    assert scheduler.task is None
+
+
+@pytest.mark.asyncio
+async def test_execute_monitoring(async_connect_client, logger, mocker, run_setup):
+    mocker.patch(
+        'connect_ext.settings.settings',
+        Settings(monitor_targets=[{'hub_id': 'HB-1', 'product_id': 'PRD-1'}], monitor_jitter=0),
+    )
+    ext = HubTestingEventsApplication(async_connect_client, logger, {})
+    monitor = get_monitor()
+    monitor.task.cancel()
+    _make_due(monitor)
+
+    await ext.execute_monitoring({})
+
+    assert monitor.stats()['started'] == 1
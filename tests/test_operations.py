@@ -3,6 +3,8 @@
 # Copyright (c) 2022, CloudBlue
 # All rights reserved.
 #
+from datetime import datetime, timezone
+
 import pytest
 
 from connect_ext.operations import (
@@ -10,6 +12,7 @@ from connect_ext.operations import (
     create_change_request,
     create_draft_request,
     create_request,
+    find_request,
     get_request_by_id,
     update_request,
     validate_request,
@@ -183,3 +186,24 @@ async def test_create_request(
         asset_id,
     )
     assert response == {}
+
+
+@pytest.mark.asyncio
+async def test_find_request(
+    async_client_mocker_factory,
+    async_connect_client,
+):
+    client = async_client_mocker_factory()
+    f = (
+        'asset.id=AS-123&type=suspend&status=pending&gt(created,2022-05-01T10:00:00)'
+        '&out(id,(PR-123-001,PR-123-002))'
+    )
+    client.requests.filter(f).first().mock(return_value=[{'id': 'PR-123-004'}])
+    response = await find_request(
+        async_connect_client,
+        'AS-123',
+        'suspend',
+        datetime(2022, 5, 1, 10, tzinfo=timezone.utc),
+        ['PR-123-001', 'PR-123-002'],
+    )
+    assert response == {'id': 'PR-123-004'}
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2022, CloudBlue
+# All rights reserved.
+#
+import time
+
+import pytest
+
+from connect_ext import profiler
+from connect_ext.profiler import record_event, StackSampler, start_sampler
+
+
+@pytest.fixture(autouse=True)
+def reset_sampler(mocker):
+    mocker.patch('connect_ext.profiler._sampler', None)
+
+
+def _busy_wait(seconds):
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        pass
+
+
+def test_sampler_collects_collapsed_stacks():
+    sampler = start_sampler(duration=0.2, interval=0.001)
+    _busy_wait(0.05)
+    sampler.stop()
+
+    assert sampler.running is False
+    assert sampler.samples > 0
+    assert '_busy_wait' in sampler.report()
+    line = sampler.report().splitlines()[0]
+    stack, count = line.rsplit(' ', 1)
+    assert ';' in stack
+    assert int(count) > 0
+
+
+def test_sampler_stops_after_max_events():
+    sampler = start_sampler(duration=60, interval=0.001, max_events=2)
+    record_event()
+    record_event()
+    sampler._thread.join(timeout=5)
+
+    assert sampler.running is False
+    assert sampler.status()['events'] == 2
+
+
+def test_record_event_without_sampler():
+    record_event()
+    assert profiler.get_sampler() is None
+
+
+def test_sampler_stops_after_duration():
+    sampler = StackSampler(duration=0.01, interval=0.001)
+    sampler.start()
+    sampler._thread.join(timeout=5)
+    assert sampler.running is False
+    assert sampler.status()['stopped_at'] is not None
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2022, CloudBlue
+# All rights reserved.
+#
+import asyncio
+import json
+
+import pytest
+
+from connect_ext.db import DB
+from connect_ext.events import HubTestingEventsApplication
+from connect_ext.models import DEFAULT_SCENARIO, ResultType
+from connect_ext.replay import EventRecorder, load_events, main, RecordedEvent, replay
+from connect_ext.settings import Settings
+
+
+def _request(request_id, asset_id):
+    return {
+        'id': request_id,
+        'asset': {
+            'id': asset_id,
+            'product': {'id': 'PRD-1'},
+            'connection': {'hub': {'id': 'HB-1'}},
+        },
+    }
+
+
+def _events(asset_id, start=0.0, steps=DEFAULT_SCENARIO):
+    return [
+        RecordedEvent(start + index, step, _request(f'PR-{asset_id}-{index}', asset_id))
+        for index, step in enumerate(steps)
+    ]
+
+
+@pytest.mark.asyncio
+async def test_record_events(async_connect_client, logger, mocker, tmp_path):
+    path = str(tmp_path / 'events.ndjson.gz')
+    mocker.patch('connect_ext.settings.settings', Settings(event_record_path=path))
+    ext = HubTestingEventsApplication(async_connect_client, logger, {})
+    ext.db = mocker.AsyncMock()
+    ext.db.get_test_scenario = mocker.AsyncMock(return_value=(1, ['purchase', 'adjustment']))
+    mocker.patch('connect_ext.events.get_job_runner')
+    mocker.patch('connect_ext.events.advance')
+
+    await ext.handle_asset_purchase_request_processing(_request('PR-1', 'AS-1'))
+    await ext.handle_asset_adjustment_request_processing(_request('PR-2', 'AS-1'))
+
+    events = list(load_events(path))
+    assert [(e.step, e.request['id'], e.scenario) for e in events] == [
+        ('purchase', 'PR-1', ['purchase', 'adjustment']),
+        ('adjustment', 'PR-2', None),
+    ]
+    assert events[0].at <= events[1].at
+
+
+@pytest.mark.asyncio
+async def test_replay_rebuilds_tests(db):
+    events = _events('AS-1') + _events('AS-2', start=10)
+
+    result = await replay(events, db, speed=0)
+
+    assert result['events'] == 12
+    assert result['skipped'] == 0
+    tests = await db.list_tests()
+    assert [(t.object_id, t.result, t.hub_id, t.product_id) for t in tests] == [
+        ('AS-1', ResultType.success, 'HB-1', 'PRD-1'),
+        ('AS-2', ResultType.success, 'HB-1', 'PRD-1'),
+    ]
+    assert [(s.name, s.object_id) for s in tests[1].steps] == [
+        (e.step, e.request['id']) for e in _events('AS-2')
+    ]
+    assert all(s.checked_at for s in tests[1].steps)
+
+
+@pytest.mark.asyncio
+async def test_replay_skips_test_while_another_runs(db):
+    events = _events('AS-1', steps=['purchase']) + _events('AS-2', start=1)
+
+    result = await replay(events, db, speed=0)
+
+    assert result['skipped'] == 1
+    tests = await db.list_tests(include_steps=False)
+    assert [(t.object_id, t.result) for t in tests] == [('AS-1', None)]
+
+
+@pytest.mark.asyncio
+async def test_replay_fails_test_without_recorded_request(db):
+    events = _events('AS-1', steps=['purchase', 'adjustment'])
+
+    await replay(events, db, speed=0)
+
+    test = (await db.list_tests(include_steps=False))[0]
+    assert test.result == ResultType.failed
+
+
+@pytest.mark.asyncio
+async def test_replay_uses_recorded_scenario(db):
+    scenario = ['purchase', 'adjustment']
+    events = _events('AS-1', steps=scenario)
+    events[0] = events[0]._replace(scenario=scenario)
+
+    await replay(events, db, speed=0)
+
+    test = (await db.list_tests(include_steps=False))[0]
+    assert test.scenario == scenario
+    assert test.result == ResultType.success
+
+
+@pytest.mark.asyncio
+async def test_replay_keeps_pace(db):
+    events = _events('AS-1', steps=['purchase', 'adjustment'], start=100)
+    events[1] = events[1]._replace(at=100.4)
+
+    result = await replay(events, db, speed=2)
+
+    assert result['elapsed'] >= 0.2
+
+
+def test_main(tmp_path, capsys):
+    path = str(tmp_path / 'events.ndjson.gz')
+    recorder = EventRecorder(path)
+
+    async def record():
+        for event in _events('AS-1'):
+            await recorder.record(event.step, event.request)
+
+    asyncio.run(record())
+    assert recorder.recorded == 6
+
+    main([path, '--database', str(tmp_path / 'replay.db'), '--speed', '0'])
+
+    result = json.loads(capsys.readouterr().out)
+    assert result['events'] == 6
+    assert result['skipped'] == 0
+
+
+def test_main_with_scenario(tmp_path, capsys):
+    path = str(tmp_path / 'events.ndjson.gz')
+    recorder = EventRecorder(path)
+
+    async def record():
+        for event in _events('AS-1', steps=['purchase', 'adjustment']):
+            await recorder.record(event.step, event.request)
+
+    asyncio.run(record())
+
+    database = str(tmp_path / 'replay.db')
+    main([path, '--database', database, '--speed', '0', '--scenario', 'purchase,adjustment'])
+
+    assert json.loads(capsys.readouterr().out)['events'] == 2
+    test = DB(database)._list_tests(include_steps=False)[0]
+    assert test.scenario == ['purchase', 'adjustment']
+    assert test.result == ResultType.success
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2022, CloudBlue
+# All rights reserved.
+#
+import pytest
+from connect.client import ClientError
+
+from connect_ext import resilience
+from connect_ext.resilience import CircuitOpenError, get_backoff_delay, resilient
+from connect_ext.settings import Settings
+
+
+@pytest.fixture(autouse=True)
+def settings(mocker):
+    settings = Settings(
+        retry_max_attempts=3,
+        retry_backoff_base=0,
+        circuit_failure_threshold=2,
+        circuit_reset_timeout=60,
+    )
+    mocker.patch('connect_ext.settings.settings', settings)
+    return settings
+
+
+@pytest.mark.asyncio
+async def test_resilient_retries_throttled_calls(mocker):
+    client = mocker.MagicMock()
+    client.response.headers = {'Retry-After': '0'}
+    func = mocker.AsyncMock(side_effect=[ClientError(status_code=429), {'id': 'PR-123'}])
+
+    result = await resilient('requests', idempotent=False)(func)(client, 'PR-123')
+
+    assert result == {'id': 'PR-123'}
+    assert func.await_count == 2
+    assert resilience.get_breaker('requests').state == 'closed'
+
+
+@pytest.mark.asyncio
+async def test_resilient_gives_up_after_max_attempts(mocker):
+    func = mocker.AsyncMock(side_effect=ClientError(status_code=502))
+
+    with pytest.raises(ClientError):
+        await resilient('hubs')(func)(mocker.MagicMock())
+
+    # The breaker opens after the second failure and stops the retries.
+    assert func.await_count == 2
+    with pytest.raises(CircuitOpenError):
+        await resilient('hubs')(func)(mocker.MagicMock())
+    assert func.await_count == 2
+
+
+@pytest.mark.asyncio
+async def test_resilient_does_not_retry_client_errors(mocker):
+    func = mocker.AsyncMock(side_effect=ClientError(status_code=400))
+
+    with pytest.raises(ClientError):
+        await resilient('requests')(func)(mocker.MagicMock())
+
+    assert func.await_count == 1
+    assert resilience.get_breaker('requests').failures == 0
+
+
+@pytest.mark.asyncio
+async def test_resilient_does_not_retry_server_errors_of_non_idempotent_calls(mocker):
+    func = mocker.AsyncMock(side_effect=ClientError(status_code=500))
+
+    with pytest.raises(ClientError):
+        await resilient('requests', idempotent=False)(func)(mocker.MagicMock())
+
+    assert func.await_count == 1
+    assert resilience.get_breaker('requests').failures == 1
+
+
+@pytest.mark.asyncio
+async def test_resilient_server_errors_of_non_idempotent_calls_open_breaker(mocker):
+    func = mocker.AsyncMock(side_effect=ClientError(status_code=None))
+
+    for _ in range(2):
+        with pytest.raises(ClientError):
+            await resilient('requests', idempotent=False)(func)(mocker.MagicMock())
+
+    assert resilience.get_breaker('requests').state == 'open'
+    with pytest.raises(CircuitOpenError):
+        await resilient('requests', idempotent=False)(func)(mocker.MagicMock())
+    assert func.await_count == 2
+
+
+def test_circuit_breaker_half_open(mocker):
+    breaker = resilience.CircuitBreaker('requests', failure_threshold=1, reset_timeout=10)
+    breaker.record_failure()
+    assert breaker.state == 'open'
+    mocker.patch('connect_ext.resilience.time.monotonic', return_value=breaker.opened_at + 10)
+    assert breaker.state == 'half_open'
+    breaker.before_call()
+    assert breaker.state == 'open'
+    breaker.record_success()
+    assert breaker.state == 'closed'
+
+
+def test_get_backoff_delay(settings):
+    settings.retry_backoff_base = 1
+    settings.retry_backoff_max = 5
+    assert 0 <= get_backoff_delay(1) <= 2
+    assert 0 <= get_backoff_delay(10) <= 5
+    assert get_backoff_delay(1, retry_after=3) == 3
+    assert get_backoff_delay(1, retry_after=60) == 5
+
+
+def test_get_retry_after_http_date(mocker):
+    client = mocker.MagicMock()
+    client.response.headers = {'Retry-After': 'Wed, 21 Oct 2015 07:28:00 GMT'}
+    assert resilience._get_retry_after(client) == 0
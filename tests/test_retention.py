@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2022, CloudBlue
+# All rights reserved.
+#
+import gzip
+import json
+from datetime import datetime, timedelta
+
+import pytest
+
+from connect_ext.db import DB
+from connect_ext.events import HubTestingEventsApplication
+from connect_ext.retention import apply_retention
+from connect_ext.settings import Settings
+
+
+def _create_finished_test(db, asset_id, age_days=0):
+    test = db._create_new_test(asset_id)
+    db._add_new_step(asset_id, 'purchase', f'PR-{asset_id}')
+    db._check_step(test.id, 'purchase', f'PR-{asset_id}')
+    db._set_test_result(test.id, 'success')
+    with db.connection as c:
+        c.execute(
+            'UPDATE test SET created_at=? WHERE id=?',
+            (datetime.now() - timedelta(days=age_days), test.id),
+        )
+    return test.id
+
+
+@pytest.fixture
+def settings(mocker):
+    settings = Settings(retention_max_age_days=30, retention_batch_size=2)
+    mocker.patch('connect_ext.settings.settings', settings)
+    return settings
+
+
+@pytest.mark.asyncio
+async def test_apply_retention_by_age(db, settings, tmp_path):
+    settings.retention_archive_path = str(tmp_path / 'archive.ndjson.gz')
+    old_ids = [_create_finished_test(db, f'AS-{i}', age_days=60) for i in range(3)]
+    recent_id = _create_finished_test(db, 'AS-recent')
+
+    result = await apply_retention(db)
+
+    assert result == {'archived': 3}
+    assert [test.id for test in db._list_tests()] == [recent_id]
+    rows = db.connection.execute('SELECT id, steps FROM test_archive ORDER BY id').fetchall()
+    assert [row[0] for row in rows] == old_ids
+    steps = json.loads(rows[0][1])
+    assert steps[0]['name'] == 'purchase'
+    assert steps[0]['duration'] >= 0
+    with gzip.open(settings.retention_archive_path, 'rt') as archive:
+        assert [json.loads(line)['id'] for line in archive] == old_ids
+
+
+@pytest.mark.asyncio
+async def test_apply_retention_by_count(db, settings):
+    settings.retention_max_age_days = None
+    settings.retention_max_count = 2
+    ids = [_create_finished_test(db, f'AS-{i}') for i in range(4)]
+
+    result = await apply_retention(db)
+
+    assert result == {'archived': 2}
+    assert [test.id for test in db._list_tests()] == ids[2:]
+
+
+@pytest.mark.asyncio
+async def test_apply_retention_keeps_running_tests(db, settings):
+    test = db._create_new_test('AS-123')
+    with db.connection as c:
+        c.execute('UPDATE test SET created_at=? WHERE id=?', ('2000-01-01 00:00:00', test.id))
+
+    assert await apply_retention(db) == {'archived': 0}
+    assert len(db._list_tests()) == 1
+
+
+@pytest.mark.asyncio
+async def test_apply_retention_disabled(db, settings):
+    settings.retention_max_age_days = None
+    _create_finished_test(db, 'AS-123', age_days=365)
+
+    assert await apply_retention(db) == {'archived': 0}
+
+
+def test_vacuum_converts_database(tmp_path):
+    database = str(tmp_path / 'data.db')
+    db = DB(database)
+    db.connection.execute('PRAGMA auto_vacuum=NONE')
+    db.connection.execute('VACUUM')
+    db._vacuum(10)
+    assert db.connection.execute('PRAGMA auto_vacuum').fetchone()[0] == 2
+    db._vacuum(10)
+
+
+@pytest.mark.asyncio
+async def test_execute_retention(async_connect_client, logger, mocker):
+    ext = HubTestingEventsApplication(async_connect_client, logger, {})
+    mocker.patch(
+        'connect_ext.events.apply_retention',
+        mocker.AsyncMock(return_value={'archived': 2}),
+    )
+    result = await ext.execute_retention({'id': 'EFS-123'})
+    assert result.status == 'success'
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2022, CloudBlue
+# All rights reserved.
+#
+import pytest
+
+from connect_ext.settings import Settings
+from connect_ext.sla import get_sla_seconds
+
+
+@pytest.fixture(autouse=True)
+def sla_settings(mocker):
+    mocker.patch(
+        'connect_ext.settings.settings',
+        Settings(
+            sla_default_seconds=60,
+            sla_step_seconds={'purchase': 600},
+            sla_hub_step_seconds={'HB-SLOW': {'purchase': 3600, 'change': 900}},
+        ),
+    )
+
+
+@pytest.mark.parametrize(
+    ('hub_id', 'step', 'expected'),
+    (
+        ('HB-SLOW', 'purchase', 3600),
+        ('HB-SLOW', 'change', 900),
+        ('HB-SLOW', 'resume', 60),
+        ('HB-FAST', 'purchase', 600),
+        (None, 'purchase', 600),
+        (None, 'resume', 60),
+    ),
+)
+def test_get_sla_seconds(hub_id, step, expected):
+    assert get_sla_seconds(hub_id, step) == expected
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2022, CloudBlue
+# All rights reserved.
+#
+import time
+
+import pytest
+
+from connect_ext.client import ThrottledAsyncConnectClient, wrap_client
+from connect_ext.throttling import get_rate_limiter, RateLimiter, TokenBucket
+
+
+@pytest.mark.asyncio
+async def test_token_bucket_waits_for_tokens():
+    bucket = TokenBucket(rate=100, burst=1)
+    await bucket.acquire()
+    started = time.monotonic()
+    await bucket.acquire()
+    assert time.monotonic() - started >= 0.005
+    stats = bucket.stats()
+    assert stats['acquired'] == 2
+    assert stats['queue_depth'] == 0
+    assert stats['max_wait'] >= 0.005
+
+
+@pytest.mark.asyncio
+async def test_token_bucket_disabled():
+    bucket = TokenBucket(rate=0, burst=0)
+    await bucket.acquire()
+    assert bucket.stats()['acquired'] == 0
+
+
+@pytest.mark.asyncio
+async def test_rate_limiter_uses_family_bucket():
+    limiter = RateLimiter(100, 10, {'requests': 50})
+    await limiter.acquire('requests/PR-123')
+    await limiter.acquire('marketplaces?owner.id=VA-123')
+    stats = limiter.stats()
+    assert stats['global']['acquired'] == 2
+    assert stats['families']['requests']['acquired'] == 1
+
+
+def test_rate_limiter_get_family():
+    assert RateLimiter.get_family('requests/PR-123/purchase') == 'requests'
+    assert RateLimiter.get_family('/hubs/HB-123/connections') == 'hubs'
+    assert RateLimiter.get_family('listings?limit=100') == 'listings'
+
+
+@pytest.mark.asyncio
+async def test_throttled_client_goes_through_limiter(
+    async_client_mocker_factory,
+    async_connect_client,
+):
+    client = wrap_client(async_connect_client)
+    assert isinstance(client, ThrottledAsyncConnectClient)
+    assert client.max_retries == 0
+    assert wrap_client(client) is client
+
+    mocker = async_client_mocker_factory()
+    mocker.requests['PR-123'].get(return_value={'id': 'PR-123'})
+    assert await client.requests['PR-123'].get() == {'id': 'PR-123'}
+    assert get_rate_limiter().stats()['families']['requests']['acquired'] == 1
@@ -3,25 +3,32 @@
 # Copyright (c) 2022, CloudBlue
 # All rights reserved.
 #
-from datetime import datetime
+import subprocess
+import sys
+import time
+from datetime import datetime, timedelta
 
 from connect.client import ClientError
 
+from connect_ext import profiler
+from connect_ext.backpressure import get_event_gate
+from connect_ext.health import get_outbound_errors
 from connect_ext.webapp import TstWebApplication
-from connect_ext.models import TstInstance
+from connect_ext.models import ResultType, Step, TstInstance
+from connect_ext.settings import Settings
 
 
 def test_start_test(mocker, test_client_factory, async_client_mocker_factory):
     client = test_client_factory(TstWebApplication)
     client_mocker = async_client_mocker_factory()
     client_mocker.accounts.all().first().mock(return_value=[{'id': 'VA-123-123'}])
-    mocker.patch('connect_ext.webapp.create_draft_request', return_value={'id': 'PR-123'})
+    mocker.patch('connect_ext.lifecycle.create_draft_request', return_value={'id': 'PR-123'})
     mocker.patch(
-        'connect_ext.webapp.get_request_by_id',
+        'connect_ext.lifecycle.get_request_by_id',
         return_value={'id': 'PR-123', 'asset': {'id': 'AS-123'}},
     )
-    mocker.patch('connect_ext.webapp.validate_request')
-    mocker.patch('connect_ext.webapp.change_draft_to_pending')
+    mocker.patch('connect_ext.lifecycle.validate_request')
+    mocker.patch('connect_ext.lifecycle.change_draft_to_pending')
 
     body = {
         'product_id': 'PRD-123',
@@ -38,6 +45,10 @@ def test_start_test(mocker, test_client_factory, async_client_mocker_factory):
     assert test['running'] is True
     assert test['result'] is None
     assert test['object_id'] == 'AS-123'
+    assert test['hub_id'] == 'HUB-123'
+    assert test['product_id'] == 'PRD-123'
+    assert test['account_id'] == 'VA-123-123'
+    assert test['setup_status'] == 'done'
     assert test['done_at'] is None
     assert test['created_at'] is not None
     assert len(test['steps']) == 2
@@ -76,13 +87,13 @@ def test_start_test_while_other_already_started(
     client = test_client_factory(TstWebApplication)
     client_mocker = async_client_mocker_factory()
     client_mocker.accounts.all().first().mock(return_value=[{'id': 'VA-123-123'}])
-    mocker.patch('connect_ext.webapp.create_draft_request', return_value={'id': 'PR-123'})
+    mocker.patch('connect_ext.lifecycle.create_draft_request', return_value={'id': 'PR-123'})
     mocker.patch(
-        'connect_ext.webapp.get_request_by_id',
+        'connect_ext.lifecycle.get_request_by_id',
         return_value={'id': 'PR-123', 'asset': {'id': 'AS-123'}},
     )
-    mocker.patch('connect_ext.webapp.validate_request')
-    mocker.patch('connect_ext.webapp.change_draft_to_pending')
+    mocker.patch('connect_ext.lifecycle.validate_request')
+    mocker.patch('connect_ext.lifecycle.change_draft_to_pending')
     db.create_new_test = mocker.AsyncMock(return_value=None)
 
     client = test_client_factory(TstWebApplication)
@@ -132,13 +143,13 @@ def test_get_and_list_test(test_client_factory, mocker, async_client_mocker_fact
     client = test_client_factory(TstWebApplication)
     client_mocker = async_client_mocker_factory()
     client_mocker.accounts.all().first().mock(return_value=[{'id': 'VA-123-123'}])
-    mocker.patch('connect_ext.webapp.create_draft_request', return_value={'id': '1'})
+    mocker.patch('connect_ext.lifecycle.create_draft_request', return_value={'id': '1'})
     mocker.patch(
-        'connect_ext.webapp.get_request_by_id',
+        'connect_ext.lifecycle.get_request_by_id',
         return_value={'id': 'PR-123', 'asset': {'id': 'AS-123'}},
     )
-    mocker.patch('connect_ext.webapp.validate_request')
-    mocker.patch('connect_ext.webapp.change_draft_to_pending')
+    mocker.patch('connect_ext.lifecycle.validate_request')
+    mocker.patch('connect_ext.lifecycle.change_draft_to_pending')
 
     response = client.post(
         '/api/tests',
@@ -197,38 +208,30 @@ def test_check_test_not_running(mocker, test_client_factory, db):
 
 def test_check_test(mocker, test_client_factory, db):
     client = test_client_factory(TstWebApplication)
+    an_hour_ago = datetime.now() - timedelta(hours=1)
     test = TstInstance(
         id=1,
         running=True,
         result=None,
         object_id='AS-123',
-        created_at=datetime.now(),
+        created_at=an_hour_ago,
         done_at=None,
-        steps=[],
-    )
-    test2 = TstInstance(
-        id=1,
-        running=False,
-        result='success',
-        object_id='AS-123',
-        created_at=datetime.now(),
-        done_at=datetime.now(),
-        steps=[],
-    )
-    db.get_test = mocker.AsyncMock(
-        side_effect=[test, test2],
+        steps_checked=5,
+        sla_breaches=0,
+        steps=[
+            Step(name='purchase', object_id='PR-123', created_at=an_hour_ago, checked=True),
+            Step(name='adjustment', object_id='PR-124', created_at=an_hour_ago, sla_seconds=60),
+            Step(name='suspend', object_id='PR-125', created_at=datetime.now(), sla_seconds=60),
+            Step(name='change', created_at=an_hour_ago),
+        ],
     )
-    db.get_steps_to_check = mocker.AsyncMock(
-        return_value=[('PR-123',)],
-    )
-    db.check_step = mocker.AsyncMock()
-    db.get_step_count = mocker.AsyncMock(return_value=6)
-    db.set_test_result = mocker.AsyncMock()
-    mocker.patch(
+    db.get_test = mocker.AsyncMock(return_value=test)
+    db.finish_check = mocker.AsyncMock(return_value=True)
+    get_request = mocker.patch(
         'connect_ext.webapp.get_request_by_id',
         return_value={
-            'id': 'PR-123',
-            'type': 'purchase',
+            'id': 'PR-124',
+            'type': 'adjustment',
             'status': 'approved',
         },
     )
@@ -241,19 +244,88 @@ def test_check_test(mocker, test_client_factory, db):
     assert response_test['running'] is False
     assert response_test['result'] == 'success'
     assert response_test['object_id'] == 'AS-123'
+    assert response_test['done_at']
+    assert response_test['steps_checked'] == 6
+    assert response_test['sla_breaches'] == 1
+    assert [step['checked'] for step in response_test['steps']] == [True, True, False, False]
+    assert response_test['steps'][1]['sla_met'] is False
+    db.get_test.assert_awaited_once()
+    assert get_request.call_args.args[1] == 'PR-124'
+    get_request.assert_called_once()
+    db.finish_check.assert_awaited_once_with(
+        '1',
+        [('adjustment', 'PR-124')],
+        'success',
+        mocker.ANY,
+    )
+
+
+def test_check_test_finished_meanwhile(mocker, test_client_factory, db):
+    client = test_client_factory(TstWebApplication)
+    test = db._create_new_test('AS-123')
+    snapshot = db._get_test(test.id)
+    db._set_test_result(test.id, 'failed')
+    mocker.patch.object(
+        db,
+        'get_test',
+        mocker.AsyncMock(side_effect=[snapshot, db._get_test(test.id)]),
+    )
+
+    response = client.post(
+        f'/api/tests/{test.id}/check',
+    )
+
+    assert response.status_code == 400
+    assert db.get_test.await_count == 2
+    test = db._get_test(test.id)
+    assert test.result == ResultType.failed
+    assert test.steps_checked == 0
+
+
+def test_check_test_request_not_approved(mocker, test_client_factory, db):
+    client = test_client_factory(TstWebApplication)
+    test = db._create_new_test('AS-123')
+    db._add_new_step('AS-123', 'purchase', 'PR-123')
+    db._add_new_step('AS-123', 'adjustment', 'PR-124')
+    db._add_new_step('AS-123', 'change', 'PR-125')
+    with db.connection as c:
+        # The adjustment is still within its threshold and is not polled.
+        c.execute(
+            "UPDATE step SET created_at=? WHERE object_id IN ('PR-123', 'PR-125')",
+            (datetime.now() - timedelta(hours=1),),
+        )
+    get_request = mocker.patch(
+        'connect_ext.webapp.get_request_by_id',
+        side_effect=[
+            {'id': 'PR-123', 'type': 'purchase', 'status': 'approved'},
+            {'id': 'PR-125', 'type': 'change', 'status': 'pending'},
+        ],
+    )
+    response = client.post(
+        f'/api/tests/{test.id}/check',
+    )
+    assert response.status_code == 400
+    assert response.json() == {
+        'detail': 'The change PR-125 is in pending status instead of approved.',
+    }
+    assert [call.args[1] for call in get_request.call_args_list] == ['PR-123', 'PR-125']
+    test = db._get_test(test.id)
+    assert test.result == ResultType.failed
+    assert test.steps_checked == 1
+    assert [step.checked for step in test.steps] == [True, False, False]
 
 
 def test_full_flow(mocker, test_client_factory, async_client_mocker_factory, db):
     client = test_client_factory(TstWebApplication)
     client_mocker = async_client_mocker_factory()
     client_mocker.accounts.all().first().mock(return_value=[{'id': 'VA-123-123'}])
-    mocker.patch('connect_ext.webapp.create_draft_request', return_value={'id': '1'})
+    mocker.patch('connect_ext.lifecycle.create_draft_request', return_value={'id': '1'})
     mocker.patch(
-        'connect_ext.webapp.get_request_by_id',
+        'connect_ext.lifecycle.get_request_by_id',
         return_value={'id': 'PR-123-001', 'asset': {'id': 'AS-123'}},
     )
-    mocker.patch('connect_ext.webapp.validate_request')
-    mocker.patch('connect_ext.webapp.change_draft_to_pending')
+    mocker.patch('connect_ext.lifecycle.validate_request')
+    mocker.patch('connect_ext.lifecycle.change_draft_to_pending')
 
     response = client.post(
         '/api/tests',
@@ -306,4 +378,307 @@ def test_full_flow(mocker, test_client_factory, async_client_mocker_factory, db)
     assert response_test['running'] is False
     assert response_test['result'] == 'success'
     assert response_test['object_id'] == 'AS-123'
+    assert response_test['steps_checked'] == 6
+    assert response_test['steps_expected'] == 6
+    assert response_test['steps_added'] == 6
+    assert response_test['last_step'] == 'cancel'
+    assert response_test['total_duration'] is not None
     assert len(response_test['steps']) == 6
+
+
+def test_start_test_with_scenario(mocker, test_client_factory, async_client_mocker_factory):
+    client = test_client_factory(TstWebApplication)
+    client_mocker = async_client_mocker_factory()
+    client_mocker.accounts.all().first().mock(return_value=[{'id': 'VA-123-123'}])
+    mocker.patch('connect_ext.lifecycle.create_draft_request', return_value={'id': 'PR-123'})
+    mocker.patch(
+        'connect_ext.lifecycle.get_request_by_id',
+        return_value={'id': 'PR-123', 'asset': {'id': 'AS-123'}},
+    )
+    mocker.patch('connect_ext.lifecycle.validate_request')
+    mocker.patch('connect_ext.lifecycle.change_draft_to_pending')
+
+    scenario = ['purchase', 'adjustment', 'change', 'change', 'cancel']
+    response = client.post(
+        '/api/tests',
+        json={
+            'product_id': 'PRD-123',
+            'hub_id': 'HUB-123',
+            'scenario': scenario,
+        },
+    )
+    assert response.status_code == 201
+    test = response.json()
+    assert test['scenario'] == scenario
+    assert test['steps_checked'] == 0
+
+
+def test_start_test_invalid_scenario(test_client_factory):
+    client = test_client_factory(TstWebApplication)
+    response = client.post(
+        '/api/tests',
+        json={
+            'product_id': 'PRD-123',
+            'hub_id': 'HUB-123',
+            'scenario': ['purchase', 'adjustment', 'resume', 'cancel'],
+        },
+    )
+    assert response.status_code == 422
+
+
+def test_get_rate_limits(test_client_factory):
+    client = test_client_factory(TstWebApplication)
+    response = client.get('/api/rate-limits')
+    assert response.status_code == 200
+    stats = response.json()
+    assert stats['global']['queue_depth'] == 0
+    assert 'requests' in stats['families']
+
+
+def test_get_event_gates(test_client_factory):
+    get_event_gate('asset_purchase_request_processing')
+    client = test_client_factory(TstWebApplication)
+    response = client.get('/api/event-gates')
+    assert response.status_code == 200
+    assert response.json()['asset_purchase_request_processing']['queue_depth'] == 0
+
+
+def test_list_tests_summary(test_client_factory, db):
+    db._create_new_test('AS-123', ['purchase', 'adjustment', 'cancel'])
+    db._add_new_step('AS-123', 'purchase', 'PR-123-001')
+    db._add_new_step('AS-123', 'adjustment', None)
+    db._check_step(1, 'purchase', 'PR-123-001')
+
+    client = test_client_factory(TstWebApplication)
+    response = client.get('/api/tests', params={'include_steps': False})
+
+    assert response.status_code == 200
+    test = response.json()[0]
+    assert test['steps'] is None
+    assert test['steps_expected'] == 3
+    assert test['steps_added'] == 2
+    assert test['steps_checked'] == 1
+    assert test['last_step'] == 'adjustment'
+    assert test['total_duration'] >= 0
+
+
+def test_profiler_routes(test_client_factory, mocker):
+    mocker.patch('connect_ext.profiler._sampler', None)
+    client = test_client_factory(TstWebApplication)
+
+    response = client.get('/api/admin/profiler')
+    assert response.status_code == 404
+    response = client.get('/api/admin/profiler/report')
+    assert response.status_code == 404
+
+    response = client.post('/api/admin/profiler', json={'seconds': 60, 'events': 2})
+    assert response.status_code == 202
+    assert response.json()['running'] is True
+    response = client.post('/api/admin/profiler', json={'seconds': 1})
+    assert response.status_code == 400
+
+    client.get('/api/tests')
+    client.get('/api/tests')
+    profiler.get_sampler()._thread.join(timeout=5)
+
+    response = client.get('/api/admin/profiler')
+    assert response.status_code == 200
+    assert response.json()['running'] is False
+    assert response.json()['events'] == 2
+    response = client.get('/api/admin/profiler/report')
+    assert response.status_code == 200
+    assert response.headers['content-type'].startswith('text/plain')
+
+
+def test_import_does_not_load_report_libraries():
+    loaded = subprocess.run(
+        [
+            sys.executable,
+            '-c',
+            'import sys, connect_ext.webapp; print({"numpy", "pyarrow"} & set(sys.modules))',
+        ],
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout
+    assert loaded.strip() == 'set()'
+
+
+def test_export_tests(test_client_factory, db):
+    db._create_new_test('AS-123', hub_id='HB-123', product_id='PRD-123')
+    db._add_new_step('AS-123', 'purchase', 'PR-123')
+    client = test_client_factory(TstWebApplication)
+
+    response = client.get('/api/tests/export', params={'hub_id': 'HB-123'})
+
+    assert response.status_code == 200
+    assert response.headers['content-type'].startswith('text/csv')
+    lines = response.text.splitlines()
+    assert lines[0].startswith('test_id,hub_id,product_id')
+    assert lines[1].startswith('1,HB-123,PRD-123,AS-123')
+
+    response = client.get('/api/tests/export', params={'format': 'parquet'})
+    assert response.status_code == 400
+
+
+def test_get_analytics(test_client_factory, mocker):
+    mocker.patch('connect_ext.analytics.numpy', None)
+    client = test_client_factory(TstWebApplication)
+
+    response = client.get('/api/analytics')
+
+    assert response.status_code == 400
+    assert 'numpy' in response.json()['detail']
+
+
+def test_get_hubs_stats(test_client_factory, db):
+    test = db._create_new_test('AS-123', hub_id='HB-123')
+    db._set_test_result(test.id, 'failed')
+    client = test_client_factory(TstWebApplication)
+
+    response = client.get('/api/hubs/stats')
+    assert response.status_code == 200
+    assert [hub['hub_id'] for hub in response.json()] == ['HB-123']
+
+    response = client.get('/api/hubs/HB-123/stats')
+    assert response.status_code == 200
+    assert response.json()['success_rate'] == 0.0
+    assert response.json()['last_failure_test_id'] == test.id
+
+    response = client.get('/api/hubs/HB-999/stats')
+    assert response.status_code == 404
+
+
+def test_start_test_deadline(mocker, test_client_factory, async_client_mocker_factory, db):
+    mocker.patch('connect_ext.settings.settings', Settings(start_test_timeout=0.1))
+    client_mocker = async_client_mocker_factory()
+    client_mocker.accounts.all().first().mock(return_value=[{'id': 'VA-123-123'}])
+    mocker.patch('connect_ext.lifecycle.create_draft_request', return_value={'id': 'PR-123'})
+    mocker.patch(
+        'connect_ext.lifecycle.get_request_by_id',
+        return_value={'id': 'PR-123', 'asset': {'id': 'AS-123'}},
+    )
+    mocker.patch('connect_ext.lifecycle.validate_request')
+    mocker.patch(
+        'connect_ext.lifecycle.change_draft_to_pending',
+        side_effect=lambda *args: time.sleep(0.2),
+    )
+    client = test_client_factory(TstWebApplication)
+
+    response = client.post('/api/tests', json={'product_id': 'PRD-123', 'hub_id': 'HB-123'})
+
+    assert response.status_code == 504
+    assert response.json()['partial_state'] == {
+        'stage': 'add_new_step',
+        'request_id': 'PR-123',
+        'asset_id': 'AS-123',
+        'test_id': 1,
+    }
+    test = db._get_test(1)
+    assert test.running is False
+    assert test.result.value == 'failed'
+
+
+def test_start_test_background(mocker, test_client_factory, async_client_mocker_factory):
+    client_mocker = async_client_mocker_factory()
+    client_mocker.accounts.all().first().mock(return_value=[{'id': 'VA-123-123'}])
+    mocker.patch('connect_ext.lifecycle.create_draft_request', return_value={'id': 'PR-123'})
+    mocker.patch(
+        'connect_ext.lifecycle.get_request_by_id',
+        return_value={'id': 'PR-123', 'asset': {'id': 'AS-123'}},
+    )
+    mocker.patch('connect_ext.lifecycle.validate_request')
+    mocker.patch('connect_ext.lifecycle.change_draft_to_pending')
+
+    with test_client_factory(TstWebApplication) as client:
+        response = client.post(
+            '/api/tests',
+            params={'background': True},
+            json={'product_id': 'PRD-123', 'hub_id': 'HB-123'},
+        )
+        assert response.status_code == 202
+        assert response.json()['setup_status'] == 'pending'
+        assert response.json()['object_id'] is None
+
+        for _ in range(100):
+            test = client.get('/api/tests/1').json()
+            if test['setup_status'] != 'pending':
+                break
+            time.sleep(0.01)
+
+    assert test['setup_status'] == 'done'
+    assert test['object_id'] == 'AS-123'
+    assert [step['name'] for step in test['steps']] == ['purchase', 'adjustment']
+
+
+def test_start_test_setup_failed(mocker, test_client_factory, async_client_mocker_factory, db):
+    client_mocker = async_client_mocker_factory()
+    client_mocker.accounts.all().first().mock(return_value=[{'id': 'VA-123-123'}])
+    mocker.patch(
+        'connect_ext.lifecycle.create_draft_request',
+        side_effect=ClientError('No listing found'),
+    )
+    client = test_client_factory(TstWebApplication)
+
+    response = client.post('/api/tests', json={'product_id': 'PRD-123', 'hub_id': 'HB-123'})
+
+    assert response.status_code == 400
+    test = db._get_test(1)
+    assert test.running is False
+    assert test.result.value == 'failed'
+    assert test.setup_status.value == 'failed'
+    assert test.setup_error == 'No listing found (stage: create_draft_request)'
+
+
+def test_get_health(test_client_factory, db):
+    db._create_new_test('AS-123')
+    client = test_client_factory(TstWebApplication)
+    response = client.get('/api/health')
+    assert response.status_code == 200
+    assert response.json() == {
+        'status': 'ok',
+        'running_tests': 1,
+        'problems': [],
+        'connect_degraded': False,
+    }
+
+
+def test_get_health_connect_errors(test_client_factory):
+    for _ in range(3):
+        get_outbound_errors().add(True)
+    client = test_client_factory(TstWebApplication)
+    response = client.get('/api/health')
+    assert response.status_code == 200
+    assert response.json()['status'] == 'ok'
+    assert response.json()['connect_degraded'] is True
+
+
+def test_get_health_degraded(mocker, test_client_factory, db):
+    mocker.patch('connect_ext.settings.settings', Settings(health_max_db_pending=0))
+    db.health.db_pending = 1
+    client = test_client_factory(TstWebApplication)
+    response = client.get('/api/health')
+    assert response.status_code == 503
+    assert response.json()['status'] == 'degraded'
+    assert response.json()['problems'] == ['1 database calls pending.']
+
+
+def test_get_status(test_client_factory, db):
+    test = db._create_new_test('AS-123', hub_id='HB-123')
+    db._set_test_result(test.id, 'success')
+    statements = []
+    db.connection.set_trace_callback(statements.append)
+
+    client = test_client_factory(TstWebApplication)
+    response = client.get('/api/status')
+
+    assert response.status_code == 200
+    result = response.json()
+    assert result['running_tests'] == 0
+    assert result['last_results']['HB-123']['result'] == 'success'
+    assert result['db']['pending'] == 0
+    assert result['outbound'] == {'calls': 0, 'errors': 0, 'error_rate': 0.0}
+    assert result['setup_workers']['queued'] == 0
+    # The summary only reads the test table, through its indexes.
+    assert statements
+    assert not [statement for statement in statements if 'step' in statement]
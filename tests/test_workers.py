@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2022, CloudBlue
+# All rights reserved.
+#
+import asyncio
+
+import pytest
+
+from connect_ext import instrumentation
+from connect_ext.deadline import deadline, get_deadline
+from connect_ext.instrumentation import instrumented
+from connect_ext.workers import WorkerPool
+
+
+@pytest.mark.asyncio
+async def test_worker_pool_runs_jobs_concurrently():
+    pool = WorkerPool('test', 2)
+    running, peak = [], []
+
+    async def job():
+        running.append(1)
+        peak.append(len(running))
+        await asyncio.sleep(0.01)
+        running.pop()
+
+    for _ in range(5):
+        pool.submit(job)
+    await pool.join()
+
+    assert max(peak) == 2
+    assert pool.stats() == {'size': 2, 'queued': 0, 'completed': 5, 'failed': 0}
+
+
+@pytest.mark.asyncio
+async def test_worker_pool_survives_failed_jobs(caplog):
+    pool = WorkerPool('test', 1)
+
+    async def failing():
+        raise ValueError('boom')
+
+    async def ok():
+        pass
+
+    pool.submit(failing)
+    pool.submit(ok)
+    await pool.join()
+
+    assert pool.stats()['failed'] == 1
+    assert pool.stats()['completed'] == 1
+    # Jobs log their own failures.
+    assert caplog.records == []
+
+
+@pytest.mark.asyncio
+async def test_worker_pool_runs_jobs_outside_submitter_context():
+    pool = WorkerPool('test', 1)
+    seen = []
+
+    async def job():
+        seen.append((get_deadline(), instrumentation._current.get()))
+
+    @instrumented
+    async def handler():
+        with deadline(60):
+            pool.submit(job)
+
+    await handler()
+    await pool.join()
+
+    assert seen == [(None, None)]